@@ -0,0 +1,143 @@
+import java.io.BufferedReader;
+import java.io.ByteArrayOutputStream;
+import java.io.IOException;
+import java.io.InputStreamReader;
+import java.io.OutputStream;
+import java.io.PrintStream;
+import java.lang.management.ManagementFactory;
+import java.lang.management.ThreadMXBean;
+import java.net.StandardProtocolFamily;
+import java.net.UnixDomainSocketAddress;
+import java.nio.channels.Channels;
+import java.nio.channels.ServerSocketChannel;
+import java.nio.channels.SocketChannel;
+import java.nio.charset.StandardCharsets;
+import java.nio.file.Files;
+import java.nio.file.Path;
+import javax.tools.JavaCompiler;
+import javax.tools.ToolProvider;
+
+/**
+ * 常驻的 javac, 见 javac_server.py
+ *
+ * 每个连接一个请求: 第一行为 CPU 时间限制(毫秒)和输出大小限制(字节), 以空格分隔; 第二行为以 \0 分隔的 javac 参数.
+ * 响应的第一行为 "状态 退出码 CPU 时间(毫秒)", 之后是 javac 的输出, 超过限制的部分丢弃.
+ * 状态为 ok, cpu(CPU 时间超限) 或 output(输出超限). 编译线程无法安全中止, 超限时仍在编译则返回响应后整个进程退出.
+ * 标准输入关闭(judge server worker 退出)时退出.
+ */
+public class JavacServer {
+    private static final JavaCompiler COMPILER = ToolProvider.getSystemJavaCompiler();
+    private static final ThreadMXBean THREADS = ManagementFactory.getThreadMXBean();
+    private static final long CPU_CHECK_INTERVAL = 10;  // 毫秒
+
+    /** 只保留前 limit 字节的输出 */
+    private static class LimitedOutputStream extends ByteArrayOutputStream {
+        private final int limit;
+        private boolean exceeded = false;
+
+        LimitedOutputStream(int limit) {
+            this.limit = limit;
+        }
+
+        @Override
+        public synchronized void write(int b) {
+            if (count >= limit) {
+                exceeded = true;
+                return;
+            }
+            super.write(b);
+        }
+
+        @Override
+        public synchronized void write(byte[] b, int off, int len) {
+            if (len > limit - count) {
+                exceeded = true;
+                len = limit - count;
+            }
+            super.write(b, off, len);
+        }
+
+        synchronized boolean exceeded() {
+            return exceeded;
+        }
+    }
+
+    public static void main(String[] args) throws IOException {
+        Path path = Path.of(args[0]);
+        Files.deleteIfExists(path);
+        Thread watchdog = new Thread(() -> {
+            try {
+                while (System.in.read() != -1) {
+                }
+            } catch (IOException e) {
+                // ignore
+            }
+            System.exit(0);
+        });
+        watchdog.setDaemon(true);
+        watchdog.start();
+        try (ServerSocketChannel server = ServerSocketChannel.open(StandardProtocolFamily.UNIX)) {
+            server.bind(UnixDomainSocketAddress.of(path));
+            while (true) {
+                SocketChannel channel = server.accept();
+                Thread thread = new Thread(() -> handle(channel));
+                thread.setDaemon(true);
+                thread.start();
+            }
+        }
+    }
+
+    private static void handle(SocketChannel channel) {
+        try (channel) {
+            BufferedReader reader = new BufferedReader(
+                    new InputStreamReader(Channels.newInputStream(channel), StandardCharsets.UTF_8));
+            String limits = reader.readLine();
+            String line = reader.readLine();
+            if (limits == null || line == null) {
+                return;
+            }
+            String[] fields = limits.split(" ");
+            long maxCpuTime = Long.parseLong(fields[0]);
+            LimitedOutputStream output = new LimitedOutputStream(Integer.parseInt(fields[1]));
+            int[] code = {4};
+            long[] threadCpuTime = {0};
+            Thread compile = new Thread(() -> {
+                try {
+                    // 与 javac 命令行相同, 诊断信息写入 stderr, 这里和 stdout 合并
+                    code[0] = COMPILER.run(null, output, output, line.split("\0"));
+                } catch (Throwable e) {
+                    e.printStackTrace(new PrintStream(output, true, StandardCharsets.UTF_8));
+                    code[0] = 4;
+                } finally {
+                    threadCpuTime[0] = THREADS.getCurrentThreadCpuTime();
+                }
+            });
+            compile.setDaemon(true);
+            compile.start();
+            long cpuTime;
+            while (true) {
+                compile.join(CPU_CHECK_INTERVAL);
+                if (!compile.isAlive()) {
+                    // 编译线程结束前记录了自身的 CPU 时间
+                    cpuTime = threadCpuTime[0] / 1000000;
+                    break;
+                }
+                // 线程刚结束时返回 -1, 下一轮再读取
+                cpuTime = Math.max(THREADS.getThreadCpuTime(compile.getId()), 0) / 1000000;
+                if (cpuTime > maxCpuTime) {
+                    break;
+                }
+            }
+            String status = cpuTime > maxCpuTime ? "cpu" : output.exceeded() ? "output" : "ok";
+            OutputStream out = Channels.newOutputStream(channel);
+            out.write((status + " " + code[0] + " " + cpuTime + "\n").getBytes(StandardCharsets.UTF_8));
+            output.writeTo(out);
+            out.flush();
+            if (compile.isAlive()) {
+                Runtime.getRuntime().halt(1);
+            }
+        } catch (IOException | RuntimeException | InterruptedException e) {
+            // judge server 已断开连接或请求格式错误
+        }
+    }
+}
@@ -0,0 +1,184 @@
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import threading
+import uuid
+
+from compiler import Compiler
+from config import (
+    COMPILE_CACHE_DIR,
+    COMPILE_CACHE_EVICT_INTERVAL,
+    COMPILE_CACHE_MAX_SIZE,
+    COMPILER_GROUP_GID,
+    COMPILER_USER_UID,
+    SPJ_STORE_DIR,
+    SPJ_STORE_MAX_SIZE,
+)
+from languages import BaseLanguageConfig
+from utils import dir_size, logger, remove_stale_tmp
+
+
+class CompileCache(object):
+    """编译产物缓存
+
+    每个条目是 cache_dir 下以 key 命名的目录, 保存编译新生成的全部文件(可执行文件, Java 的 class 文件等).
+    条目先写入临时目录再 rename 发布, 并发的 worker 不会看到写了一半的产物.
+    条目目录的 mtime 作为最近使用时间, 每写入 COMPILE_CACHE_EVICT_INTERVAL 个条目检查一次总大小, 超过 max_size 时淘汰最久未使用的条目.
+    条目发布后内容不变, 本进程记录已统计过的条目大小, 淘汰时只统计新出现的条目.
+    """
+
+    def __init__(self, cache_dir=COMPILE_CACHE_DIR, max_size=COMPILE_CACHE_MAX_SIZE):
+        self._cache_dir = cache_dir
+        self._max_size = max_size
+        self._lock = threading.Lock()
+        self._stored = 0
+        # 条目名 -> 大小, 只在持有 .lock 时访问
+        self._sizes = {}
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def enabled(self):
+        return self._max_size > 0
+
+    @staticmethod
+    def make_key(language, language_config: BaseLanguageConfig, src):
+        src_hash = hashlib.sha256(src.encode("utf-8")).hexdigest()
+        key = json.dumps(
+            [
+                language,
+                type(language_config).__name__,
+                language_config.compile_command,
+                language_config.exe_name,
+                src_hash,
+            ]
+        )
+        return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+    def _count(self, hit):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def _restore(self, key, output_dir):
+        entry_dir = os.path.join(self._cache_dir, key)
+        try:
+            names = os.listdir(entry_dir)
+        except FileNotFoundError:
+            return False
+        copied = []
+        try:
+            for name in names:
+                src = os.path.join(entry_dir, name)
+                dst = os.path.join(output_dir, name)
+                copied.append(dst)
+                if os.path.isdir(src):
+                    shutil.copytree(src, dst)
+                else:
+                    shutil.copy2(src, dst)
+            for path in copied:
+                for root, dirs, files in os.walk(path):
+                    for name in dirs + files:
+                        os.chown(os.path.join(root, name), COMPILER_USER_UID, COMPILER_GROUP_GID)
+                os.chown(path, COMPILER_USER_UID, COMPILER_GROUP_GID)
+            os.utime(entry_dir)
+        except OSError as e:
+            # 条目可能恰好被淘汰, 清理已拷贝的文件后按未命中处理
+            logger.warning(f"Failed to restore compile cache {key}: {e}")
+            for path in copied:
+                if os.path.isdir(path):
+                    shutil.rmtree(path, ignore_errors=True)
+                elif os.path.exists(path):
+                    os.remove(path)
+            return False
+        return True
+
+    def _store(self, key, output_dir, names):
+        entry_dir = os.path.join(self._cache_dir, key)
+        if os.path.exists(entry_dir):
+            return
+        tmp_dir = os.path.join(self._cache_dir, ".tmp-" + uuid.uuid4().hex)
+        try:
+            os.makedirs(tmp_dir)
+            for name in names:
+                src = os.path.join(output_dir, name)
+                if os.path.isdir(src):
+                    shutil.copytree(src, os.path.join(tmp_dir, name))
+                else:
+                    shutil.copy2(src, os.path.join(tmp_dir, name))
+            os.rename(tmp_dir, entry_dir)
+        except OSError as e:
+            # 其他 worker 已发布同一条目时 rename 会失败, 直接丢弃
+            logger.debug(f"Failed to store compile cache {key}: {e}")
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            return
+        with self._lock:
+            self._stored += 1
+            evict = self._stored % COMPILE_CACHE_EVICT_INTERVAL == 0
+        if evict:
+            self._evict()
+
+    def _evict(self):
+        lock_fd = os.open(os.path.join(self._cache_dir, ".lock"), os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            try:
+                fcntl.flock(lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                # 其他 worker 正在淘汰
+                return
+            remove_stale_tmp(self._cache_dir)
+            sizes = {}
+            entries = []
+            total = 0
+            with os.scandir(self._cache_dir) as it:
+                for entry in it:
+                    if entry.name.startswith(".") or not entry.is_dir():
+                        continue
+                    size = self._sizes.get(entry.name)
+                    if size is None:
+                        size = dir_size(entry.path)
+                    sizes[entry.name] = size
+                    total += size
+                    entries.append((entry.stat().st_mtime, size, entry.name))
+            entries.sort()
+            for _, size, name in entries:
+                if total <= self._max_size:
+                    break
+                shutil.rmtree(os.path.join(self._cache_dir, name), ignore_errors=True)
+                del sizes[name]
+                total -= size
+            self._sizes = sizes
+        finally:
+            os.close(lock_fd)
+
+    def compile(self, language, language_config: BaseLanguageConfig, src, src_path, output_dir):
+        """编译源码, 命中缓存时直接还原编译产物
+
+        :return: 可执行文件路径
+        """
+        if not self.enabled or not language_config.reproducible:
+            return Compiler().compile(language_config=language_config, src_path=src_path, output_dir=output_dir)
+
+        os.makedirs(self._cache_dir, exist_ok=True)
+        key = self.make_key(language, language_config, src)
+        if self._restore(key, output_dir):
+            self._count(hit=True)
+            return os.path.join(output_dir, language_config.exe_name)
+        self._count(hit=False)
+
+        before = set(os.listdir(output_dir))
+        exe_path = Compiler().compile(language_config=language_config, src_path=src_path, output_dir=output_dir)
+        self._store(key, output_dir, [name for name in os.listdir(output_dir) if name not in before])
+        return exe_path
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses}
+
+
+compile_cache = CompileCache()
+spj_cache = CompileCache(cache_dir=SPJ_STORE_DIR, max_size=SPJ_STORE_MAX_SIZE)
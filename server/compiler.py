@@ -4,9 +4,12 @@ import shlex
 
 import judger
 
-from config import DEBUG, COMPILER_GROUP_GID, COMPILER_LOG_PATH, COMPILER_USER_UID
+from config import DEBUG, COMPILER_GROUP_GID, COMPILER_LOG_PATH, COMPILER_USER_UID, MAX_COMPILER_OUTPUT_BYTES
 from exception import CompileError, CompilerRuntimeError
+from javac_server import javac_server
 from languages import BaseLanguageConfig
+from pch import precompiled_headers
+from toolchain_cache import java_cds
 from utils import logger
 
 
@@ -15,11 +18,22 @@ class Compiler(object):
         command = language_config.compile_command
         exe_path = os.path.join(output_dir, language_config.exe_name)
         command = command.format(
-            src_path=src_path, exe_dir=output_dir, exe_path=exe_path
+            src_path=src_path,
+            exe_dir=output_dir,
+            exe_path=exe_path,
+            pch_include=precompiled_headers.include(language_config, src_path),
+            cds_options=java_cds.javac_options(language_config),
         )
         compiler_out = os.path.join(output_dir, "compiler.out")
         _command = shlex.split(command)
 
+        if javac_server.enabled_for(language_config):
+            # 常驻进程的工作目录不是 output_dir, 显式指定与命令行相同的默认 classpath
+            args = ["-cp", output_dir] + [arg for arg in _command[1:] if not arg.startswith("-J")]
+            result = javac_server.compile(language_config, args, compiler_out)
+            if result is not None:
+                return self._check_result(result["result"] == judger.RESULT_SUCCESS, result, compiler_out, exe_path)
+
         os.chdir(output_dir)
         env = language_config.env + ["PATH=" + os.getenv("PATH")]
         if DEBUG:
@@ -29,7 +43,7 @@ class Compiler(object):
             max_real_time=language_config.max_real_time,
             max_memory=language_config.max_memory,
             max_stack=128 * 1024 * 1024,
-            max_output_size=20 * 1024 * 1024,
+            max_output_size=MAX_COMPILER_OUTPUT_BYTES,
             max_process_number=judger.UNLIMITED,
             exe_path=_command[0],
             # /dev/null is best, but in some system, this will call ioctl system call
@@ -45,7 +59,11 @@ class Compiler(object):
         )
         if DEBUG:
             logger.debug(str(result))
-        if result["result"] != judger.RESULT_SUCCESS:
+        return self._check_result(result["result"] == judger.RESULT_SUCCESS, result, compiler_out, exe_path)
+
+    @staticmethod
+    def _check_result(success, result, compiler_out, exe_path):
+        if not success:
             if os.path.exists(compiler_out):
                 with open(compiler_out, encoding="utf-8") as f:
                     error = f.read().strip()
@@ -5,6 +5,7 @@ import pwd
 DEBUG = os.environ.get("judger_debug") == "1"
 
 JUDGER_WORKSPACE_BASE = "/judger/run"
+JUDGER_PATH = "/usr/lib/judger/libjudger.so"  # judger.run 启动的沙箱程序
 LOG_BASE = "/log"
 
 COMPILER_LOG_PATH = os.path.join(LOG_BASE, "compile.log")
@@ -26,3 +27,107 @@ SPJ_EXE_DIR = "/judger/spj"
 
 MAX_READ_BYTES = 64 * 1024 * 1024  # 最大读取输出大小 64M
 MAX_RESP_BYTES = 16 * 1024  # 最大服务器 API 响应输出大小 16K
+MAX_COMPILER_OUTPUT_BYTES = 20 * 1024 * 1024  # 编译器最大输出大小 20M
+
+# 全机共享的测试用例运行槽位, 每个槽位对应 RUN_SLOT_DIR 下的一个文件锁
+RUN_SLOT_DIR = "/judger/slots"
+RUN_SLOT_NUM = int(os.getenv("RUN_SLOT_NUM", 0)) or os.cpu_count() or 1
+SLOT_POLL_INTERVAL = 0.01  # 全部槽位被占用时的重试间隔, 秒
+SLOT_POLL_MAX_INTERVAL = 0.1  # 重试间隔按指数退避的上限, 秒
+
+# 全机共享的编译槽位, 与运行槽位分开, 每个槽位对应 COMPILE_SLOT_DIR 下的一个文件锁
+COMPILE_SLOT_DIR = "/judger/compile_slots"
+COMPILE_SLOT_NUM = int(os.getenv("COMPILE_SLOT_NUM", 0)) or max((os.cpu_count() or 1) // 2, 1)
+COMPILE_MEMORY_BUDGET = int(os.getenv("COMPILE_MEMORY_BUDGET_MB", 4096)) * 1024 * 1024  # 同时编译的内存上限之和, 0 表示不限制
+COMPILE_UNLIMITED_MEMORY = 1024 * 1024 * 1024  # 不限制编译内存的语言(Java)计入预算的大小
+COMPILE_NICE = int(os.getenv("COMPILE_NICE", 10))  # 编译线程及编译器进程的 nice 值
+COMPILE_POLL_INTERVAL = 0.05  # 编译槽位全部被占用或内存预算不足时的重试间隔, 秒
+
+# 编译产物缓存, 按 语言 + 编译命令 + 源码哈希 寻址, 超过上限按 LRU 淘汰, 0 表示关闭
+COMPILE_CACHE_DIR = "/judger/compile_cache"
+COMPILE_CACHE_MAX_SIZE = int(os.getenv("COMPILE_CACHE_MAX_SIZE_MB", 1024)) * 1024 * 1024
+COMPILE_CACHE_EVICT_INTERVAL = 16  # 每写入多少个条目检查一次总大小
+STALE_TMP_AGE = 3600  # 缓存目录下超过该时间(秒)未修改的 .tmp-* 视为崩溃遗留, 淘汰时清理
+
+# 评测结果缓存, 按 编译产物 + 测试用例 + 评测参数 寻址, 请求指定 use_result_cache 时使用, 超过上限按 LRU 淘汰, 0 表示关闭
+RESULT_CACHE_DIR = "/judger/result_cache"
+RESULT_CACHE_MAX_SIZE = int(os.getenv("RESULT_CACHE_MAX_SIZE_MB", 256)) * 1024 * 1024
+RESULT_CACHE_LIMIT_MARGIN = 0.5  # 缓存结果的用时和内存都不超过本次限制的该比例时才使用
+RESULT_CACHE_EVICT_INTERVAL = 64  # 每写入多少个条目检查一次总大小
+
+# C++ 预编译的 bits/stdc++.h, 每个 语言标准 + O2/asan 组合首次使用时在后台生成, 无法使用时回退为普通编译
+PCH_DIR = "/judger/pch"
+PCH_ENABLED = os.getenv("PCH_ENABLED", "1") == "1"
+PCH_PREBUILD = [std for std in os.getenv("PCH_PREBUILD", "c++14,c++17").split(",") if std]  # 启动时生成的语言标准(O2)
+PCH_BUILD_TIMEOUT = 300  # 秒
+PCH_CHECK_INTERVAL = 60  # 每个 worker 缓存预编译头文件是否可用的时间, 秒
+
+# Go 构建缓存, 属于编译用户, 容器重启时保留. 启动时预编译标准库, 超过上限按 LRU 淘汰
+GO_CACHE_DIR = "/judger/go_cache"
+GO_CACHE_MAX_SIZE = int(os.getenv("GO_CACHE_MAX_SIZE_MB", 2048)) * 1024 * 1024
+GO_CACHE_TRIM_INTERVAL = 10 * 60  # 秒
+
+# javac 和 java 的 AppCDS 归档, 启动时在后台生成, 编译和运行时共享 JDK 类的元数据
+JAVA_CDS_DIR = "/judger/cds"
+JAVA_CDS_ENABLED = os.getenv("JAVA_CDS_ENABLED", "1") == "1"
+TOOLCHAIN_BUILD_TIMEOUT = 300  # 预热命令的超时时间, 秒
+
+# 常驻的 javac 进程, 以编译用户运行, 通过 unix socket 接收编译请求, 不可用时回退为每次启动 javac
+JAVAC_SERVER_ENABLED = os.getenv("JAVAC_SERVER_ENABLED", "0") == "1"
+JAVAC_SERVER_DIR = "/judger/javac_server"
+JAVAC_SERVER_MAX_REQUESTS = int(os.getenv("JAVAC_SERVER_MAX_REQUESTS", 500))  # 处理多少个请求后重启
+JAVAC_SERVER_MAX_RSS = int(os.getenv("JAVAC_SERVER_MAX_RSS_MB", 1024)) * 1024 * 1024  # 内存超过该值后重启
+JAVAC_SERVER_START_TIMEOUT = 30  # 秒
+
+# 异步评测任务, 结果保存在 JOB_DIR 下, 供任意 worker 查询
+JOB_DIR = "/judger/jobs"
+JOB_QUEUE_SIZE = int(os.getenv("JOB_QUEUE_SIZE", 64))  # 每个 worker 的排队任务上限
+JOB_WORKER_NUM = int(os.getenv("JOB_WORKER_NUM", 4))
+JOB_RESULT_TTL = 60 * 60  # 任务结果保留时间, 秒
+JOB_RETRY_AFTER = 5  # 队列已满时建议的重试间隔, 秒
+
+# 持久化存储, 容器重启时不会被清理
+JUDGER_STORE_BASE = "/judger/store"
+# spj 编译产物按 源码哈希 寻址保存, 超过上限按 LRU 淘汰
+SPJ_STORE_DIR = os.path.join(JUDGER_STORE_BASE, "spj")
+SPJ_STORE_MAX_SIZE = int(os.getenv("SPJ_STORE_MAX_SIZE_MB", 256)) * 1024 * 1024
+# 内联和上传的测试用例按内容寻址去重保存, 超过上限按 LRU 淘汰, 0 表示关闭
+TEST_CASE_STORE_DIR = os.path.join(JUDGER_STORE_BASE, "test_case")
+TEST_CASE_STORE_MAX_SIZE = int(os.getenv("TEST_CASE_STORE_MAX_SIZE_MB", 1024)) * 1024 * 1024
+TEST_CASE_STORE_EVICT_INTERVAL = 8  # 每发布多少个条目检查一次总大小
+
+# 测试用例同步, TEST_CASE_DIR 中没有的 test_case_id 从 TEST_CASE_SOURCE 下载, 可以是目录或 http(s) 地址, 为空表示关闭
+# 来源的布局: <test_case_id>/latest 保存最新版本号, <test_case_id>/<version>.tar.zst 为该版本的测试用例打包
+TEST_CASE_SOURCE = os.getenv("TEST_CASE_SOURCE", "")
+TEST_CASE_SYNC_DIR = os.path.join(JUDGER_STORE_BASE, "test_case_sync")
+# 解压后的测试用例和下载的压缩包分别按 LRU 淘汰
+TEST_CASE_SYNC_MAX_SIZE = int(os.getenv("TEST_CASE_SYNC_MAX_SIZE_MB", 10240)) * 1024 * 1024
+TEST_CASE_SYNC_PACKAGE_MAX_SIZE = int(os.getenv("TEST_CASE_SYNC_PACKAGE_MAX_SIZE_MB", 10240)) * 1024 * 1024
+TEST_CASE_SYNC_VERSION_TTL = 60  # 最新版本号的缓存时间, 秒
+TEST_CASE_SYNC_TIMEOUT = 60  # 下载超时, 秒
+
+# 预热评测最频繁的测试用例的页缓存, 同一时间只有一个 worker 负责
+PAGE_CACHE_LOCK_PATH = "/judger/page_cache.lock"
+PAGE_CACHE_WARM_INTERVAL = 30  # 秒
+PAGE_CACHE_HOT_NUM = int(os.getenv("PAGE_CACHE_HOT_NUM", 8))  # 预热的测试用例数量, 0 表示关闭
+PAGE_CACHE_MLOCK_BUDGET = int(os.getenv("PAGE_CACHE_MLOCK_BUDGET_MB", 0)) * 1024 * 1024  # mlock 的总大小上限, 0 表示不锁定
+
+# 各 worker 的监控数据, 由 /metrics 合并输出
+METRICS_DIR = "/judger/metrics"
+METRICS_FLUSH_INTERVAL = 5  # 秒
+
+# 评测目录先移入回收目录, 由后台线程限速删除
+JUDGER_TRASH_DIR = "/judger/trash"
+REAPER_MAX_UNLINK_RATE = int(os.getenv("REAPER_MAX_UNLINK_RATE", 2000))  # 每秒最多删除的文件数
+REAPER_URGENT_DISK_USAGE = 0.9  # 磁盘使用率超过该值时不再限速
+
+# 每个 worker 预先创建的评测目录数量, 0 表示关闭. 评测目录可以挂载为 tmpfs, 见 docker-compose.example.yml
+WORKSPACE_POOL_SIZE = int(os.getenv("WORKSPACE_POOL_SIZE", 8))
+
+# /judge_batch 单次请求最多包含的 job 数量
+JUDGE_BATCH_MAX_JOBS = int(os.getenv("JUDGE_BATCH_MAX_JOBS", 64))
+
+# 以 multipart 或 tar 上传的测试用例, 评测结束后删除
+UPLOAD_DIR = "/judger/upload"
+# gzip/zstd 压缩的请求体解压后的最大大小
+UPLOAD_MAX_SIZE = int(os.getenv("UPLOAD_MAX_SIZE_MB", 1024)) * 1024 * 1024
@@ -1,15 +1,28 @@
 #!/bin/bash
 set -ex
 
-rm -rf /judger/*
-mkdir -p /judger/run /judger/spj /log
+# /judger/store 和 /judger/go_cache 保存需要跨重启保留的数据, /judger/run 和 /judger/trash 由 judge server 在后台清理
+find /judger -mindepth 1 -maxdepth 1 ! -name store ! -name run ! -name trash ! -name go_cache -exec rm -rf {} +
+mkdir -p /judger/run /judger/trash /judger/pch /judger/cds /judger/go_cache /judger/javac_server /judger/spj /judger/slots /judger/compile_slots /judger/compile_cache /judger/result_cache /judger/jobs /judger/metrics /judger/upload /judger/store/spj /judger/store/test_case /judger/store/test_case_sync /log
 
 chown compiler:code /judger/run
 chmod 711 /judger/run
 
+# 预编译头文件和 AppCDS 归档由 judge server 生成, 编译和运行用户只读
+chown root:root /judger/pch /judger/cds
+chmod 755 /judger/pch /judger/cds
+
+# Go 构建缓存和常驻 javac 的 socket 只有编译用户可以读写
+chown -R compiler:compiler /judger/go_cache
+chown compiler:compiler /judger/javac_server
+chmod 700 /judger/go_cache /judger/javac_server
+
 chown compiler:spj /judger/spj
 chmod 710 /judger/spj
 
+chown root:root /judger/trash /judger/slots /judger/compile_slots /judger/compile_cache /judger/result_cache /judger/jobs /judger/metrics /judger/upload /judger/store /judger/store/spj /judger/store/test_case /judger/store/test_case_sync
+chmod 700 /judger/trash /judger/slots /judger/compile_slots /judger/compile_cache /judger/result_cache /judger/jobs /judger/metrics /judger/upload /judger/store /judger/store/spj /judger/store/test_case /judger/store/test_case_sync
+
 touch /log/judge_server.log /log/gunicorn.log /log/compile.log
 chown root:root /log /log/judge_server.log /log/gunicorn.log
 chmod 711 /log
@@ -32,3 +32,29 @@ class JudgeClientError(JudgeServerException):
 
 class JudgeServiceError(JudgeServerException):
     pass
+
+
+class JudgeQueueFull(JudgeServerException):
+    """评测队列已满"""
+
+    status = 429
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class JobNotFound(JudgeServerException):
+    status = 404
+
+
+class JobLost(JudgeServerException):
+    """执行任务的 worker 已退出, 任务不会再执行, 需要重新提交"""
+
+    pass
+
+
+class TestCaseNotFound(JudgeServerException):
+    """按 test_case_hash 评测时存储中没有对应的测试用例, 需要重新发送测试用例"""
+
+    status = 404
@@ -4,3 +4,10 @@ bind = "0.0.0.0:8080"
 error_logfile = "/log/gunicorn.log"
 workers = int(int(os.getenv("MAX_WORKER_NUM", default=2)) / 2)
 threads = 4
+
+
+def on_starting(server):
+    # 上次异常退出时遗留的评测目录移入回收目录, 由 worker 在后台删除
+    from reaper import reaper
+
+    reaper.recover()
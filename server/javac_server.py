@@ -0,0 +1,247 @@
+import fcntl
+import os
+import socket
+import subprocess
+import threading
+import time
+import uuid
+
+import judger
+import psutil
+
+from config import (
+    COMPILER_GROUP_GID,
+    COMPILER_USER_UID,
+    JAVAC_SERVER_DIR,
+    JAVAC_SERVER_ENABLED,
+    JAVAC_SERVER_MAX_REQUESTS,
+    JAVAC_SERVER_MAX_RSS,
+    JAVAC_SERVER_START_TIMEOUT,
+    MAX_COMPILER_OUTPUT_BYTES,
+)
+from languages import JavaConfig
+from utils import logger
+
+JAVA = "/usr/bin/java"
+JAVAC = "/usr/bin/javac"
+SOURCE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "JavacServer.java")
+MAIN_CLASS = "JavacServer"
+RECV_CHUNK_SIZE = 64 * 1024
+MAX_HEADER_BYTES = 64  # 响应第一行 "状态 退出码 CPU 时间" 的最大长度
+# 响应状态对应的 judger 结果, 与命令行 javac 超出同样限制时一致
+STATUS_RESULTS = {
+    "cpu": judger.RESULT_CPU_TIME_LIMIT_EXCEEDED,
+    "output": judger.RESULT_RUNTIME_ERROR,
+}
+
+
+class _Daemon(object):
+    def __init__(self, proc, sock_path):
+        self.proc = proc
+        self.sock_path = sock_path
+        self.requests = 0
+        self.in_flight = 0
+        self.retired = False
+
+    def stop(self):
+        if self.proc.poll() is None:
+            self.proc.kill()
+            self.proc.wait()
+        if os.path.exists(self.sock_path):
+            os.remove(self.sock_path)
+
+
+class JavacServer(object):
+    """常驻的 javac 进程, 以编译用户运行, 通过 unix socket 接收编译请求
+
+    每个 worker 按需启动一个进程, 每个请求使用独立的 javac 实例, 输出目录由请求参数指定.
+    处理 max_requests 个请求或内存超过 max_rss 后不再接收新请求, 正在处理的请求结束后退出.
+    与 Compiler.compile 一样限制 CPU 时间, 总用时和输出大小: CPU 时间由常驻进程统计编译线程, 超限时仍在编译则进程退出;
+    总用时超过 max_real_time 时杀死常驻进程. Java 编译不限制内存, 常驻进程的内存由 max_rss 限制.
+    进程无法启动或通信失败时返回 None, 由调用方回退为每次启动 javac.
+    """
+
+    def __init__(
+            self,
+            server_dir=JAVAC_SERVER_DIR,
+            enabled=JAVAC_SERVER_ENABLED,
+            max_requests=JAVAC_SERVER_MAX_REQUESTS,
+            max_rss=JAVAC_SERVER_MAX_RSS,
+            max_output_size=MAX_COMPILER_OUTPUT_BYTES,
+    ):
+        self._server_dir = server_dir
+        self._enabled = enabled
+        self._max_requests = max_requests
+        self._max_rss = max_rss
+        self._max_output_size = max_output_size
+        self._lock = threading.Lock()
+        self._daemon = None
+        self.requests = 0
+        self.fallbacks = 0
+        self.restarts = 0
+
+    def enabled_for(self, language_config):
+        return self._enabled and isinstance(language_config, JavaConfig)
+
+    def _prepare(self):
+        """编译 JavacServer.java, 编译用户无法读取 /app 下的源码"""
+        class_path = os.path.join(self._server_dir, MAIN_CLASS + ".class")
+        lock_fd = os.open(os.path.join(self._server_dir, ".lock"), os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(lock_fd, fcntl.LOCK_EX)
+            if os.path.exists(class_path) and os.stat(class_path).st_mtime >= os.stat(SOURCE_PATH).st_mtime:
+                return
+            subprocess.run([JAVAC, "-d", self._server_dir, SOURCE_PATH], check=True, capture_output=True, timeout=60)
+            os.chown(class_path, COMPILER_USER_UID, COMPILER_GROUP_GID)
+            os.chmod(class_path, 0o400)
+        finally:
+            os.close(lock_fd)
+
+    def _start(self, language_config):
+        self._prepare()
+        sock_path = os.path.join(self._server_dir, f"{os.getpid()}-{uuid.uuid4().hex}.sock")
+        proc = subprocess.Popen(
+            [JAVA, "-XX:+UseSerialGC", "-cp", self._server_dir, MAIN_CLASS, sock_path],
+            # worker 退出时管道关闭, 常驻进程随之退出
+            stdin=subprocess.PIPE,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            cwd=self._server_dir,
+            env=dict(item.split("=", 1) for item in language_config.env + ["PATH=" + os.getenv("PATH")]),
+            user=COMPILER_USER_UID,
+            group=COMPILER_GROUP_GID,
+        )
+        deadline = time.monotonic() + JAVAC_SERVER_START_TIMEOUT
+        while not os.path.exists(sock_path):
+            if proc.poll() is not None or time.monotonic() > deadline:
+                _Daemon(proc, sock_path).stop()
+                raise OSError(f"javac server exited with {proc.returncode}")
+            time.sleep(0.05)
+        with self._lock:
+            self.restarts += 1
+        return _Daemon(proc, sock_path)
+
+    def _acquire(self, language_config):
+        with self._lock:
+            daemon = self._daemon
+            if daemon is not None and daemon.proc.poll() is None:
+                daemon.requests += 1
+                daemon.in_flight += 1
+                return daemon
+        # 启动较慢, 不持有锁, 并发启动时只保留一个
+        started = self._start(language_config)
+        with self._lock:
+            if self._daemon is not None and self._daemon.proc.poll() is None:
+                extra, daemon = started, self._daemon
+            else:
+                extra, daemon = None, started
+                self._daemon = started
+            daemon.requests += 1
+            daemon.in_flight += 1
+        if extra is not None:
+            extra.stop()
+        return daemon
+
+    def _release(self, daemon, failed, kill=False):
+        """:param kill: 立即杀死常驻进程, 不等待其他请求结束"""
+        try:
+            rss = psutil.Process(daemon.proc.pid).memory_info().rss
+        except psutil.Error:
+            rss = 0
+        with self._lock:
+            daemon.in_flight -= 1
+            if failed or kill or daemon.requests >= self._max_requests or rss > self._max_rss:
+                daemon.retired = True
+                if self._daemon is daemon:
+                    self._daemon = None
+            stop = kill or (daemon.retired and daemon.in_flight == 0)
+        if stop:
+            daemon.stop()
+
+    def _request(self, daemon, request, deadline):
+        """发送请求并读取响应, 总用时超过 deadline 时抛出 socket.timeout"""
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(max(deadline - time.monotonic(), 0.001))
+            sock.connect(daemon.sock_path)
+            sock.sendall(request)
+            response = bytearray()
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise socket.timeout("javac server request timed out")
+                sock.settimeout(remaining)
+                chunk = sock.recv(RECV_CHUNK_SIZE)
+                if not chunk:
+                    return bytes(response)
+                response += chunk
+                if len(response) > MAX_HEADER_BYTES + self._max_output_size:
+                    raise ValueError("javac server output too large")
+
+    def compile(self, language_config, args, compiler_out):
+        """以 args 调用 javac, 输出写入 compiler_out
+
+        :param args: javac 的参数, 不含 javac 本身和 -J 参数
+        :return: 与 judger.run 格式相同的 result, exit_code, cpu_time, real_time, 需要回退时为 None
+        """
+        try:
+            daemon = self._acquire(language_config)
+        except (OSError, subprocess.SubprocessError) as e:
+            logger.warning(f"Failed to start javac server: {e}")
+            with self._lock:
+                self.fallbacks += 1
+            return None
+        request = (
+            f"{language_config.max_cpu_time} {self._max_output_size}\n" + "\0".join(args) + "\n"
+        ).encode("utf-8")
+        start = time.monotonic()
+        failed = True
+        kill = False
+        try:
+            response = self._request(daemon, request, start + language_config.max_real_time / 1000)
+            header, _, output = response.partition(b"\n")
+            status, code, cpu_time = header.decode("ascii").split()
+            code = int(code)
+            with open(compiler_out, "wb") as f:
+                f.write(output)
+            # CPU 时间超限时常驻进程可能已退出
+            failed = status != "ok"
+        except socket.timeout:
+            # 编译线程无法单独中止, 杀死常驻进程, 与超时的 javac 一样按编译失败处理
+            kill = True
+            with self._lock:
+                self.requests += 1
+            return {
+                "result": judger.RESULT_REAL_TIME_LIMIT_EXCEEDED,
+                "exit_code": 0,
+                "cpu_time": 0,
+                "real_time": int((time.monotonic() - start) * 1000),
+            }
+        except (OSError, ValueError) as e:
+            # 进程异常退出, 重启后再用
+            logger.warning(f"javac server request failed: {e}")
+            with self._lock:
+                self.fallbacks += 1
+            return None
+        finally:
+            self._release(daemon, failed, kill=kill)
+        with self._lock:
+            self.requests += 1
+        if status in STATUS_RESULTS:
+            result = STATUS_RESULTS[status]
+        elif code != 0:
+            result = judger.RESULT_RUNTIME_ERROR
+        else:
+            result = judger.RESULT_SUCCESS
+        return {
+            "result": result,
+            "exit_code": code,
+            "cpu_time": int(cpu_time),
+            "real_time": int((time.monotonic() - start) * 1000),
+        }
+
+    def stats(self):
+        with self._lock:
+            return {"requests": self.requests, "fallbacks": self.fallbacks, "restarts": self.restarts}
+
+
+javac_server = JavacServer()
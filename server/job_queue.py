@@ -0,0 +1,163 @@
+import hashlib
+import hmac
+import json
+import os
+import queue
+import re
+import threading
+import time
+import uuid
+
+import psutil
+import requests
+
+from config import JOB_DIR, JOB_QUEUE_SIZE, JOB_RESULT_TTL, JOB_RETRY_AFTER, JOB_WORKER_NUM
+from exception import JobLost, JobNotFound, JudgeQueueFull
+from utils import exception_info, get_token, logger
+
+
+class JobStatus:
+    pending = "pending"
+    running = "running"
+    done = "done"
+
+
+class JobQueue(object):
+    """异步评测任务队列
+
+    任务在提交的 worker 进程内排队执行, 状态和结果写入 JOB_DIR, 任意 worker 都可以查询.
+    队列已满时抛出 JudgeQueueFull, 由调用方返回 429.
+    未完成的任务记录所属 worker 的 pid 和启动时间, 查询时该 worker 已退出则标记为 JobLost.
+    """
+
+    def __init__(self, job_dir=JOB_DIR, max_size=JOB_QUEUE_SIZE, worker_num=JOB_WORKER_NUM):
+        self._job_dir = job_dir
+        self._worker_num = worker_num
+        self._queue = queue.Queue(maxsize=max_size)
+        self._lock = threading.Lock()
+        self._started = False
+        self._last_cleanup = 0
+        self._owner = None
+
+    @staticmethod
+    def _process_owner(process):
+        return f"{process.pid}:{process.create_time()}"
+
+    def _start(self):
+        os.makedirs(self._job_dir, exist_ok=True)
+        # gunicorn fork 之后才记录, 各 worker 不同
+        self._owner = self._process_owner(psutil.Process())
+        for _ in range(self._worker_num):
+            threading.Thread(target=self._worker, daemon=True).start()
+        self._started = True
+
+    def _job_path(self, job_id):
+        if not re.fullmatch(r"[0-9a-f]{32}", job_id or ""):
+            raise JobNotFound("job not found")
+        return os.path.join(self._job_dir, job_id + ".json")
+
+    def _write(self, job_id, job):
+        path = self._job_path(job_id)
+        # 查询时可能与其他 worker 同时写入同一任务
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(job, f)
+        os.replace(tmp_path, path)
+
+    def submit(self, func, kwargs, callback_url=None):
+        """提交异步任务
+
+        :param func: 任务函数, 以 kwargs 调用
+        :param callback_url: 任务完成后将结果 POST 到该地址, X-JUDGE-SERVER-SIGNATURE 为以 TOKEN 为密钥的请求体 HMAC-SHA256
+        :return: job_id
+        """
+        with self._lock:
+            if not self._started:
+                self._start()
+        job_id = uuid.uuid4().hex
+        self._write(job_id, self._job(job_id, JobStatus.pending))
+        try:
+            self._queue.put_nowait((job_id, func, kwargs, callback_url))
+        except queue.Full:
+            os.remove(self._job_path(job_id))
+            raise JudgeQueueFull("judge queue is full", retry_after=JOB_RETRY_AFTER)
+        self._cleanup()
+        return job_id
+
+    def _job(self, job_id, status):
+        return {"job_id": job_id, "status": status, "err": None, "data": None, "owner": self._owner}
+
+    def _owner_alive(self, owner):
+        pid, _, _ = (owner or "").partition(":")
+        try:
+            return self._process_owner(psutil.Process(int(pid))) == owner
+        except (ValueError, psutil.Error):
+            return False
+
+    def result(self, job_id):
+        try:
+            with open(self._job_path(job_id)) as f:
+                job = json.load(f)
+        except FileNotFoundError:
+            raise JobNotFound("job not found")
+        if job["status"] != JobStatus.done and not self._owner_alive(job.get("owner")):
+            # worker 退出或重启, 排队和运行中的任务随之丢失
+            job["status"] = JobStatus.done
+            job["err"], job["data"] = exception_info(JobLost("judge server worker exited before the job finished"))
+            self._write(job_id, job)
+        job.pop("owner", None)
+        return job
+
+    def _worker(self):
+        while True:
+            job_id, func, kwargs, callback_url = self._queue.get()
+            job = self._job(job_id, JobStatus.running)
+            self._write(job_id, job)
+            try:
+                job["data"] = func(**kwargs)
+            except Exception as e:
+                logger.exception(e)
+                job["err"], job["data"] = exception_info(e)
+            job["status"] = JobStatus.done
+            try:
+                self._write(job_id, job)
+            except Exception as e:
+                logger.exception(e)
+            job.pop("owner")
+            if callback_url:
+                self._callback(callback_url, job)
+
+    @staticmethod
+    def _callback(callback_url, job):
+        # 回调地址由请求指定, 不能发送可以调用接口的 token, 只发送签名供接收方校验
+        body = json.dumps(job).encode("utf-8")
+        signature = hmac.new(get_token().encode("utf-8"), body, hashlib.sha256).hexdigest()
+        try:
+            requests.post(
+                callback_url,
+                data=body,
+                headers={"X-JUDGE-SERVER-SIGNATURE": signature, "Content-Type": "application/json"},
+                timeout=5,
+            )
+        except Exception as e:
+            logger.exception(f"Job callback request failed: {e}")
+
+    def _cleanup(self):
+        # 每分钟最多清理一次过期的任务结果
+        now = time.time()
+        if now - self._last_cleanup < 60:
+            return
+        self._last_cleanup = now
+        for name in os.listdir(self._job_dir):
+            path = os.path.join(self._job_dir, name)
+            try:
+                if now - os.stat(path).st_mtime > JOB_RESULT_TTL:
+                    os.remove(path)
+            except OSError:
+                pass
+
+    def stats(self):
+        return {"queued": self._queue.qsize(), "max_size": self._queue.maxsize}
+
+
+job_queue = JobQueue()
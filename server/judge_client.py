@@ -1,16 +1,21 @@
+import collections
 import hashlib
+import itertools
 import json
+import math
 import os
 import re
 import shlex
-import shutil
-from multiprocessing import Pool
-from typing import Tuple
+import subprocess
+import threading
+from concurrent.futures import as_completed, wait
+from typing import NamedTuple, Optional, Tuple
 
 import judger
 import psutil
 
 from config import (
+    JUDGER_PATH,
     JUDGER_RUN_LOG_PATH,
     MAX_READ_BYTES,
     MAX_RESP_BYTES,
@@ -22,15 +27,206 @@ from config import (
 )
 from exception import JudgeClientError
 from languages import BaseLanguageConfig
+from metrics import Stage, metrics
+from output_hash import output_md5
+from scheduler import run_scheduler
+from staging import stage_file
+from toolchain_cache import java_cds
 from utils import ProblemIOMode
 
 SPJ_WA = 1
 SPJ_AC = 0
 SPJ_ERROR = -1
 
-
-def _run(instance, test_case_file_id):
-    return instance._judge_one(test_case_file_id)
+# 快速失败模式下未运行或被中止的用例
+RESULT_SKIPPED = -3
+
+COMPARE_CHUNK_SIZE = 1024 * 1024
+WHITESPACE_RE = re.compile(rb"\s")
+MAX_TOKEN_BYTES = 16 * 1024 * 1024  # 内置检查器单个 token 或行的最大长度
+
+
+class CheckerType:
+    """内置检查器, 无需编译和运行 spj"""
+
+    tokens = "tokens"  # 逐个比较空白分隔的 token
+    tokens_ci = "tokens_ci"  # 逐个比较 token, 忽略大小写
+    float = "float"  # 数字 token 允许绝对/相对误差, 其余 token 精确比较
+    lines_unordered = "lines_unordered"  # 忽略行顺序和空行, 比较每行去除行尾空白后的内容
+
+
+DEFAULT_FLOAT_EPS = 1e-6
+
+# 解析后的测试用例 info 缓存, 按 info 文件的 mtime/size/inode 失效
+TEST_CASE_INFO_CACHE_NUM = 256
+_test_case_info_cache = collections.OrderedDict()  # info_path -> (stat_key, info, test_case_files)
+_test_case_info_cache_lock = threading.Lock()
+
+# 各题目每个用例的历史运行时间, 用于决定用例派发顺序
+RUNTIME_PROFILE_NUM = 1024
+_runtime_profiles = collections.OrderedDict()  # test_case_dir -> {test_case_file_id: real_time}
+_runtime_profiles_lock = threading.Lock()
+
+
+def _run_in_dir(cwd, **kwargs):
+    """以 cwd 为工作目录调用 judger.run
+
+    调度器在线程中运行测试用例, 直接 os.chdir 会影响同进程内其他用例.
+    judger.run 本身就是启动 libjudger.so 并解析它输出的 JSON, 这里按相同的命令行参数直接启动, 只多指定工作目录
+    """
+    args = [JUDGER_PATH]
+    for name, value in kwargs.items():
+        if name == "seccomp_rule_name":
+            if value:
+                args.append(f"--seccomp_rule={value}")
+        elif isinstance(value, list):
+            args.extend(f"--{name}={item}" for item in value)
+        elif isinstance(value, str) or value != judger.UNLIMITED:
+            args.append(f"--{name}={value}")
+    process = subprocess.run(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=cwd)
+    if process.stderr:
+        raise JudgeClientError("Error occurred while calling judger: " + process.stderr.decode("utf-8", "replace"))
+    return json.loads(process.stdout.decode("utf-8"))
+
+
+class _ReadLimitExceeded(Exception):
+    """内置检查器读取的输出超过 MAX_READ_BYTES, 或单个 token/行超过 MAX_TOKEN_BYTES"""
+
+
+def _read_tokens(path, max_bytes=None):
+    """分块读取文件, 逐个产出空白分隔的 token
+
+    跨块的 token 追加到缓冲区, 耗时与文件大小成线性关系
+
+    :param max_bytes: 最多读取的字节数, 超过时抛出 _ReadLimitExceeded
+    """
+    with open(path, "rb") as f:
+        pending = bytearray()  # 上一块末尾还没读完的 token
+        offset = 0
+        while True:
+            chunk = f.read(COMPARE_CHUNK_SIZE)
+            if not chunk:
+                break
+            offset += len(chunk)
+            if max_bytes is not None and offset > max_bytes:
+                raise _ReadLimitExceeded()
+            start = 0
+            if pending:
+                match = WHITESPACE_RE.search(chunk)
+                start = match.start() if match else len(chunk)
+                pending += chunk[:start]
+                if len(pending) > MAX_TOKEN_BYTES:
+                    raise _ReadLimitExceeded()
+                if match is None:
+                    continue
+                yield bytes(pending)
+                pending.clear()
+            tokens = chunk[start:].split()
+            # 块末尾不是空白时最后一个 token 可能还没读完
+            if tokens and not chunk[-1:].isspace():
+                pending += tokens.pop()
+            yield from tokens
+        if pending:
+            yield bytes(pending)
+
+
+def _line_counter(path, max_bytes=None):
+    counter = collections.Counter()
+    with open(path, "rb") as f:
+        offset = 0
+        while True:
+            line = f.readline(MAX_TOKEN_BYTES + 1)
+            if not line:
+                break
+            offset += len(line)
+            if len(line) > MAX_TOKEN_BYTES or (max_bytes is not None and offset > max_bytes):
+                raise _ReadLimitExceeded()
+            line = line.rstrip()
+            if line:
+                counter[hashlib.md5(line).digest()] += 1
+    return counter
+
+
+def _float_equal(abs_eps, rel_eps):
+    def equal(user_token, ans_token):
+        if user_token == ans_token:
+            return True
+        try:
+            expected = float(ans_token)
+            actual = float(user_token)
+        except ValueError:
+            return False
+        if math.isnan(expected) or math.isnan(actual):
+            return math.isnan(expected) and math.isnan(actual)
+        if math.isinf(expected):
+            return actual == expected
+        diff = abs(actual - expected)
+        return diff <= abs_eps or diff <= rel_eps * abs(expected)
+
+    return equal
+
+
+def _check_output(checker, user_output_file, ans_file) -> int:
+    """使用内置检查器比较用户输出和答案
+
+    :param checker: {'type': CheckerType, 'abs_eps': ..., 'rel_eps': ...}
+    :return: judger.RESULT_SUCCESS 或 judger.RESULT_WRONG_ANSWER
+    """
+    try:
+        accepted = _compare_with_checker(checker, user_output_file, ans_file)
+    except _ReadLimitExceeded:
+        # 用户输出过长或包含过长的 token/行, 按答案错误处理
+        accepted = False
+    return judger.RESULT_SUCCESS if accepted else judger.RESULT_WRONG_ANSWER
+
+
+def _compare_with_checker(checker, user_output_file, ans_file) -> bool:
+    checker_type = checker["type"]
+    if checker_type == CheckerType.lines_unordered:
+        return _line_counter(user_output_file, MAX_READ_BYTES) == _line_counter(ans_file)
+    else:
+        if checker_type == CheckerType.tokens_ci:
+            equal = lambda user_token, ans_token: user_token.lower() == ans_token.lower()  # noqa: E731
+        elif checker_type == CheckerType.float:
+            equal = _float_equal(checker["abs_eps"], checker["rel_eps"])
+        else:
+            equal = bytes.__eq__
+        for user_token, ans_token in itertools.zip_longest(
+                _read_tokens(user_output_file, MAX_READ_BYTES), _read_tokens(ans_file)
+        ):
+            if user_token is None or ans_token is None or not equal(user_token, ans_token):
+                return False
+        return True
+
+
+class TestCaseFile(NamedTuple):
+    """预先解析的单个测试用例信息"""
+
+    test_case_file_id: str
+    input_path: str
+    output_path: Optional[str]
+    input_size: int
+    output_size: int
+    output_md5: Optional[str]
+    stripped_output_md5: Optional[str]
+    is_sample: bool
+
+
+def _parse_test_case_files(test_case_dir, info):
+    test_case_files = {}
+    for test_case_file_id, item in info["test_cases"].items():
+        output_name = item.get("output_name")
+        test_case_files[test_case_file_id] = TestCaseFile(
+            test_case_file_id=test_case_file_id,
+            input_path=os.path.join(test_case_dir, item["input_name"]),
+            output_path=os.path.join(test_case_dir, output_name) if output_name else None,
+            input_size=item.get("input_size", 0),
+            output_size=item.get("output_size", 0),
+            output_md5=item.get("output_md5"),
+            stripped_output_md5=item.get("stripped_output_md5"),
+            is_sample=item.get("is_sample", False),
+        )
+    return test_case_files
 
 
 class JudgeClient(object):
@@ -49,8 +245,13 @@ class JudgeClient(object):
             io_mode,
             include_sample=True,
             output=False,
+            checker=None,
+            max_failures=None,
+            language=None,
+            group=None,
     ):
         self._language_config = language_config
+        self._language = language  # 仅用于监控数据的标签
         self._exe_path = exe_path
         self._max_cpu_time = max_cpu_time
         self._max_memory = max_memory
@@ -58,13 +259,31 @@ class JudgeClient(object):
         self._test_case_dir = test_case_dir
         self._submission_dir = submission_dir
 
-        self._test_case_info = self._load_test_case_info()
+        self._test_case_info, self._test_case_files = self._load_test_case_info()
 
         self._spj_version = spj_version
         self._spj_config = spj_config
         self._output = output
         self._io_mode = io_mode
         self._include_sample = include_sample
+        # 请求中指定的检查器优先于测试用例 info 中的配置
+        self._checker = self._load_checker(checker or self._test_case_info.get("checker"))
+        # 未通过的用例数达到 max_failures 后跳过剩余用例
+        if max_failures is not None and (
+                isinstance(max_failures, bool) or not isinstance(max_failures, int) or max_failures <= 0
+        ):
+            raise JudgeClientError("max_failures must be a positive integer")
+        self._max_failures = max_failures
+        self._stopped = threading.Event()
+        # 调度器按 group 轮转, 同一批评测共用一个 group, 默认每次评测独立
+        self._group = group or submission_dir
+        # 所有用例的运行命令相同, 只查询一次 CDS 归档
+        self._command = shlex.split(self._language_config.execute_command.format(
+            exe_path=self._exe_path,
+            exe_dir=os.path.dirname(self._exe_path),
+            max_memory=int(self._max_memory / 1024),
+            cds_options=java_cds.java_options(self._language_config),
+        ))
 
         if self._spj_version and self._spj_config:
             self._spj_exe = os.path.join(
@@ -74,17 +293,67 @@ class JudgeClient(object):
             if not os.path.exists(self._spj_exe):
                 raise JudgeClientError("spj exe not found")
 
+    @property
+    def _inline_test_case(self):
+        # 内联测试用例写在本次提交的目录下, 每次都是新目录
+        return self._test_case_dir.startswith(self._submission_dir)
+
     def _load_test_case_info(self):
+        """读取测试用例 info, 同一 worker 内按 info 文件的 mtime/size/inode 缓存
+
+        :return: info 和 {test_case_file_id: TestCaseFile}
+        """
+        info_path = os.path.join(self._test_case_dir, "info")
         try:
-            with open(os.path.join(self._test_case_dir, "info")) as f:
-                return json.load(f)
+            with open(info_path) as f:
+                st = os.fstat(f.fileno())
+                stat_key = (st.st_mtime_ns, st.st_size, st.st_ino)
+                with _test_case_info_cache_lock:
+                    cached = _test_case_info_cache.get(info_path)
+                    if cached and cached[0] == stat_key:
+                        _test_case_info_cache.move_to_end(info_path)
+                        return cached[1], cached[2]
+                info = json.load(f)
+            test_case_files = _parse_test_case_files(self._test_case_dir, info)
         except IOError:
             raise JudgeClientError("Test case not found")
-        except ValueError:
+        except (ValueError, KeyError, TypeError, AttributeError):
             raise JudgeClientError("Bad test case config")
-
-    def _get_test_case_file_info(self, test_case_file_id):
-        return self._test_case_info["test_cases"][test_case_file_id]
+        if not self._inline_test_case:
+            with _test_case_info_cache_lock:
+                _test_case_info_cache[info_path] = (stat_key, info, test_case_files)
+                _test_case_info_cache.move_to_end(info_path)
+                while len(_test_case_info_cache) > TEST_CASE_INFO_CACHE_NUM:
+                    _test_case_info_cache.popitem(last=False)
+        return info, test_case_files
+
+    @staticmethod
+    def _load_checker(checker):
+        """解析内置检查器配置
+
+        :param checker: 检查器名称, 或 {'type': ..., 'eps': ..., 'abs_eps': ..., 'rel_eps': ...}
+        """
+        if not checker:
+            return None
+        if isinstance(checker, str):
+            checker = {"type": checker}
+        checker_type = checker.get("type")
+        if checker_type not in {
+            CheckerType.tokens,
+            CheckerType.tokens_ci,
+            CheckerType.float,
+            CheckerType.lines_unordered,
+        }:
+            raise JudgeClientError(f"Unsupported checker: {checker_type}")
+        eps = checker.get("eps", DEFAULT_FLOAT_EPS)
+        try:
+            return {
+                "type": checker_type,
+                "abs_eps": float(checker.get("abs_eps", eps)),
+                "rel_eps": float(checker.get("rel_eps", eps)),
+            }
+        except (TypeError, ValueError):
+            raise JudgeClientError("Bad checker eps")
 
     def _compare_output(self, test_case_file_id, user_output_file) -> Tuple[str, int]:
         """比较输出md5
@@ -93,30 +362,25 @@ class JudgeClient(object):
         :param user_output_file:
         :return: md5和答案状态
         """
-        with open(user_output_file, "rb") as f:
-            output_str = f.read(MAX_READ_BYTES)
-        stripped_output = re.sub(pattern=rb"\s", repl=b"", string=output_str)  # 去除所有空字符
+        user_output_md5, stripped_output_md5 = output_md5(user_output_file)
 
-        output_md5 = hashlib.md5(output_str.rstrip()).hexdigest()
-        stripped_output_md5 = hashlib.md5(stripped_output).hexdigest()
+        test_case_file = self._test_case_files[test_case_file_id]
 
-        test_case_file_info = self._get_test_case_file_info(test_case_file_id)
-
-        if output_md5 == test_case_file_info["output_md5"]:
-            return output_md5, judger.RESULT_SUCCESS
-        elif stripped_output_md5 == test_case_file_info["stripped_output_md5"]:
-            return output_md5, judger.RESULT_PRESENTATION_ERROR
+        if user_output_md5 == test_case_file.output_md5:
+            return user_output_md5, judger.RESULT_SUCCESS
+        elif stripped_output_md5 == test_case_file.stripped_output_md5:
+            return user_output_md5, judger.RESULT_PRESENTATION_ERROR
         else:
-            return output_md5, judger.RESULT_WRONG_ANSWER
+            return user_output_md5, judger.RESULT_WRONG_ANSWER
 
     def _spj(self, test_case_file_id, in_file_path, user_out_file_path, ans_file_path):
-        # 对于spj, 先把测试输入和测试输出拷贝到评测目录下
+        # 对于spj, 先把测试输入和测试输出放到评测目录下
         # 直接访问测试数据会因为spj用户对测试数据目录没有读权限而Permission Denied
         tmp_in_file_path = os.path.join(self._submission_dir, f"std{test_case_file_id}.in")
         tmp_ans_file_path = os.path.join(self._submission_dir, f"std{test_case_file_id}.out")
         spj_out_file_path = os.path.join(self._submission_dir, f"spj{test_case_file_id}.out")
-        shutil.copyfile(in_file_path, tmp_in_file_path)
-        shutil.copyfile(ans_file_path, tmp_ans_file_path)
+        stage_file(in_file_path, tmp_in_file_path)
+        stage_file(ans_file_path, tmp_ans_file_path)
 
         os.chown(self._submission_dir, SPJ_USER_UID, 0)
         os.chown(user_out_file_path, SPJ_USER_UID, 0)
@@ -130,7 +394,7 @@ class JudgeClient(object):
         )
         command = shlex.split(command)
         seccomp_rule_name = self._spj_config["seccomp_rule"]
-        result = judger.run(
+        result = self._run_judger(
             max_cpu_time=self._max_cpu_time * 3,
             max_real_time=self._max_cpu_time * 9,
             max_memory=self._max_memory * 3,
@@ -168,30 +432,67 @@ class JudgeClient(object):
         else:
             return SPJ_ERROR, spj_output
 
+    def _skipped_result(self, test_case_file_id):
+        return {
+            "cpu_time": 0,
+            "real_time": 0,
+            "memory": 0,
+            "signal": 0,
+            "exit_code": 0,
+            "error": 0,
+            "result": RESULT_SKIPPED,
+            "test_case": test_case_file_id,
+            "output_md5": None,
+            "output": None,
+            "is_sample": self._test_case_files[test_case_file_id].is_sample,
+        }
+
+    def _run_judger(self, cwd=None, **kwargs):
+        """调用 judger.run, 需要切换工作目录时见 _run_in_dir"""
+        if cwd is None:
+            return judger.run(**kwargs)
+        return _run_in_dir(cwd, **kwargs)
+
+    def _kill_running(self):
+        """结束本次提交正在运行的用户程序和 spj, judger 随后会正常返回
+
+        本进程启动的 libjudger.so 中, 输出文件在本次提交评测目录下的属于本次提交, 结束它们的子进程
+        """
+        prefix = "--output_path=" + os.path.join(self._submission_dir, "")
+        for process in psutil.Process().children():
+            try:
+                cmdline = process.cmdline()
+                if not cmdline or cmdline[0] != JUDGER_PATH or not any(arg.startswith(prefix) for arg in cmdline):
+                    continue
+                for child in process.children(recursive=True):
+                    child.kill()
+            except psutil.Error:
+                pass
+
     def _judge_one(self, test_case_file_id):
-        test_case_info = self._get_test_case_file_info(test_case_file_id)
-        in_file = os.path.join(self._test_case_dir, test_case_info["input_name"])
-        ans_file = os.path.join(self._test_case_dir, test_case_info["output_name"])
-        is_sample = test_case_info["is_sample"]
+        if self._stopped.is_set():
+            return self._skipped_result(test_case_file_id)
+        test_case_file = self._test_case_files[test_case_file_id]
+        in_file = test_case_file.input_path
+        ans_file = test_case_file.output_path
+        is_sample = test_case_file.is_sample
 
         if self._io_mode["io_mode"] == ProblemIOMode.file:
             user_output_dir = os.path.join(self._submission_dir, str(test_case_file_id))
             os.mkdir(user_output_dir)
             os.chown(user_output_dir, RUN_USER_UID, RUN_GROUP_GID)
             os.chmod(user_output_dir, 0o711)
-            os.chdir(user_output_dir)
             # todo check permission
             user_output_file = os.path.join(user_output_dir, self._io_mode["output"])
             real_user_output_file = os.path.join(user_output_dir, "stdio.txt")
-            shutil.copyfile(
-                in_file, os.path.join(user_output_dir, self._io_mode["input"])
-            )
+            stage_file(in_file, os.path.join(user_output_dir, self._io_mode["input"]))
             kwargs = {
                 "input_path": in_file,
                 "output_path": real_user_output_file,
                 "error_path": real_user_output_file,
             }
         else:
+            user_output_dir = None
             real_user_output_file = user_output_file = os.path.join(
                 self._submission_dir, test_case_file_id + ".out"
             )
@@ -201,35 +502,33 @@ class JudgeClient(object):
                 "error_path": real_user_output_file,
             }
 
-        command = self._language_config.execute_command.format(
-            exe_path=self._exe_path,
-            exe_dir=os.path.dirname(self._exe_path),
-            max_memory=int(self._max_memory / 1024),
-        )
-        command = shlex.split(command)
         env = ["PATH=" + os.environ.get("PATH", "")] + self._language_config.env
 
         seccomp_rule = self._language_config.seccomp_rule
 
-        run_result = judger.run(
-            max_cpu_time=self._max_cpu_time,
-            max_real_time=self._max_real_time,
-            max_memory=self._max_memory,
-            max_stack=128 * 1024 * 1024,
-            max_output_size=max(
-                test_case_info.get("output_size", 0) * 2, 1024 * 1024 * 16
-            ),
-            max_process_number=judger.UNLIMITED,
-            exe_path=command[0],
-            args=command[1::],
-            env=env,
-            log_path=JUDGER_RUN_LOG_PATH,
-            seccomp_rule_name=seccomp_rule,
-            uid=RUN_USER_UID,
-            gid=RUN_GROUP_GID,
-            memory_limit_check_only=self._language_config.memory_limit_check_only,
-            **kwargs
-        )
+        if user_output_dir:
+            kwargs["cwd"] = user_output_dir
+        with metrics.timer(Stage.run, language=self._language) as labels:
+            run_result = self._run_judger(
+                max_cpu_time=self._max_cpu_time,
+                max_real_time=self._max_real_time,
+                max_memory=self._max_memory,
+                max_stack=128 * 1024 * 1024,
+                max_output_size=max(
+                    test_case_file.output_size * 2, 1024 * 1024 * 16
+                ),
+                max_process_number=judger.UNLIMITED,
+                exe_path=self._command[0],
+                args=self._command[1::],
+                env=env,
+                log_path=JUDGER_RUN_LOG_PATH,
+                seccomp_rule_name=seccomp_rule,
+                uid=RUN_USER_UID,
+                gid=RUN_GROUP_GID,
+                memory_limit_check_only=self._language_config.memory_limit_check_only,
+                **kwargs
+            )
+            labels["verdict"] = run_result["result"]
         run_result["test_case"] = test_case_file_id
 
         # if progress exited normally, then we should check output result
@@ -237,29 +536,33 @@ class JudgeClient(object):
         run_result["output"] = None
         run_result["is_sample"] = is_sample
         if run_result["result"] == judger.RESULT_SUCCESS:
-            if not os.path.exists(user_output_file):
-                run_result["result"] = judger.RESULT_WRONG_ANSWER
-            else:
-                if self._test_case_info.get("spj"):
-                    if not self._spj_config or not self._spj_version:
-                        raise JudgeClientError("spj_config or spj_version not set")
-
-                    spj_result, spj_output = self._spj(
-                        test_case_file_id=test_case_file_id, in_file_path=in_file,
-                        user_out_file_path=user_output_file, ans_file_path=ans_file
-                    )
-                    run_result["spj_output"] = spj_output
-
-                    if spj_result == SPJ_WA:
-                        run_result["result"] = judger.RESULT_WRONG_ANSWER
-                    elif spj_result == SPJ_ERROR:
-                        run_result["result"] = judger.RESULT_SYSTEM_ERROR
-                        run_result["error"] = judger.ERROR_SPJ_ERROR
+            with metrics.timer(Stage.check, language=self._language) as labels:
+                if not os.path.exists(user_output_file):
+                    run_result["result"] = judger.RESULT_WRONG_ANSWER
+                elif self._checker:
+                    run_result["result"] = _check_output(self._checker, user_output_file, ans_file)
                 else:
-                    (
-                        run_result["output_md5"],
-                        run_result["result"],
-                    ) = self._compare_output(test_case_file_id, user_output_file)
+                    if self._test_case_info.get("spj"):
+                        if not self._spj_config or not self._spj_version:
+                            raise JudgeClientError("spj_config or spj_version not set")
+
+                        spj_result, spj_output = self._spj(
+                            test_case_file_id=test_case_file_id, in_file_path=in_file,
+                            user_out_file_path=user_output_file, ans_file_path=ans_file
+                        )
+                        run_result["spj_output"] = spj_output
+
+                        if spj_result == SPJ_WA:
+                            run_result["result"] = judger.RESULT_WRONG_ANSWER
+                        elif spj_result == SPJ_ERROR:
+                            run_result["result"] = judger.RESULT_SYSTEM_ERROR
+                            run_result["error"] = judger.ERROR_SPJ_ERROR
+                    else:
+                        (
+                            run_result["output_md5"],
+                            run_result["result"],
+                        ) = self._compare_output(test_case_file_id, user_output_file)
+                labels["verdict"] = run_result["result"]
 
         if self._output:
             try:
@@ -273,20 +576,100 @@ class JudgeClient(object):
 
         return run_result
 
-    def run(self):
-        tmp_result = []
-        result = []
-        pool = Pool(processes=psutil.cpu_count())
-        try:
-            for test_case_file_id, case_info in self._test_case_info["test_cases"].items():
-                if not self._include_sample and case_info["is_sample"]:
+    def _wait_all(self, futures, on_result=None):
+        """等待全部用例结束
+
+        设置 max_failures 时, 未通过的用例数达到上限后取消排队中的用例, 并结束正在运行的用例
+
+        :param futures: {future: test_case_file_id}
+        :param on_result: 每个用例结束时以该用例的结果调用
+        :return: 被跳过的用例对应的 future
+        """
+        failures = 0
+        pending = set(futures)
+        for item in as_completed(futures):
+            pending.discard(item)
+            if item.exception() is not None:
+                failures += 1
+            else:
+                if on_result:
+                    on_result(item.result())
+                if item.result()["result"] != judger.RESULT_SUCCESS:
+                    failures += 1
+            if self._max_failures and failures >= self._max_failures and pending:
+                break
+        else:
+            return set()
+
+        self._stopped.set()
+        for item in pending:
+            item.cancel()
+        not_done = {item for item in pending if not item.done()}
+        while not_done:
+            self._kill_running()
+            _, not_done = wait(not_done, timeout=0.1)
+        if on_result:
+            for item in pending:
+                on_result(self._skipped_result(futures[item]))
+        return pending
+
+    def _dispatch_order(self, test_case_file_ids):
+        """用例派发顺序, 耗时长的用例先运行以缩短整体评测时间
+
+        有历史运行时间时按历史运行时间降序, 否则按 info 中的输入输出大小降序
+        """
+        with _runtime_profiles_lock:
+            profile = _runtime_profiles.get(self._test_case_dir)
+            if profile is not None:
+                _runtime_profiles.move_to_end(self._test_case_dir)
+        if profile and all(test_case_file_id in profile for test_case_file_id in test_case_file_ids):
+            key = profile.get
+        else:
+            def key(test_case_file_id):
+                test_case_file = self._test_case_files[test_case_file_id]
+                return test_case_file.input_size + test_case_file.output_size
+        return sorted(test_case_file_ids, key=key, reverse=True)
+
+    def _update_runtime_profile(self, result):
+        if self._inline_test_case:
+            return
+        with _runtime_profiles_lock:
+            profile = _runtime_profiles.setdefault(self._test_case_dir, {})
+            _runtime_profiles.move_to_end(self._test_case_dir)
+            for item in result:
+                if item["result"] == RESULT_SKIPPED:
                     continue
-                tmp_result.append(pool.apply_async(_run, (self, test_case_file_id)))
-        except Exception as e:
-            raise e
-        finally:
-            pool.close()
-            pool.join()
-        for item in tmp_result:
-            result.append(item.get())
+                last = profile.get(item["test_case"])
+                real_time = item["real_time"]
+                profile[item["test_case"]] = real_time if last is None else (last + real_time) / 2
+            while len(_runtime_profiles) > RUNTIME_PROFILE_NUM:
+                _runtime_profiles.popitem(last=False)
+
+    def run(self, on_result=None):
+        """运行全部用例
+
+        :param on_result: 每个用例结束时以该用例的结果调用, 用于流式返回
+        :return: 按 info 中用例顺序排列的结果
+        """
+        test_case_file_ids = []
+        result = []
+        for test_case_file_id, test_case_file in self._test_case_files.items():
+            if not self._include_sample and test_case_file.is_sample:
+                continue
+            test_case_file_ids.append(test_case_file_id)
+        futures = {}
+        for test_case_file_id in self._dispatch_order(test_case_file_ids):
+            futures[test_case_file_id] = run_scheduler.submit(
+                self._group, self._judge_one, test_case_file_id
+            )
+        # 结果顺序与 info 中的用例顺序一致
+        tmp_result = [(test_case_file_id, futures[test_case_file_id]) for test_case_file_id in test_case_file_ids]
+        # 等待全部用例结束后再返回, 避免评测目录被提前清理
+        skipped = self._wait_all({item: test_case_file_id for test_case_file_id, item in tmp_result}, on_result)
+        for test_case_file_id, item in tmp_result:
+            if item in skipped:
+                result.append(self._skipped_result(test_case_file_id))
+            else:
+                result.append(item.result())
+        self._update_runtime_profile(result)
         return result
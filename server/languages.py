@@ -5,6 +5,7 @@ import platform
 from enum import StrEnum
 from typing import Literal, Optional, Type, TypedDict
 
+from config import GO_CACHE_DIR
 from utils import ProblemIOMode
 
 py_version = "".join(platform.python_version().split(".")[:2])
@@ -42,6 +43,8 @@ CPP_STDS = {
     "gnu++23",
 }
 
+PY_OPTIMIZE_FLAGS = {0: "", 1: "-O", 2: "-OO"}
+
 
 class SeccompRule(StrEnum):
     GENERAL = "general"
@@ -57,6 +60,7 @@ class OptionType(TypedDict, total=False):
     version: Optional[str]  # C/C++ 语言标准，如 C11, C++11 等
     enable_asan: bool  # 是否使用 Address Sanitizer (越界检查)，默认关闭
     enable_lsan: bool  # 是否使用 Leak Sanitizer (内存泄漏检查)，默认关闭
+    optimize: int  # Python 优化级别 0, 1(-O) 或 2(-OO)，默认 0
 
 
 class BaseLanguageConfig:
@@ -81,6 +85,9 @@ class BaseLanguageConfig:
         self._env: list[str] = default_env
         self.memory_limit_check_only = 0  # 是否仅检查内存限制，默认 0 否，1 是
         self.compiled = True  # 是否编译型语言
+        self.reproducible = True  # 相同源码的编译产物是否相同, 否则不使用编译缓存
+        self.src_readable = False  # 运行时是否需要读取源码
+        self.artifact_suffix = None  # 除 exe_name 外, 评测目录中以该后缀结尾的文件也是编译产物
 
         self.io_mode = io_mode
         assert self.io_mode in {ProblemIOMode.standard, ProblemIOMode.file}
@@ -131,11 +138,10 @@ class CConfig(BaseLanguageConfig):
         else:
             raise RuntimeError("compile_command validation error")
 
-        params = ["-std=" + self.std]
-        if self.enable_asan:
-            params.append("-O1 -fsanitize=address -fno-omit-frame-pointer")
-        else:
-            params.append("-O2")
+        params = ["-std=" + self.std, self.optimization]
+        if isinstance(self, CppConfig):
+            # 编译时替换为预编译头文件所在目录, 见 pch.py
+            params.append("{pch_include}")
 
         command = [
             self.compiler,
@@ -146,6 +152,12 @@ class CConfig(BaseLanguageConfig):
         command = " ".join(command)
         return command
 
+    @property
+    def optimization(self) -> str:
+        if self.enable_asan:
+            return "-O1 -fsanitize=address -fno-omit-frame-pointer"
+        return "-O2"
+
     @property
     def seccomp_rule(self) -> str:
         if self.enable_asan:
@@ -187,14 +199,16 @@ class JavaConfig(BaseLanguageConfig):
         super().__init__(options, io_mode)
         self.src_name = "Main.java"
         self.exe_name = "Main"
+        self.artifact_suffix = ".class"
         self.max_cpu_time = 5000
         self.max_real_time = 10000
         self.max_memory = -1  # 不限制
         self.memory_limit_check_only = 1
         self._seccomp_rule = None
-        self._compile_command = "/usr/bin/javac {src_path} -d {exe_dir}"
+        # {cds_options} 替换为 AppCDS 归档参数, 见 toolchain_cache.py
+        self._compile_command = "/usr/bin/javac {cds_options} {src_path} -d {exe_dir}"
         self._execute_command = (
-            "/usr/bin/java -cp {exe_dir} -XX:MaxRAM={max_memory}k Main"
+            "/usr/bin/java {cds_options} -cp {exe_dir} -XX:MaxRAM={max_memory}k Main"
         )
 
 
@@ -206,16 +220,27 @@ class Py3Config(BaseLanguageConfig):
     ):
         super().__init__(options, io_mode)
         self.src_name = "main.py"
-        self.exe_name = "main.py"
+        self.exe_name = "main.pyc"
         self.max_cpu_time = 3000
         self.max_real_time = 10000
         self.max_memory = 128 * 1024 * 1024
-        self._compile_command = "/usr/bin/python3 -m py_compile {src_path}"
+        self.optimize = int(self.options.get("optimize") or 0)
+        assert self.optimize in PY_OPTIMIZE_FLAGS, f"Unsupported Python optimize level: {self.optimize}"
+        optimize = PY_OPTIMIZE_FLAGS[self.optimize]
+        # 编译一次, 每个用例直接运行 .pyc, 不再重新编译源码. 编译失败时 py_compile 输出错误信息, 退出码为 1
+        self._compile_command = (
+            f"/usr/bin/python3 {optimize} -c "
+            "\"import py_compile, sys; sys.exit(py_compile.compile(sys.argv[1], cfile=sys.argv[2]) is None)\" "
+            "{src_path} {exe_path}"
+        )
         self._execute_command = (
-            "/usr/bin/python3 -BS {exe_path}"  # -B: 不生成 .pyc 文件, -S: 不导入 site 模块
+            f"/usr/bin/python3 -BS {optimize} {{exe_path}}"  # -B: 不生成 .pyc 文件, -S: 不导入 site 模块
         )
         self._env = default_env
         self.compiled = True
+        # .pyc 中记录了源码的绝对路径, 运行时错误的 traceback 从该路径读取源码
+        self.reproducible = False
+        self.src_readable = True
 
 
 class GoConfig(BaseLanguageConfig):
@@ -235,7 +260,7 @@ class GoConfig(BaseLanguageConfig):
         self._seccomp_rule = "golang"
         self._env = default_env + [
             "GOMAXPROCS=1",
-            "GOCACHE=/tmp",
+            "GOCACHE=" + GO_CACHE_DIR,  # 只有编译用户可以读写, 见 toolchain_cache.py
             "GOPATH=/tmp/go",
         ]
 
@@ -0,0 +1,164 @@
+import contextlib
+import json
+import os
+import threading
+import time
+
+from config import METRICS_DIR, METRICS_FLUSH_INTERVAL
+from utils import logger
+
+# 秒
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class Stage:
+    parse = "parse"  # 解析请求
+    init_env = "init_env"  # 创建评测目录
+    write_test_case = "write_test_case"  # 写入内联测试用例
+    compile_queue = "compile_queue"  # 等待编译槽位和内存预算
+    compile = "compile"
+    run = "run"  # 单个用例 judger.run
+    check = "check"  # 单个用例 _compare_output / _spj / 内置检查器
+    cleanup = "cleanup"  # 清理评测目录
+    serialize = "serialize"  # 序列化响应
+
+
+class Metrics(object):
+    """评测各阶段耗时直方图和计数
+
+    每个 gunicorn worker 定期把自己的数据写入 METRICS_DIR/<pid>.json, 渲染时合并所有存活 worker 的数据.
+    """
+
+    def __init__(self, metrics_dir=METRICS_DIR, flush_interval=METRICS_FLUSH_INTERVAL):
+        self._metrics_dir = metrics_dir
+        self._flush_interval = flush_interval
+        self._lock = threading.Lock()
+        # (stage, language, verdict) -> [各 bucket 计数..., +Inf 计数, 总耗时]
+        self._histograms = {}
+        self._collectors = []
+        self._started = False
+
+    def register(self, collector):
+        """注册采集函数, 返回 [(name, type, labels, value)], type 为 counter 或 gauge"""
+        self._collectors.append(collector)
+
+    def observe(self, stage, seconds, language=None, verdict=None):
+        key = (stage, language or "", "" if verdict is None else str(verdict))
+        with self._lock:
+            if not self._started:
+                self._start()
+            values = self._histograms.get(key)
+            if values is None:
+                values = self._histograms[key] = [0] * (len(BUCKETS) + 1) + [0.0]
+            for index, bound in enumerate(BUCKETS):
+                if seconds <= bound:
+                    values[index] += 1
+            values[len(BUCKETS)] += 1
+            values[-1] += seconds
+
+    @contextlib.contextmanager
+    def timer(self, stage, language=None, verdict=None):
+        """统计代码块耗时, 可以在代码块内修改返回的 labels["verdict"], 抛出异常时 verdict 为异常类名"""
+        labels = {"verdict": verdict}
+        start = time.monotonic()
+        try:
+            yield labels
+        except Exception as e:
+            labels["verdict"] = e.__class__.__name__
+            raise
+        finally:
+            self.observe(stage, time.monotonic() - start, language=language, verdict=labels["verdict"])
+
+    def _start(self):
+        # 调用方需持有 self._lock
+        os.makedirs(self._metrics_dir, exist_ok=True)
+        threading.Thread(target=self._flush_loop, daemon=True).start()
+        self._started = True
+
+    def _snapshot(self):
+        with self._lock:
+            histograms = [[list(key), list(values)] for key, values in self._histograms.items()]
+        samples = []
+        for collector in self._collectors:
+            try:
+                samples.extend(collector())
+            except Exception as e:
+                logger.exception(e)
+        return {"histograms": histograms, "samples": samples}
+
+    def _flush(self):
+        path = os.path.join(self._metrics_dir, f"{os.getpid()}.json")
+        with open(path + ".tmp", "w") as f:
+            json.dump(self._snapshot(), f)
+        os.replace(path + ".tmp", path)
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(self._flush_interval)
+            try:
+                self._flush()
+            except Exception as e:
+                logger.exception(e)
+
+    def _load_snapshots(self):
+        snapshots = [self._snapshot()]
+        try:
+            names = os.listdir(self._metrics_dir)
+        except FileNotFoundError:
+            return snapshots
+        for name in names:
+            if not name.endswith(".json") or name == f"{os.getpid()}.json":
+                continue
+            path = os.path.join(self._metrics_dir, name)
+            try:
+                os.kill(int(name[:-len(".json")]), 0)
+            except ProcessLookupError:
+                # worker 已退出
+                os.remove(path)
+                continue
+            except (ValueError, PermissionError):
+                continue
+            try:
+                with open(path) as f:
+                    snapshots.append(json.load(f))
+            except (OSError, ValueError):
+                pass
+        return snapshots
+
+    def render(self):
+        """Prometheus 文本格式"""
+        histograms = {}
+        samples = {}
+        types = {}
+        for snapshot in self._load_snapshots():
+            for key, values in snapshot["histograms"]:
+                merged = histograms.setdefault(tuple(key), [0] * len(values))
+                for index, value in enumerate(values):
+                    merged[index] += value
+            for name, metric_type, labels, value in snapshot["samples"]:
+                types[name] = metric_type
+                label_key = (name, tuple(sorted(labels.items())))
+                samples[label_key] = samples.get(label_key, 0) + value
+
+        lines = [
+            "# HELP judge_stage_duration_seconds Time spent in each judge stage",
+            "# TYPE judge_stage_duration_seconds histogram",
+        ]
+        for (stage, language, verdict), values in sorted(histograms.items()):
+            labels = f'stage="{stage}",language="{language}",verdict="{verdict}"'
+            for bound, count in zip(BUCKETS, values):
+                lines.append(f'judge_stage_duration_seconds_bucket{{{labels},le="{bound}"}} {count}')
+            lines.append(f'judge_stage_duration_seconds_bucket{{{labels},le="+Inf"}} {values[len(BUCKETS)]}')
+            lines.append(f"judge_stage_duration_seconds_count{{{labels}}} {values[len(BUCKETS)]}")
+            lines.append(f"judge_stage_duration_seconds_sum{{{labels}}} {values[-1]}")
+        last_name = None
+        for (name, labels), value in sorted(samples.items()):
+            if name != last_name:
+                lines.append(f"# TYPE {name} {types[name]}")
+                last_name = name
+            label_str = ",".join(f'{key}="{label_value}"' for key, label_value in labels)
+            lines.append(f"{name}{{{label_str}}} {value}" if label_str else f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
@@ -0,0 +1,64 @@
+import hashlib
+import os
+
+from config import MAX_READ_BYTES
+
+HASH_CHUNK_SIZE = 1024 * 1024
+WHITESPACE = b" \t\n\r\x0b\x0c"  # 与 rb"\s" 和 bytes.rstrip() 一致
+
+
+class OutputHasher(object):
+    """按顺序接收文件内容, 增量计算 rstrip 后的 md5 和去除所有空白字符后的 md5
+
+    末尾的空白字符暂不计入, 之后出现非空白字符时再从文件中补读, 内存占用与文件大小无关.
+    f 为正在读取或写入的文件, 补读前先 flush.
+    """
+
+    def __init__(self, f):
+        self._f = f
+        self._output_md5 = hashlib.md5()
+        self._stripped_output_md5 = hashlib.md5()
+        self._offset = 0  # 已接收的字节数
+        self._hashed = 0  # [0, hashed) 已计入 output_md5
+
+    def update(self, chunk):
+        offset = self._offset
+        self._offset += len(chunk)
+        stripped_chunk = chunk.translate(None, WHITESPACE)
+        self._stripped_output_md5.update(stripped_chunk)
+        if not stripped_chunk:
+            return
+        if self._hashed < offset:
+            self._f.flush()
+        while self._hashed < offset:
+            pending = os.pread(self._f.fileno(), min(HASH_CHUNK_SIZE, offset - self._hashed), self._hashed)
+            self._output_md5.update(pending)
+            self._hashed += len(pending)
+        end = len(chunk.rstrip())
+        self._output_md5.update(memoryview(chunk)[:end])
+        self._hashed = offset + end
+
+    @property
+    def output_md5(self):
+        return self._output_md5.hexdigest()
+
+    @property
+    def stripped_output_md5(self):
+        return self._stripped_output_md5.hexdigest()
+
+
+def output_md5(path, max_bytes=MAX_READ_BYTES):
+    """分块读取文件的前 max_bytes 字节
+
+    :return: (rstrip 后的 md5, 去除所有空白字符后的 md5)
+    """
+    with open(path, "rb", buffering=0) as f:
+        hasher = OutputHasher(f)
+        offset = 0
+        while offset < max_bytes:
+            chunk = f.read(min(HASH_CHUNK_SIZE, max_bytes - offset))
+            if not chunk:
+                break
+            hasher.update(chunk)
+            offset += len(chunk)
+    return hasher.output_md5, hasher.stripped_output_md5
@@ -0,0 +1,237 @@
+import collections
+import ctypes
+import fcntl
+import json
+import mmap
+import os
+import threading
+import time
+
+from config import PAGE_CACHE_HOT_NUM, PAGE_CACHE_LOCK_PATH, PAGE_CACHE_MLOCK_BUDGET, PAGE_CACHE_WARM_INTERVAL
+from utils import logger
+
+_libc = ctypes.CDLL(None, use_errno=True)
+_libc.mmap.restype = ctypes.c_void_p
+_libc.mmap.argtypes = [ctypes.c_void_p, ctypes.c_size_t, ctypes.c_int, ctypes.c_int, ctypes.c_int, ctypes.c_long]
+_libc.munmap.argtypes = [ctypes.c_void_p, ctypes.c_size_t]
+_libc.mincore.argtypes = [ctypes.c_void_p, ctypes.c_size_t, ctypes.POINTER(ctypes.c_ubyte)]
+_libc.mlock.argtypes = [ctypes.c_void_p, ctypes.c_size_t]
+MAP_FAILED = ctypes.c_void_p(-1).value
+# Linux 5.14+, 预读映射的全部页面后返回, 旧内核返回 EINVAL
+MADV_POPULATE_READ = getattr(mmap, "MADV_POPULATE_READ", 22)
+TOUCH_CHUNK_SIZE = 1024 * 1024
+
+
+def _mmap(path):
+    """只读映射整个文件, 返回 (地址, 大小), 空文件返回 None"""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        size = os.fstat(fd).st_size
+        if not size:
+            return None
+        addr = _libc.mmap(None, size, mmap.PROT_READ, mmap.MAP_SHARED, fd, 0)
+        if addr == MAP_FAILED:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno), path)
+        return addr, size
+    finally:
+        os.close(fd)
+
+
+def _resident_size(path):
+    """文件在页缓存中的字节数(按页计算, 不超过文件大小)"""
+    mapped = _mmap(path)
+    if mapped is None:
+        return 0
+    addr, size = mapped
+    try:
+        vec = (ctypes.c_ubyte * ((size + mmap.PAGESIZE - 1) // mmap.PAGESIZE))()
+        if _libc.mincore(addr, size, vec) != 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno), path)
+        return min(sum(page & 1 for page in vec) * mmap.PAGESIZE, size)
+    finally:
+        _libc.munmap(addr, size)
+
+
+def _populate(f, size):
+    """把文件全部读入页缓存, 返回前读取完成"""
+    with mmap.mmap(f.fileno(), size, prot=mmap.PROT_READ) as mm:
+        try:
+            mm.madvise(MADV_POPULATE_READ)
+            return
+        except OSError:
+            pass
+    buf = bytearray(TOUCH_CHUNK_SIZE)
+    while f.readinto(buf):
+        pass
+
+
+def _test_case_paths(test_case_dir):
+    """info 中列出的输入和输出文件"""
+    with open(os.path.join(test_case_dir, "info")) as f:
+        info = json.load(f)
+    paths = []
+    for item in info["test_cases"].values():
+        paths.append(os.path.join(test_case_dir, item["input_name"]))
+        if item.get("output_name"):
+            paths.append(os.path.join(test_case_dir, item["output_name"]))
+    return paths
+
+
+class PageCacheWarmer(object):
+    """预热评测最频繁的测试用例的页缓存
+
+    每个 worker 统计自己评测的 test_case_id, 计数每个周期减半. 拿到 PAGE_CACHE_LOCK_PATH 锁的 worker 负责预热,
+    各 worker 的请求是均匀分配的, 只用它自己的统计结果.
+    预热时对 info 中列出的文件 posix_fadvise(WILLNEED) 并 madvise(MADV_POPULATE_READ) 读入页缓存,
+    mlock_budget 大于 0 时按热度依次 mlock, 总大小不超过 mlock_budget.
+    """
+
+    def __init__(
+            self,
+            lock_path=PAGE_CACHE_LOCK_PATH,
+            interval=PAGE_CACHE_WARM_INTERVAL,
+            hot_num=PAGE_CACHE_HOT_NUM,
+            mlock_budget=PAGE_CACHE_MLOCK_BUDGET,
+    ):
+        self._lock_path = lock_path
+        self._interval = interval
+        self._hot_num = hot_num
+        self._mlock_budget = mlock_budget
+        self._lock = threading.Lock()
+        self._counts = collections.Counter()  # test_case_dir -> 最近的评测次数
+        self._names = {}  # test_case_dir -> test_case_id
+        self._started = False
+        self._leader = False
+        self._pinned = {}  # path -> (地址, 大小), 由预热线程修改, 读写都持有 _lock
+        self._report = []
+
+    def record(self, test_case_id, test_case_dir):
+        """记录一次评测"""
+        if self._hot_num <= 0:
+            return
+        with self._lock:
+            if not self._started:
+                threading.Thread(target=self._run, daemon=True).start()
+                self._started = True
+            self._counts[test_case_dir] += 1
+            self._names[test_case_dir] = test_case_id
+
+    def hot(self):
+        """本 worker 最近评测最频繁的 [(test_case_id, test_case_dir)]"""
+        with self._lock:
+            return [(self._names[path], path) for path, _ in self._counts.most_common(self._hot_num)]
+
+    def warm(self, test_case_id, test_case_dir, touch=True):
+        """预读测试用例文件
+
+        :param touch: 返回前文件已全部读入页缓存, 否则只提示内核异步预读
+        :return: 预热后的覆盖率
+        """
+        paths = _test_case_paths(test_case_dir)
+        size = 0
+        resident = 0
+        for path in paths:
+            with open(path, "rb") as f:
+                file_size = os.fstat(f.fileno()).st_size
+                os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_WILLNEED)
+                if touch and file_size:
+                    _populate(f, file_size)
+            size += file_size
+            resident += _resident_size(path)
+        with self._lock:
+            pinned = sum(self._pinned[path][1] for path in paths if path in self._pinned)
+        return {
+            "test_case_id": test_case_id,
+            "files": len(paths),
+            "size": size,
+            "resident": resident,
+            "pinned": pinned,
+        }
+
+    def _pin(self, hot):
+        """按热度 mlock 文件, 不再需要的文件解除锁定"""
+        wanted = []
+        budget = self._mlock_budget
+        for _, test_case_dir in hot:
+            try:
+                paths = _test_case_paths(test_case_dir)
+            except (OSError, ValueError, KeyError):
+                continue
+            for path in paths:
+                try:
+                    size = os.path.getsize(path)
+                except OSError:
+                    continue
+                if size > budget:
+                    break
+                budget -= size
+                wanted.append(path)
+        # 只有预热线程修改 _pinned, mmap/mlock 不持有锁
+        with self._lock:
+            unpinned = [self._pinned.pop(path) for path in set(self._pinned) - set(wanted)]
+            pinned = set(self._pinned)
+        for mapped in unpinned:
+            _libc.munmap(*mapped)
+        for path in wanted:
+            if path in pinned:
+                continue
+            mapped = _mmap(path)
+            if mapped is None:
+                continue
+            if _libc.mlock(*mapped) != 0:
+                logger.warning(f"Failed to mlock {path}: {os.strerror(ctypes.get_errno())}")
+                _libc.munmap(*mapped)
+                break
+            with self._lock:
+                self._pinned[path] = mapped
+
+    def _warm_hot(self):
+        hot = self.hot()
+        if self._mlock_budget > 0:
+            self._pin(hot)
+        report = []
+        for test_case_id, test_case_dir in hot:
+            try:
+                report.append(self.warm(test_case_id, test_case_dir))
+            except (OSError, ValueError, KeyError) as e:
+                # 测试用例可能已被删除或淘汰
+                logger.debug(f"Failed to warm {test_case_dir}: {e}")
+        with self._lock:
+            self._report = report
+
+    def _run(self):
+        lock_fd = os.open(self._lock_path, os.O_RDWR | os.O_CREAT, 0o600)
+        while True:
+            time.sleep(self._interval)
+            try:
+                if not self._leader:
+                    try:
+                        # 拿到锁后一直持有, worker 退出时由其他 worker 接替
+                        fcntl.flock(lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                        self._leader = True
+                    except BlockingIOError:
+                        pass
+                if self._leader:
+                    self._warm_hot()
+            except Exception as e:
+                logger.exception(e)
+            with self._lock:
+                for path in list(self._counts):
+                    self._counts[path] //= 2
+                    if not self._counts[path]:
+                        del self._counts[path]
+                        del self._names[path]
+
+    def stats(self):
+        """负责预热的 worker 最近一次预热后的覆盖率"""
+        with self._lock:
+            return {
+                "leader": self._leader,
+                "pinned": sum(size for _, size in self._pinned.values()),
+                "hot": self._report,
+            }
+
+
+page_cache = PageCacheWarmer()
@@ -0,0 +1,175 @@
+import fcntl
+import os
+import re
+import shlex
+import shutil
+import subprocess
+import threading
+import time
+import uuid
+
+from config import PCH_BUILD_TIMEOUT, PCH_CHECK_INTERVAL, PCH_DIR, PCH_ENABLED, PCH_PREBUILD
+from languages import CPP_STDS, CppConfig
+from reaper import reaper
+from utils import logger
+
+HEADER = "bits/stdc++.h"
+STAMP_NAME = "stamp"
+# g++ 只在头文件之前没有其他代码时使用预编译头文件, 这里只检查它是否是第一个 #include
+FIRST_INCLUDE = re.compile(r"^\s*#\s*include\s*[<\"]([^>\"]+)[>\"]", re.MULTILINE)
+# 只在源码的开头查找第一个 #include
+INCLUDE_SCAN_SIZE = 64 * 1024
+
+
+class PrecompiledHeaders(object):
+    """C++ 的预编译头文件
+
+    每个 语言标准 + O2/asan 组合对应 pch_dir 下的一个目录, 包含 bits/stdc++.h.gch 和生成时的编译器版本.
+    编译时把该目录加入 include 路径, g++ 在该目录下找到可用的 .gch 时直接使用, 否则继续按原路径查找头文件.
+    目录不存在或编译器已更新时本次按普通编译处理并计为未命中, 同时在后台重新生成.
+    是否可用的检查结果每个 worker 缓存 check_interval 秒.
+    """
+
+    def __init__(self, pch_dir=PCH_DIR, enabled=PCH_ENABLED, check_interval=PCH_CHECK_INTERVAL):
+        self._pch_dir = pch_dir
+        self._enabled = enabled
+        self._check_interval = check_interval
+        self._lock = threading.Lock()
+        self._building = set()
+        self._checked = {}  # name -> (是否可用, 检查时间)
+        self.hits = 0
+        self.misses = 0
+        self.builds = 0
+
+    @staticmethod
+    def _name(language_config: CppConfig):
+        return f"{language_config.std}-{'asan' if language_config.enable_asan else 'O2'}"
+
+    @staticmethod
+    def _stamp(language_config: CppConfig):
+        """编译器和编译选项, 任一变化时预编译头文件失效"""
+        compiler = os.path.realpath(language_config.compiler)
+        st = os.stat(compiler)
+        return f"{compiler} {st.st_size} {st.st_mtime_ns} -std={language_config.std} {language_config.optimization}"
+
+    def _count(self, hit):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def _valid(self, language_config: CppConfig):
+        path = os.path.join(self._pch_dir, self._name(language_config))
+        try:
+            with open(os.path.join(path, STAMP_NAME)) as f:
+                return f.read() == self._stamp(language_config)
+        except FileNotFoundError:
+            return False
+
+    def _valid_cached(self, language_config: CppConfig):
+        name = self._name(language_config)
+        with self._lock:
+            checked = self._checked.get(name)
+        if checked and time.monotonic() - checked[1] < self._check_interval:
+            return checked[0]
+        valid = self._valid(language_config)
+        with self._lock:
+            self._checked[name] = (valid, time.monotonic())
+        return valid
+
+    def _build(self, language_config: CppConfig):
+        name = self._name(language_config)
+        os.makedirs(self._pch_dir, mode=0o755, exist_ok=True)
+        lock_fd = os.open(os.path.join(self._pch_dir, f".lock-{name}"), os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            try:
+                fcntl.flock(lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                # 其他 worker 正在生成
+                return
+            if self._valid(language_config):
+                return
+            tmp_dir = os.path.join(self._pch_dir, ".tmp-" + uuid.uuid4().hex)
+            try:
+                os.makedirs(os.path.join(tmp_dir, os.path.dirname(HEADER)))
+                src_path = os.path.join(tmp_dir, "pch.h")
+                with open(src_path, "w") as f:
+                    f.write(f"#include <{HEADER}>\n")
+                # 除 -fmax-errors 和链接选项外与 CConfig.compile_command 一致
+                command = [
+                    language_config.compiler, "-DONLINE_JUDGE", "-w", "-std=" + language_config.std,
+                    *shlex.split(language_config.optimization),
+                    "-x", "c++-header", src_path, "-o", os.path.join(tmp_dir, HEADER + ".gch"),
+                ]
+                subprocess.run(command, check=True, capture_output=True, timeout=PCH_BUILD_TIMEOUT)
+                os.remove(src_path)
+                with open(os.path.join(tmp_dir, STAMP_NAME), "w") as f:
+                    f.write(self._stamp(language_config))
+                for root, dirs, files in os.walk(tmp_dir):
+                    os.chmod(root, 0o755)
+                    for file in files:
+                        os.chmod(os.path.join(root, file), 0o644)
+                path = os.path.join(self._pch_dir, name)
+                if os.path.exists(path):
+                    reaper.discard(path)
+                os.rename(tmp_dir, path)
+            except (OSError, subprocess.SubprocessError) as e:
+                logger.warning(f"Failed to build precompiled header {name}: {e}")
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+                return
+            with self._lock:
+                self.builds += 1
+                self._checked.pop(name, None)
+        finally:
+            os.close(lock_fd)
+
+    def _build_async(self, language_config: CppConfig):
+        name = self._name(language_config)
+        with self._lock:
+            if name in self._building:
+                return
+            self._building.add(name)
+
+        def build():
+            try:
+                self._build(language_config)
+            finally:
+                with self._lock:
+                    self._building.discard(name)
+
+        threading.Thread(target=build, daemon=True).start()
+
+    def include(self, language_config, src_path):
+        """返回替换 compile_command 中 {pch_include} 的参数, 不使用预编译头文件时为空"""
+        if not self._enabled or not isinstance(language_config, CppConfig):
+            return ""
+        with open(src_path, encoding="utf-8", errors="replace") as f:
+            match = FIRST_INCLUDE.search(f.read(INCLUDE_SCAN_SIZE))
+        if not match or match.group(1) != HEADER:
+            return ""
+        if not self._valid_cached(language_config):
+            self._count(hit=False)
+            self._build_async(language_config)
+            return ""
+        self._count(hit=True)
+        return "-I" + os.path.join(self._pch_dir, self._name(language_config))
+
+    def prebuild(self, stds=PCH_PREBUILD):
+        """在后台生成常用语言标准的预编译头文件"""
+        if not self._enabled:
+            return
+        for std in stds:
+            if std not in CPP_STDS:
+                logger.warning(f"Unsupported C++ standard for precompiled header: {std}")
+                continue
+            language_config = CppConfig({"version": std})
+            if not self._valid(language_config):
+                self._build_async(language_config)
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "builds": self.builds}
+
+
+precompiled_headers = PrecompiledHeaders()
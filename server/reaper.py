@@ -0,0 +1,126 @@
+import fcntl
+import os
+import shutil
+import threading
+import time
+import uuid
+
+from config import JUDGER_TRASH_DIR, JUDGER_WORKSPACE_BASE, REAPER_MAX_UNLINK_RATE, REAPER_URGENT_DISK_USAGE
+from utils import logger
+
+
+class Reaper(object):
+    """后台回收评测目录
+
+    评测结束后目录直接 rename 到回收目录, 请求无需等待删除.
+    后台线程限速删除回收目录中的文件, 磁盘使用率过高时不限速. 同一时间只有一个 worker 在删除.
+    """
+
+    def __init__(
+            self,
+            trash_dir=JUDGER_TRASH_DIR,
+            max_unlink_rate=REAPER_MAX_UNLINK_RATE,
+            urgent_disk_usage=REAPER_URGENT_DISK_USAGE,
+    ):
+        self._trash_dir = trash_dir
+        self._max_unlink_rate = max_unlink_rate
+        self._urgent_disk_usage = urgent_disk_usage
+        self._wakeup = threading.Event()
+        self._lock = threading.Lock()
+        self._started = False
+        self._unlinked = 0
+        self._window_start = time.monotonic()
+
+    def start(self):
+        """启动后台删除线程, 启动后会先清理回收目录中的遗留文件"""
+        with self._lock:
+            if self._started:
+                return
+            os.makedirs(self._trash_dir, exist_ok=True)
+            threading.Thread(target=self._run, daemon=True).start()
+            self._started = True
+
+    def discard(self, path):
+        """把目录移入回收目录, 移动失败时直接删除"""
+        self.start()
+        try:
+            os.rename(path, os.path.join(self._trash_dir, f"{os.path.basename(path)}-{uuid.uuid4().hex}"))
+        except OSError as e:
+            logger.warning(f"Failed to move {path} to trash: {e}")
+            shutil.rmtree(path)
+            return
+        self._wakeup.set()
+
+    def recover(self, workspace=JUDGER_WORKSPACE_BASE):
+        """启动时把上次遗留的评测目录移入回收目录, 需在 worker 启动前调用"""
+        os.makedirs(self._trash_dir, exist_ok=True)
+        for name in os.listdir(workspace):
+            path = os.path.join(workspace, name)
+            try:
+                os.rename(path, os.path.join(self._trash_dir, f"{name}-{uuid.uuid4().hex}"))
+            except OSError:
+                # 评测目录挂载为 tmpfs 时无法 rename 到回收目录
+                shutil.rmtree(path, ignore_errors=True)
+
+    def _throttle(self):
+        self._unlinked += 1
+        if self._unlinked < 100:
+            return
+        usage = shutil.disk_usage(self._trash_dir)
+        if usage.used / usage.total < self._urgent_disk_usage:
+            expected = self._unlinked / self._max_unlink_rate
+            elapsed = time.monotonic() - self._window_start
+            if elapsed < expected:
+                time.sleep(expected - elapsed)
+        self._unlinked = 0
+        self._window_start = time.monotonic()
+
+    def _remove_tree(self, path):
+        if os.path.islink(path) or not os.path.isdir(path):
+            os.unlink(path)
+            return
+        for root, dirs, files in os.walk(path, topdown=False):
+            for name in files:
+                os.unlink(os.path.join(root, name))
+                self._throttle()
+            for name in dirs:
+                dir_path = os.path.join(root, name)
+                if os.path.islink(dir_path):
+                    os.unlink(dir_path)
+                else:
+                    os.rmdir(dir_path)
+                self._throttle()
+        os.rmdir(path)
+
+    def _sweep(self):
+        for name in os.listdir(self._trash_dir):
+            if name.startswith("."):
+                continue
+            try:
+                self._remove_tree(os.path.join(self._trash_dir, name))
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                logger.exception(e)
+
+    def _run(self):
+        lock_fd = os.open(os.path.join(self._trash_dir, ".lock"), os.O_RDWR | os.O_CREAT, 0o600)
+        while True:
+            fcntl.flock(lock_fd, fcntl.LOCK_EX)
+            try:
+                self._wakeup.clear()
+                self._sweep()
+            except Exception as e:
+                logger.exception(e)
+            finally:
+                fcntl.flock(lock_fd, fcntl.LOCK_UN)
+            self._wakeup.wait(timeout=60)
+
+    def stats(self):
+        try:
+            return {"pending": len([name for name in os.listdir(self._trash_dir) if not name.startswith(".")])}
+        except FileNotFoundError:
+            return {"pending": 0}
+
+
+reaper = Reaper()
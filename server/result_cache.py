@@ -0,0 +1,191 @@
+import fcntl
+import hashlib
+import json
+import os
+import threading
+import uuid
+
+import judger
+
+from config import RESULT_CACHE_DIR, RESULT_CACHE_EVICT_INTERVAL, RESULT_CACHE_LIMIT_MARGIN, RESULT_CACHE_MAX_SIZE
+from judge_client import RESULT_SKIPPED
+from utils import logger
+
+# 与限制无关的结果才能缓存
+CACHEABLE_RESULTS = {
+    judger.RESULT_SUCCESS,
+    judger.RESULT_WRONG_ANSWER,
+    judger.RESULT_PRESENTATION_ERROR,
+    RESULT_SKIPPED,
+}
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def _file_sha256(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(HASH_CHUNK_SIZE)
+            if not chunk:
+                break
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def hash_artifacts(submission_dir, names, suffix=None):
+    """评测目录中编译产物的 sha256, 只读取 names 中的文件和文件名以 suffix 结尾的文件, 不遍历子目录
+
+    :param names: 编译产物或源码的文件名, 不存在的文件不计入
+    :param suffix: 文件名不固定的编译产物, 如 Java 的 .class
+    :return: 一个文件都没有时返回 None
+    """
+    names = set(names)
+    if suffix:
+        with os.scandir(submission_dir) as it:
+            names.update(entry.name for entry in it if entry.name.endswith(suffix) and entry.is_file())
+    h = hashlib.sha256()
+    found = False
+    for name in sorted(names):
+        path = os.path.join(submission_dir, name)
+        if os.path.isfile(path):
+            h.update(f"{name} {_file_sha256(path)}\n".encode("utf-8"))
+            found = True
+    return h.hexdigest() if found else None
+
+
+def hash_test_case(test_case_dir):
+    """测试用例目录的指纹: info 的 sha256 加上每个文件的大小, mtime 和 inode
+
+    info 中只有输出的 md5 和大小, 输入被原地修改或替换时靠 stat 发现, 不读取输入内容.
+    评测时输入可能被硬链接到评测目录, ctime 会变化, 不计入
+    """
+    h = hashlib.sha256(_file_sha256(os.path.join(test_case_dir, "info")).encode("utf-8"))
+    with os.scandir(test_case_dir) as it:
+        files = sorted(
+            (entry.name, entry.stat(follow_symlinks=False))
+            for entry in it
+            if not entry.name.startswith(".") and entry.is_file(follow_symlinks=False)
+        )
+    for name, st in files:
+        h.update(f"{name} {st.st_size} {st.st_mtime_ns} {st.st_ino}\n".encode("utf-8"))
+    return h.hexdigest()
+
+
+class ResultCache(object):
+    """评测结果缓存, 用于数据未变时的重测和大量相同的提交
+
+    每个条目是 cache_dir 下以 key 命名的 JSON 文件, 保存全部用例的结果. key 不包含时间和内存限制,
+    只缓存结果与限制无关的评测, 且用时和内存都不超过本次限制的 margin 倍时才使用, 否则重新评测并覆盖条目.
+    条目的 mtime 作为最近使用时间, 总大小超过 max_size 时淘汰最久未使用的条目.
+    """
+
+    def __init__(self, cache_dir=RESULT_CACHE_DIR, max_size=RESULT_CACHE_MAX_SIZE, margin=RESULT_CACHE_LIMIT_MARGIN):
+        self._cache_dir = cache_dir
+        self._max_size = max_size
+        self._margin = margin
+        self._lock = threading.Lock()
+        self._stored = 0
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def enabled(self):
+        return self._max_size > 0
+
+    @staticmethod
+    def make_key(**params):
+        """params 需要能序列化为 JSON"""
+        return hashlib.sha256(json.dumps(params, sort_keys=True).encode("utf-8")).hexdigest()
+
+    def _count(self, hit):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def _within_limits(self, run_result, max_cpu_time, max_real_time, max_memory):
+        for item in run_result:
+            if item["result"] == RESULT_SKIPPED:
+                continue
+            for used, limit in (
+                    (item["cpu_time"], max_cpu_time),
+                    (item["real_time"], max_real_time),
+                    (item["memory"], max_memory),
+            ):
+                if limit != judger.UNLIMITED and used > limit * self._margin:
+                    return False
+        return True
+
+    def get(self, key, max_cpu_time, max_real_time, max_memory):
+        """返回缓存的结果, 每个用例的结果带有 cached 标记, 未命中时返回 None"""
+        path = os.path.join(self._cache_dir, key)
+        try:
+            with open(path) as f:
+                run_result = json.load(f)
+            os.utime(path)
+        except (OSError, ValueError):
+            run_result = None
+        if run_result is None or not self._within_limits(run_result, max_cpu_time, max_real_time, max_memory):
+            self._count(hit=False)
+            return None
+        self._count(hit=True)
+        for item in run_result:
+            item["cached"] = True
+        return run_result
+
+    def put(self, key, run_result):
+        if any(item["result"] not in CACHEABLE_RESULTS for item in run_result):
+            return
+        os.makedirs(self._cache_dir, exist_ok=True)
+        tmp_path = os.path.join(self._cache_dir, ".tmp-" + uuid.uuid4().hex)
+        try:
+            with open(tmp_path, "w") as f:
+                json.dump(run_result, f)
+            os.rename(tmp_path, os.path.join(self._cache_dir, key))
+        except OSError as e:
+            logger.warning(f"Failed to store result cache {key}: {e}")
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return
+        with self._lock:
+            self._stored += 1
+            evict = self._stored % RESULT_CACHE_EVICT_INTERVAL == 0
+        if evict:
+            self._evict()
+
+    def _evict(self):
+        lock_fd = os.open(os.path.join(self._cache_dir, ".lock"), os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            try:
+                fcntl.flock(lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                # 其他 worker 正在淘汰
+                return
+            entries = []
+            total = 0
+            with os.scandir(self._cache_dir) as it:
+                for entry in it:
+                    if entry.name.startswith(".") or not entry.is_file():
+                        continue
+                    st = entry.stat()
+                    total += st.st_size
+                    entries.append((st.st_mtime, st.st_size, entry.path))
+            entries.sort()
+            for _, size, path in entries:
+                if total <= self._max_size:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                total -= size
+        finally:
+            os.close(lock_fd)
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses}
+
+
+result_cache = ResultCache()
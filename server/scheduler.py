@@ -0,0 +1,355 @@
+import collections
+import fcntl
+import os
+import threading
+import time
+from concurrent.futures import Future
+
+from config import (
+    COMPILE_MEMORY_BUDGET,
+    COMPILE_NICE,
+    COMPILE_POLL_INTERVAL,
+    COMPILE_SLOT_DIR,
+    COMPILE_SLOT_NUM,
+    COMPILE_UNLIMITED_MEMORY,
+    RUN_SLOT_DIR,
+    RUN_SLOT_NUM,
+    SLOT_POLL_INTERVAL,
+    SLOT_POLL_MAX_INTERVAL,
+)
+from utils import logger
+
+# 编译槽位文件中记录的内存预留大小, 定长十进制
+RESERVATION_SIZE = 20
+
+
+class HostSlots(object):
+    """全机共享的槽位, 每个槽位对应 slot_dir 下的一个文件锁
+
+    flock 属于打开的文件描述, 同一进程内的线程共用每个槽位的描述符, 由 _held 记录本进程已占用的槽位.
+    全部槽位被占用时每个进程只有一个线程轮询, 间隔按指数退避; 本进程释放槽位时直接唤醒它.
+    """
+
+    def __init__(self, slot_num, slot_dir):
+        self.slot_num = slot_num
+        self._slot_dir = slot_dir
+        self._lock = threading.Lock()
+        self._released = threading.Condition(self._lock)
+        self._waiter = threading.Lock()
+        self._fds = None
+        self._held = set()
+
+    def path(self, index):
+        return os.path.join(self._slot_dir, f"slot-{index}")
+
+    def _try_acquire(self):
+        # 调用方需持有 self._lock
+        if self._fds is None:
+            # gunicorn fork 之后才打开, 各 worker 的描述符相互独立
+            os.makedirs(self._slot_dir, exist_ok=True)
+            self._fds = [os.open(self.path(index), os.O_RDWR | os.O_CREAT, 0o600) for index in range(self.slot_num)]
+        for index in range(self.slot_num):
+            if index in self._held:
+                continue
+            try:
+                fcntl.flock(self._fds[index], fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                continue
+            self._held.add(index)
+            return index
+        return None
+
+    def try_acquire(self):
+        """占用第一个空闲的槽位, 返回槽位序号, 全部被占用时返回 None"""
+        with self._lock:
+            return self._try_acquire()
+
+    def acquire(self):
+        # 其他线程在 _waiter 上阻塞, 不发起系统调用
+        with self._waiter:
+            interval = SLOT_POLL_INTERVAL
+            while True:
+                with self._lock:
+                    index = self._try_acquire()
+                    if index is not None:
+                        return index
+                    self._released.wait(interval)
+                interval = min(interval * 2, SLOT_POLL_MAX_INTERVAL)
+
+    def fd(self, index):
+        """本进程打开的槽位文件描述符, 占用槽位期间可以在文件中记录数据"""
+        return self._fds[index]
+
+    def release(self, index):
+        with self._lock:
+            fcntl.flock(self._fds[index], fcntl.LOCK_UN)
+            self._held.discard(index)
+            self._released.notify()
+
+    def busy(self):
+        """全机被占用的槽位序号"""
+        busy = []
+        for index in range(self.slot_num):
+            try:
+                fd = os.open(self.path(index), os.O_RDONLY)
+            except FileNotFoundError:
+                continue
+            try:
+                fcntl.flock(fd, fcntl.LOCK_SH | fcntl.LOCK_NB)
+            except BlockingIOError:
+                busy.append(index)
+            finally:
+                os.close(fd)
+        return busy
+
+
+class RunScheduler(object):
+    """测试用例运行调度器
+
+    同一台机器上所有 gunicorn worker 共享 RUN_SLOT_NUM 个运行槽位(RUN_SLOT_DIR 下的文件锁),
+    进程内按提交轮询出队, 用例多的提交不会饿死用例少的提交.
+    """
+
+    def __init__(self, slot_num=RUN_SLOT_NUM, slot_dir=RUN_SLOT_DIR):
+        self._slots = HostSlots(slot_num, slot_dir)
+        self._cond = threading.Condition()
+        # group -> deque[(future, func, args)], 按插入顺序轮询
+        self._queues = collections.OrderedDict()
+        self._running = 0
+        self._started = False
+
+    def _start(self):
+        # gunicorn fork 之后才启动线程, 调用方需持有 self._cond
+        for _ in range(self._slots.slot_num):
+            thread = threading.Thread(target=self._worker, daemon=True)
+            thread.start()
+        self._started = True
+
+    def submit(self, group, func, *args) -> Future:
+        """提交一个任务
+
+        :param group: 任务所属分组(一次提交), 各分组之间公平调度
+        :param func: 在运行槽位内执行的函数
+        :return: Future
+        """
+        future = Future()
+        with self._cond:
+            if not self._started:
+                self._start()
+            self._queues.setdefault(group, collections.deque()).append((future, func, args))
+            self._cond.notify()
+        return future
+
+    def _pop_task(self):
+        # 取出队首分组的一个任务, 分组仍有任务时放到队尾, 调用方需持有 self._cond
+        while self._queues:
+            group, queue = next(iter(self._queues.items()))
+            task = queue.popleft()
+            if queue:
+                self._queues.move_to_end(group)
+            else:
+                del self._queues[group]
+            if not task[0].cancelled():
+                return task
+        return None
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                while not self._queues:
+                    self._cond.wait()
+            # 先占用全机任意一个空闲槽位再出队, 避免任务被一个正在等待槽位的线程扣住
+            slot_index = self._slots.acquire()
+            try:
+                with self._cond:
+                    task = self._pop_task()
+                    if task is None:
+                        continue
+                    self._running += 1
+                future, func, args = task
+                if future.set_running_or_notify_cancel():
+                    try:
+                        future.set_result(func(*args))
+                    except BaseException as e:
+                        future.set_exception(e)
+                with self._cond:
+                    self._running -= 1
+            finally:
+                self._slots.release(slot_index)
+
+    def stats(self):
+        """槽位使用情况, 用于评估节点规模"""
+        with self._cond:
+            running = self._running
+            queued = sum(len(queue) for queue in self._queues.values())
+            groups = len(self._queues)
+        return {
+            "slots": self._slots.slot_num,
+            "busy_slots": len(self._slots.busy()),
+            "running": running,
+            "queued": queued,
+            "queued_submissions": groups,
+        }
+
+
+class CompileScheduler(object):
+    """编译调度器
+
+    编译是评测中独立的一个阶段: 同一台机器上所有 gunicorn worker 共享 COMPILE_SLOT_NUM 个编译槽位
+    (COMPILE_SLOT_DIR 下的文件锁), 编译完成后再把用例交给 RunScheduler. 进程内按提交顺序出队.
+    占用槽位的任务把语言的编译内存上限写入槽位文件, 全机预留之和超过 memory_budget 时等待, 单个任务超过预算时按整个预算计算.
+    检查预算和占用槽位在 .budget 锁内一起完成, 等待期间不占用槽位, 任务在等待期间被取消时直接丢弃.
+    编译线程以 nice 运行, 编译器进程继承该优先级, 编译高峰不会抢走运行用例的 CPU.
+    """
+
+    def __init__(
+            self,
+            slot_num=COMPILE_SLOT_NUM,
+            slot_dir=COMPILE_SLOT_DIR,
+            memory_budget=COMPILE_MEMORY_BUDGET,
+            nice=COMPILE_NICE,
+    ):
+        self._slots = HostSlots(slot_num, slot_dir)
+        self._slot_dir = slot_dir
+        self._memory_budget = memory_budget
+        self._nice = nice
+        self._cond = threading.Condition()
+        # deque[(future, memory, func, args)]
+        self._queue = collections.deque()
+        self._waiting = 0  # 已出队, 等待槽位或内存预算的任务数
+        self._running = 0
+        self._started = False
+
+    @staticmethod
+    def memory_of(language_config):
+        """编译计入内存预算的大小"""
+        if language_config.max_memory > 0:
+            return language_config.max_memory
+        return COMPILE_UNLIMITED_MEMORY
+
+    def _start(self):
+        # gunicorn fork 之后才启动线程, 调用方需持有 self._cond
+        for _ in range(self._slots.slot_num):
+            thread = threading.Thread(target=self._worker, daemon=True)
+            thread.start()
+        self._started = True
+
+    def submit(self, memory, func, *args) -> Future:
+        """提交一个编译任务
+
+        :param memory: 计入内存预算的大小, 见 memory_of
+        :param func: 在编译槽位内执行的函数
+        :return: Future
+        """
+        future = Future()
+        with self._cond:
+            if not self._started:
+                self._start()
+            self._queue.append((future, memory, func, args))
+            self._cond.notify()
+        return future
+
+    def _pop_task(self):
+        # 调用方需持有 self._cond
+        while self._queue:
+            task = self._queue.popleft()
+            if not task[0].cancelled():
+                return task
+        return None
+
+    def _host_reserved(self):
+        """全机正在编译的槽位数和预留内存之和, 未被锁定的槽位文件中是过期数据"""
+        busy = self._slots.busy()
+        reserved = 0
+        for index in busy:
+            try:
+                fd = os.open(self._slots.path(index), os.O_RDONLY)
+            except FileNotFoundError:
+                continue
+            try:
+                reserved += int(os.pread(fd, RESERVATION_SIZE, 0) or 0)
+            except ValueError:
+                pass
+            finally:
+                os.close(fd)
+        return len(busy), reserved
+
+    def _try_acquire(self, budget_fd, memory):
+        """在 .budget 锁内检查全机预留, 放得下时占用第一个空闲的槽位并写入预留
+
+        :return: 槽位序号, 预算不足或没有空闲槽位时返回 None
+        """
+        fcntl.flock(budget_fd, fcntl.LOCK_EX)
+        try:
+            if memory and self._memory_budget > 0:
+                busy, reserved = self._host_reserved()
+                if busy and reserved + memory > self._memory_budget:
+                    return None
+            slot_index = self._slots.try_acquire()
+            if slot_index is not None:
+                os.pwrite(self._slots.fd(slot_index), str(memory).rjust(RESERVATION_SIZE).encode(), 0)
+            return slot_index
+        finally:
+            fcntl.flock(budget_fd, fcntl.LOCK_UN)
+
+    def _worker(self):
+        try:
+            # Linux 上 nice 值属于线程, fork 出的编译器进程继承
+            os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), self._nice)
+        except OSError as e:
+            logger.warning(f"Failed to set compile thread priority: {e}")
+        os.makedirs(self._slot_dir, exist_ok=True)
+        # flock 属于打开的文件描述, 每个线程单独打开, 同一进程的线程之间也互斥
+        budget_fd = os.open(os.path.join(self._slot_dir, ".budget"), os.O_RDWR | os.O_CREAT, 0o600)
+        while True:
+            with self._cond:
+                while not self._queue:
+                    self._cond.wait()
+                task = self._pop_task()
+                if task is None:
+                    continue
+                self._waiting += 1
+            future, memory, func, args = task
+            if self._memory_budget > 0:
+                # 超过预算的任务按整个预算计算, 在其他编译结束后总能放行
+                memory = min(memory, self._memory_budget)
+            slot_index = None
+            while not future.cancelled():
+                slot_index = self._try_acquire(budget_fd, memory)
+                if slot_index is not None:
+                    break
+                time.sleep(COMPILE_POLL_INTERVAL)
+            with self._cond:
+                self._waiting -= 1
+            if slot_index is None:
+                continue
+            try:
+                with self._cond:
+                    self._running += 1
+                if future.set_running_or_notify_cancel():
+                    try:
+                        future.set_result(func(*args))
+                    except BaseException as e:
+                        future.set_exception(e)
+                with self._cond:
+                    self._running -= 1
+            finally:
+                self._slots.release(slot_index)
+
+    def stats(self):
+        with self._cond:
+            running = self._running
+            queued = len(self._queue) + self._waiting
+        busy, reserved = self._host_reserved()
+        return {
+            "slots": self._slots.slot_num,
+            "busy_slots": busy,
+            "reserved_memory": reserved,
+            "memory_budget": self._memory_budget,
+            "running": running,
+            "queued": queued,
+        }
+
+
+run_scheduler = RunScheduler()
+compile_scheduler = CompileScheduler()
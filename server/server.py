@@ -1,79 +1,357 @@
+import concurrent.futures
+import contextlib
+import fcntl
 import hashlib
 import json
 import os
+import queue
 import re
 import shutil
+import threading
+import time
 import uuid
+
+import judger
 from flask import Flask, Response, request
 from typing import Optional
 
-from compiler import Compiler
+from compile_cache import compile_cache, spj_cache
 from config import (
     DEBUG,
     COMPILER_USER_UID,
-    JUDGER_WORKSPACE_BASE,
-    RUN_GROUP_GID,
+    JUDGE_BATCH_MAX_JOBS,
+    RUN_SLOT_NUM,
     RUN_USER_UID,
     SPJ_EXE_DIR,
     SPJ_SRC_DIR,
+    SPJ_STORE_DIR,
     SPJ_USER_UID,
     TEST_CASE_DIR,
 )
 from exception import (
     CompileError,
     CompilerRuntimeError,
+    JobNotFound,
     JudgeClientError,
+    JudgeQueueFull,
     SPJCompileError,
+    TestCaseNotFound,
     TokenVerificationFailed,
 )
+from javac_server import javac_server
+from job_queue import job_queue
 from judge_client import JudgeClient
 from languages import OptionType, lang_map, cpp_lang_spj_compile, cpp_lang_spj_config, CPPSPJConfig
-from utils import ProblemIOMode, logger, server_info, token
+from metrics import Stage, metrics
+from page_cache import page_cache
+from pch import precompiled_headers
+from reaper import reaper
+from result_cache import hash_artifacts, hash_test_case, result_cache
+from scheduler import compile_scheduler, run_scheduler
+from staging import stats as staging_stats
+from test_case_store import test_case_store
+from test_case_sync import test_case_sync
+from toolchain_cache import go_build_cache, java_cds
+from upload import UploadedTestCase, discard_uploaded_test_case, read_request
+from utils import ProblemIOMode, exception_info, logger, server_info, token
+from workspace_pool import workspace_pool
 
 app = Flask(__name__)
 app.debug = DEBUG
 
 
 class InitSubmissionEnv(object):
-    def __init__(self, judger_workspace, submission_id, init_test_case_dir=False):
-        self.work_dir = os.path.join(judger_workspace, submission_id)
+    def __init__(self, init_test_case_dir=False):
         self.init_test_case_dir = init_test_case_dir
-        if init_test_case_dir:
-            self.test_case_dir = os.path.join(
-                self.work_dir, "submission_" + submission_id
-            )
-        else:
-            self.test_case_dir = None
+        self.work_dir = None
 
     def __enter__(self):
         try:
-            os.makedirs(self.work_dir, exist_ok=True)
-            if self.init_test_case_dir:
-                os.makedirs(self.test_case_dir, exist_ok=True)
-            os.chown(self.work_dir, COMPILER_USER_UID, RUN_GROUP_GID)
-            os.chmod(self.work_dir, 0o711)
+            with metrics.timer(Stage.init_env):
+                self.work_dir, test_case_dir = workspace_pool.lease(init_test_case_dir=self.init_test_case_dir)
         except Exception as e:
             logger.exception(e)
             raise JudgeClientError("failed to create runtime dir")
-        return self.work_dir, self.test_case_dir
+        return self.work_dir, test_case_dir
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         if not DEBUG:
             try:
-                shutil.rmtree(self.work_dir)
+                with metrics.timer(Stage.cleanup):
+                    workspace_pool.release(self.work_dir)
             except Exception as e:
                 logger.exception(e)
                 raise JudgeClientError("failed to clean runtime dir")
 
 
+def copy_artifacts(src_dir, dst_dir, names):
+    """拷贝编译产物, 保留属主和权限"""
+    for name in names:
+        src = os.path.join(src_dir, name)
+        dst = os.path.join(dst_dir, name)
+        if os.path.isdir(src):
+            shutil.copytree(src, dst)
+            for root, dirs, files in os.walk(src):
+                for child in dirs + files:
+                    child_src = os.path.join(root, child)
+                    st = os.lstat(child_src)
+                    os.lchown(os.path.join(dst, os.path.relpath(child_src, src)), st.st_uid, st.st_gid)
+        else:
+            shutil.copy2(src, dst)
+        st = os.stat(src)
+        os.chown(dst, st.st_uid, st.st_gid)
+
+
 class JudgeServer:
     @classmethod
     def ping(cls):
         data = server_info()
+        data["run_slots"] = run_scheduler.stats()
+        data["compile_slots"] = compile_scheduler.stats()
+        data["compile_cache"] = compile_cache.stats()
+        data["spj_cache"] = spj_cache.stats()
+        data["result_cache"] = result_cache.stats()
+        data["pch"] = precompiled_headers.stats()
+        data["go_build_cache"] = go_build_cache.stats()
+        data["java_cds"] = java_cds.stats()
+        data["javac_server"] = javac_server.stats()
+        data["test_case_store"] = test_case_store.stats()
+        data["test_case_sync"] = test_case_sync.stats()
+        data["job_queue"] = job_queue.stats()
+        data["staging"] = staging_stats()
+        data["trash"] = reaper.stats()
+        data["workspace_pool"] = workspace_pool.stats()
+        data["page_cache"] = page_cache.stats()
         data["action"] = "pong"
         return data
 
     @classmethod
+    def _prepare_spj(cls, spj_version, spj_src):
+        """spj 还未编译时先编译, 返回 spj_config"""
+        # spj config 暂时写死了
+        spj_config = cpp_lang_spj_config
+        spj_compile_config = cpp_lang_spj_compile
+
+        if spj_version and spj_config:
+            spj_exe_path = os.path.join(
+                SPJ_EXE_DIR, spj_config["exe_name"].format(spj_version=spj_version)
+            )
+            # spj src has not been compiled
+            if not os.path.isfile(spj_exe_path):
+                cls.compile_spj(
+                    spj_version=spj_version,
+                    src=spj_src,
+                    spj_compile_config=spj_compile_config,
+                    skip_existing=True,
+                )
+        return spj_config
+
+    @classmethod
+    def _write_program(cls, language, language_config, src, submission_dir):
+        """把代码写入评测目录, 需要编译的语言先编译, 返回可执行文件路径"""
+        if language_config.compiled:
+            src_path = os.path.join(submission_dir, language_config.src_name)
+
+            # write source code into file
+            with open(src_path, "w", encoding="utf-8") as f:
+                f.write(src)
+            os.chown(src_path, COMPILER_USER_UID, 0)
+            os.chmod(src_path, 0o400)
+
+            # compile source code, return exe file path
+            with metrics.timer(Stage.compile, language=language, verdict="success"):
+                exe_path = compile_cache.compile(
+                    language=language,
+                    language_config=language_config,
+                    src=src,
+                    src_path=src_path,
+                    output_dir=submission_dir,
+                )
+            if language_config.src_readable:
+                os.chown(src_path, RUN_USER_UID, 0)
+            try:
+                # Java exe_path is SOME_PATH/Main, but the real path is SOME_PATH/Main.class
+                # We ignore it temporarily
+                os.chown(exe_path, RUN_USER_UID, 0)
+                os.chmod(exe_path, 0o500)
+            except Exception:
+                pass
+        else:
+            exe_path = os.path.join(submission_dir, language_config.exe_name)
+            with open(exe_path, "w", encoding="utf-8") as f:
+                f.write(src)
+        return exe_path
+
+    @classmethod
+    @contextlib.contextmanager
+    def _compiling(cls, language, language_config, src, submission_dir):
+        """在编译调度器中写入代码并编译, 返回 exe_path 的 Future, 调用方同时准备测试用例
+
+        退出时等待编译结束, 之后评测目录才能回收
+        """
+        if not language_config.compiled:
+            future = concurrent.futures.Future()
+            future.set_result(cls._write_program(language, language_config, src, submission_dir))
+            yield future
+            return
+        submitted = time.monotonic()
+
+        def compile_program():
+            metrics.observe(Stage.compile_queue, time.monotonic() - submitted, language=language)
+            return cls._write_program(language, language_config, src, submission_dir)
+
+        future = compile_scheduler.submit(compile_scheduler.memory_of(language_config), compile_program)
+        try:
+            yield future
+        finally:
+            if not future.cancel():
+                concurrent.futures.wait([future])
+
+    @classmethod
+    def _write_test_case(cls, test_case, test_case_dir, is_spj, language=None):
+        """写入内联测试用例并生成 info"""
+        write_start = time.monotonic()
+        info = {
+            "test_case_number": len(test_case),
+            "spj": is_spj,
+            "test_cases": {},
+        }
+        # write test case
+        for index, item in enumerate(test_case):
+            index += 1
+            item_info = {}
+
+            input_name = str(index) + ".in"
+            item_info["input_name"] = input_name
+            input_data: bytes = item["input"].encode("utf-8")
+            item_info["input_size"] = len(input_data)
+
+            with open(os.path.join(test_case_dir, input_name), "wb") as f:
+                f.write(input_data)
+
+            output_data: bytes = item["output"].encode("utf-8")
+            test_output_lf = output_data.replace(b"\r\n", b"\n")  # CRLF格式化
+            test_output_stripped = re.sub(
+                pattern=rb"\s", repl=b"", string=test_output_lf
+            )  # 去除所有空白字符
+
+            output_name = str(index) + ".out"
+            item_info["output_name"] = output_name
+            item_info["output_md5"] = hashlib.md5(
+                output_data.rstrip()
+            ).hexdigest()
+            item_info["output_size"] = len(output_data)
+            item_info["stripped_output_md5"] = hashlib.md5(
+                test_output_stripped
+            ).hexdigest()
+
+            with open(os.path.join(test_case_dir, output_name), "wb") as f:
+                f.write(output_data)
+            info["test_cases"][index] = item_info
+        with open(os.path.join(test_case_dir, "info"), "w") as f:
+            json.dump(info, f)
+        metrics.observe(Stage.write_test_case, time.monotonic() - write_start, language=language)
+
+    @classmethod
+    @contextlib.contextmanager
+    def _test_case_dir(
+            cls, test_case_id, test_case, test_case_hash, is_spj, language, inline_test_case_dir, test_case_version=None
+    ):
+        """准备测试用例目录
+
+        TEST_CASE_DIR 中没有的 test_case_id 从同步来源获取, 评测期间持有引用.
+        内联和上传的测试用例优先放入去重存储, 评测期间持有引用; 存储关闭时写入本次提交的 inline_test_case_dir
+        """
+        if test_case_id:
+            test_case_dir = os.path.join(TEST_CASE_DIR, test_case_id)
+            if not test_case_sync.enabled or (test_case_version is None and os.path.isdir(test_case_dir)):
+                page_cache.record(test_case_id, test_case_dir)
+                yield test_case_dir
+                return
+            with test_case_sync.use(test_case_id, test_case_version) as test_case_dir:
+                page_cache.record(test_case_id, test_case_dir)
+                yield test_case_dir
+            return
+        if test_case_hash:
+            key = test_case_hash
+            use = test_case_store.use(key)
+        elif isinstance(test_case, UploadedTestCase):
+            # 上传的测试用例已在解析请求时写入磁盘
+            test_case.write_info(is_spj)
+            if not test_case_store.enabled:
+                yield test_case.path
+                return
+            key = test_case_store.make_key(test_case.file_hashes(), is_spj)
+            use = test_case_store.use(key, src_dir=test_case.detach())
+        elif test_case_store.enabled:
+            key = test_case_store.make_key(test_case_store.hash_test_case(test_case), is_spj)
+            use = test_case_store.use(key, write=lambda path: cls._write_test_case(test_case, path, is_spj, language))
+        else:
+            cls._write_test_case(test_case, inline_test_case_dir, is_spj, language)
+            yield inline_test_case_dir
+            return
+        with use as stored_test_case_dir:
+            if stored_test_case_dir is None:
+                raise TestCaseNotFound(f"test case {key} not found")
+            yield stored_test_case_dir
+
+    @classmethod
+    def _result_cache_key(cls, language, language_config, submission_dir, test_case_id, test_case_dir, **params):
+        """结果缓存的 key, 测试用例不是按 id 或内容寻址时返回 None
+
+        只有指定 test_case_id, 或开启测试用例去重存储(TEST_CASE_STORE_MAX_SIZE_MB > 0)时才会命中缓存,
+        存储关闭时内联和上传的测试用例没有稳定的 key, 总是重新评测
+
+        :param params: 影响结果的其余评测参数
+        """
+        if not result_cache.enabled:
+            return None
+        if test_case_id:
+            # 同步的测试用例目录名包含版本, 本地目录的内容变化由 hash_test_case 发现
+            test_case_key = [test_case_id, os.path.basename(test_case_dir)]
+        elif test_case_store.enabled:
+            # 内联, 上传和按 hash 指定的测试用例都在去重存储中, 目录名即内容哈希
+            test_case_key = os.path.basename(test_case_dir)
+        else:
+            return None
+        if language_config.reproducible:
+            # 编译型语言只比较编译产物
+            artifact_hash = hash_artifacts(
+                submission_dir, [language_config.exe_name], suffix=language_config.artifact_suffix
+            )
+        else:
+            # 编译产物中包含评测目录的路径, 比较源码
+            artifact_hash = hash_artifacts(submission_dir, [language_config.src_name])
+        if artifact_hash is None:
+            return None
+        return result_cache.make_key(
+            artifact_hash=artifact_hash,
+            language=language,
+            language_config=type(language_config).__name__,
+            execute_command=language_config.execute_command,
+            env=language_config.env,
+            test_case=test_case_key,
+            test_case_fingerprint=hash_test_case(test_case_dir),
+            **params,
+        )
+
+    @classmethod
+    def _run_judge_client(cls, judge_client, result_cache_key, max_cpu_time, max_real_time, max_memory, on_result=None):
+        """result_cache_key 不为 None 时先查询结果缓存, 评测后写入结果缓存"""
+        if result_cache_key is None:
+            return judge_client.run(on_result=on_result)
+        run_result = result_cache.get(result_cache_key, max_cpu_time, max_real_time, max_memory)
+        if run_result is not None:
+            if on_result:
+                for item in run_result:
+                    on_result(item)
+            return run_result
+        run_result = judge_client.run(on_result=on_result)
+        result_cache.put(result_cache_key, run_result)
+        return run_result
+
+    @classmethod
+    @discard_uploaded_test_case
     def judge(
             cls,
             language,
@@ -85,10 +363,17 @@ class JudgeServer:
             include_sample=True,
             test_case_id=None,
             test_case=None,
+            test_case_hash=None,
+            test_case_version=None,
             spj_version=None,
             spj_src=None,
             output=False,
             io_mode=None,
+            checker=None,
+            stop_on_first_failure=False,
+            max_failures=None,
+            use_result_cache=False,
+            on_result=None,
     ):
         """
 
@@ -99,7 +384,9 @@ class JudgeServer:
         :param max_real_time:
         :param max_memory:
         :param test_case_id:
-        :param test_case:
+        :param test_case: 内联测试用例 [{'input': ..., 'output': ...}], 或上传的 UploadedTestCase
+        :param test_case_hash: 之前发送过的内联测试用例的 key, 见 TestCaseStore.make_key, 存储中没有时返回 TestCaseNotFound
+        :param test_case_version: 从同步来源获取 test_case_id 时使用的版本, 默认为最新版本
         :param spj_version:
         :param spj_config:
         :param spj_compile_config:
@@ -107,6 +394,11 @@ class JudgeServer:
         :param output:
         :param include_sample: 评测是否包含样例
         :param io_mode: {'io_mode': ...(, 'input': ..., 'output': ...)}
+        :param checker: 内置检查器, 如 'tokens' 或 {'type': 'float', 'eps': 1e-6}, 未指定时使用测试用例 info 中的配置
+        :param stop_on_first_failure: 第一个用例未通过后跳过剩余用例, 等价于 max_failures=1
+        :param max_failures: 未通过的用例数达到该值后跳过剩余用例, 被跳过的用例结果为 RESULT_SKIPPED
+        :param use_result_cache: 编译产物, 测试用例和评测参数都相同时直接返回缓存的结果, 每个用例的结果带有 cached 标记
+        :param on_result: 每个用例结束时以该用例的结果调用, 用于流式返回
         :return:
         """
         if not io_mode:
@@ -121,126 +413,185 @@ class JudgeServer:
             options, io_mode["io_mode"]
         )  # 根据传入的语言决定采用哪一种配置
 
-        if not (test_case or test_case_id) or (test_case and test_case_id):
+        if [bool(test_case), bool(test_case_id), bool(test_case_hash)].count(True) != 1:
             raise JudgeClientError("invalid parameter")
-        # init
-        submission_id = uuid.uuid4().hex
-
-        # spj config 暂时写死了
-        spj_config = cpp_lang_spj_config
-        spj_compile_config = cpp_lang_spj_compile
-
+        spj_config = cls._prepare_spj(spj_version, spj_src)
         is_spj = spj_version and spj_config
-        if is_spj:
-            spj_exe_path = os.path.join(
-                SPJ_EXE_DIR, spj_config["exe_name"].format(spj_version=spj_version)
-            )
-            # spj src has not been compiled
-            if not os.path.isfile(spj_exe_path):
-                cls.compile_spj(
-                    spj_version=spj_version,
-                    src=spj_src,
-                    spj_compile_config=spj_compile_config,
-                )
 
         # 目前都是后端生成测试用例, 无需判题端生成
-        init_test_case_dir = bool(test_case)
-        with InitSubmissionEnv(
-                JUDGER_WORKSPACE_BASE,
-                submission_id=str(submission_id),
-                init_test_case_dir=init_test_case_dir,
-        ) as dirs:
-            submission_dir, test_case_dir = dirs
-            test_case_dir = test_case_dir or os.path.join(TEST_CASE_DIR, test_case_id)
-
-            if language_config.compiled:
-                src_path = os.path.join(submission_dir, language_config.src_name)
-
-                # write source code into file
-                with open(src_path, "w", encoding="utf-8") as f:
-                    f.write(src)
-                os.chown(src_path, COMPILER_USER_UID, 0)
-                os.chmod(src_path, 0o400)
-
-                # compile source code, return exe file path
-                exe_path = Compiler().compile(
+        init_test_case_dir = isinstance(test_case, list) and not test_case_store.enabled
+        with InitSubmissionEnv(init_test_case_dir=init_test_case_dir) as dirs:
+            submission_dir, inline_test_case_dir = dirs
+            with cls._compiling(language, language_config, src, submission_dir) as exe_future, cls._test_case_dir(
+                    test_case_id, test_case, test_case_hash, is_spj, language, inline_test_case_dir, test_case_version
+            ) as test_case_dir:
+                judge_client = JudgeClient(
                     language_config=language_config,
-                    src_path=src_path,
-                    output_dir=submission_dir,
+                    exe_path=exe_future.result(),
+                    max_cpu_time=max_cpu_time,
+                    max_real_time=max_real_time,
+                    max_memory=max_memory,
+                    test_case_dir=test_case_dir,
+                    submission_dir=submission_dir,
+                    spj_version=spj_version,
+                    spj_config=spj_config,
+                    output=output,
+                    io_mode=io_mode,
+                    include_sample=include_sample,
+                    checker=checker,
+                    max_failures=1 if stop_on_first_failure else max_failures,
+                    language=language,
+                )
+                result_cache_key = None
+                if use_result_cache:
+                    result_cache_key = cls._result_cache_key(
+                        language, language_config, submission_dir, test_case_id, test_case_dir,
+                        io_mode=io_mode, include_sample=include_sample, spj_version=spj_version, output=output,
+                        checker=checker, max_failures=1 if stop_on_first_failure else max_failures,
+                    )
+                run_result = cls._run_judge_client(
+                    judge_client, result_cache_key, max_cpu_time, max_real_time, max_memory, on_result=on_result
                 )
+
+                return run_result
+
+    @classmethod
+    def judge_batch(
+            cls,
+            language,
+            src,
+            jobs,
+            options: Optional[OptionType] = None,
+            include_sample=True,
+            spj_version=None,
+            spj_src=None,
+            output=False,
+            checker=None,
+            use_result_cache=False,
+    ):
+        """同一份代码只编译一次, 在多组测试用例和限制下评测
+
+        :param jobs: [{'test_case_id', 'test_case' 或 'test_case_hash', 'max_cpu_time', 'max_real_time', 'max_memory'(, 'test_case_version', 'io_mode', 'checker', 'stop_on_first_failure', 'max_failures')}]
+        :param checker: job 未指定 checker 时使用
+        其余参数与 judge 相同, 对全部 job 生效
+        :return: 与 jobs 顺序一致的 [{'err': ..., 'data': ...}], data 与 judge 的返回值相同
+        """
+        if not jobs or len(jobs) > JUDGE_BATCH_MAX_JOBS:
+            raise JudgeClientError("invalid parameter")
+        for job in jobs:
+            if [bool(job.get("test_case")), bool(job.get("test_case_id")), bool(job.get("test_case_hash"))].count(True) != 1:
+                raise JudgeClientError("invalid parameter")
+
+        spj_config = cls._prepare_spj(spj_version, spj_src)
+        is_spj = spj_version and spj_config
+
+        with InitSubmissionEnv() as dirs:
+            build_dir, _ = dirs
+            # 编译命令与 io_mode 无关
+            build_config = lang_map[language](dict(options or {}), ProblemIOMode.standard)
+            before = set(os.listdir(build_dir))
+
+            def judge_job(job):
+                io_mode = job.get("io_mode") or {"io_mode": ProblemIOMode.standard}
+                job_options = dict(options or {})
+                job_options.update(io_mode)
+                language_config = lang_map[language](job_options, io_mode["io_mode"])
+                test_case = job.get("test_case")
+                # 每个 job 使用独立的评测目录, 用例输出文件不会冲突
+                init_test_case_dir = bool(test_case) and not test_case_store.enabled
+                with InitSubmissionEnv(init_test_case_dir=init_test_case_dir) as job_dirs, \
+                        cls._test_case_dir(
+                            job.get("test_case_id"), test_case, job.get("test_case_hash"), is_spj, language, job_dirs[1],
+                            job.get("test_case_version"),
+                        ) as test_case_dir:
+                    submission_dir = job_dirs[0]
+                    # 测试用例准备好后再等待编译
+                    exe_path = exe_future.result()
+                    artifacts = [name for name in os.listdir(build_dir) if name not in before]
+                    copy_artifacts(build_dir, submission_dir, artifacts)
+                    judge_client = JudgeClient(
+                        language_config=language_config,
+                        exe_path=os.path.join(submission_dir, os.path.relpath(exe_path, build_dir)),
+                        max_cpu_time=job["max_cpu_time"],
+                        max_real_time=job["max_real_time"],
+                        max_memory=job["max_memory"],
+                        test_case_dir=test_case_dir,
+                        submission_dir=submission_dir,
+                        spj_version=spj_version,
+                        spj_config=spj_config,
+                        output=output,
+                        io_mode=io_mode,
+                        include_sample=include_sample,
+                        checker=job.get("checker") or checker,
+                        max_failures=1 if job.get("stop_on_first_failure") else job.get("max_failures"),
+                        language=language,
+                        # 同一批的用例在调度器中共用一个队列, 不会挤占其他评测
+                        group=build_dir,
+                    )
+                    result_cache_key = None
+                    if use_result_cache:
+                        result_cache_key = cls._result_cache_key(
+                            language, language_config, submission_dir, job.get("test_case_id"), test_case_dir,
+                            io_mode=io_mode, include_sample=include_sample, spj_version=spj_version, output=output,
+                            checker=job.get("checker") or checker,
+                            max_failures=1 if job.get("stop_on_first_failure") else job.get("max_failures"),
+                        )
+                    return cls._run_judge_client(
+                        judge_client, result_cache_key, job["max_cpu_time"], job["max_real_time"], job["max_memory"]
+                    )
+
+            with cls._compiling(language, build_config, src, build_dir) as exe_future:
+                with concurrent.futures.ThreadPoolExecutor(max_workers=min(len(jobs), RUN_SLOT_NUM)) as executor:
+                    futures = [executor.submit(judge_job, job) for job in jobs]
+                # 编译错误对整批生效
+                exe_future.result()
+
+            result = []
+            for future in futures:
                 try:
-                    # Java exe_path is SOME_PATH/Main, but the real path is SOME_PATH/Main.class
-                    # We ignore it temporarily
-                    os.chown(exe_path, RUN_USER_UID, 0)
-                    os.chmod(exe_path, 0o500)
-                except Exception:
-                    pass
-            else:
-                exe_path = os.path.join(submission_dir, language_config.exe_name)
-                with open(exe_path, "w", encoding="utf-8") as f:
-                    f.write(src)
+                    result.append({"err": None, "data": future.result()})
+                except Exception as e:
+                    logger.exception(e)
+                    err, data = exception_info(e)
+                    result.append({"err": err, "data": data})
+            return result
 
-            if init_test_case_dir:
-                info = {
-                    "test_case_number": len(test_case),
-                    "spj": is_spj,
-                    "test_cases": {},
-                }
-                # write test case
-                for index, item in enumerate(test_case):
-                    index += 1
-                    item_info = {}
-
-                    input_name = str(index) + ".in"
-                    item_info["input_name"] = input_name
-                    input_data: bytes = item["input"].encode("utf-8")
-                    item_info["input_size"] = len(input_data)
-
-                    with open(os.path.join(test_case_dir, input_name), "wb") as f:
-                        f.write(input_data)
-
-                    output_data: bytes = item["output"].encode("utf-8")
-                    test_output_lf = output_data.replace(b"\r\n", b"\n")  # CRLF格式化
-                    test_output_stripped = re.sub(
-                        pattern=rb"\s", repl=b"", string=test_output_lf
-                    )  # 去除所有空白字符
-
-                    output_name = str(index) + ".out"
-                    item_info["output_name"] = output_name
-                    item_info["output_md5"] = hashlib.md5(
-                        output_data.rstrip()
-                    ).hexdigest()
-                    item_info["output_size"] = len(output_data)
-                    item_info["stripped_output_md5"] = hashlib.md5(
-                        test_output_stripped
-                    ).hexdigest()
-
-                    with open(os.path.join(test_case_dir, output_name), "wb") as f:
-                        f.write(output_data)
-                    info["test_cases"][index] = item_info
-                with open(os.path.join(test_case_dir, "info"), "w") as f:
-                    json.dump(info, f)
-
-            judge_client = JudgeClient(
-                language_config=language_config,
-                exe_path=exe_path,
-                max_cpu_time=max_cpu_time,
-                max_real_time=max_real_time,
-                max_memory=max_memory,
-                test_case_dir=test_case_dir,
-                submission_dir=submission_dir,
-                spj_version=spj_version,
-                spj_config=spj_config,
-                output=output,
-                io_mode=io_mode,
-                include_sample=include_sample,
-            )
-            run_result = judge_client.run()
+    @classmethod
+    def prefetch(cls, test_case_ids, unpack=False):
+        """比赛开始前在后台从同步来源下载测试用例"""
+        return test_case_sync.prefetch(test_case_ids, unpack=unpack)
 
-            return run_result
+    @classmethod
+    def warmup(cls, test_case_ids=None, touch=True):
+        """把测试用例读入页缓存并返回覆盖率, 未指定 test_case_ids 时预热本 worker 最近评测最频繁的测试用例
+
+        :param touch: 逐页读取, 否则只提示内核异步预读
+        """
+        if test_case_ids is None:
+            return [
+                page_cache.warm(test_case_id, test_case_dir, touch=touch)
+                for test_case_id, test_case_dir in page_cache.hot()
+            ]
+        result = []
+        for test_case_id in test_case_ids:
+            with cls._test_case_dir(test_case_id, None, None, False, None, None) as test_case_dir:
+                try:
+                    result.append(page_cache.warm(test_case_id, test_case_dir, touch=touch))
+                except FileNotFoundError:
+                    raise TestCaseNotFound(f"test case {test_case_id} not found")
+        return result
+
+    @classmethod
+    def result(cls, job_id):
+        """查询异步评测任务的状态和结果"""
+        return job_queue.result(job_id)
 
     @classmethod
-    def compile_spj(cls, spj_version, src, spj_compile_config=cpp_lang_spj_compile):
+    def compile_spj(cls, spj_version, src, spj_compile_config=cpp_lang_spj_compile, skip_existing=False):
+        """编译 spj
+
+        :param skip_existing: 已有编译好的 spj 时直接返回
+        """
         # 语言编译设置用BaseLanguageConfig类型, 不使用字典传参
         spj_cfg = CPPSPJConfig()
         spj_cfg.src_name = spj_compile_config["src_name"].format(spj_version=spj_version)
@@ -254,54 +605,215 @@ class JudgeServer:
         # )
 
         spj_src_path = os.path.join(SPJ_SRC_DIR, spj_cfg.src_name)
+        spj_exe_path = os.path.join(SPJ_EXE_DIR, spj_cfg.exe_name)
 
-        # if spj source code not found, then write it into file
-        if not os.path.exists(spj_src_path):
-            with open(spj_src_path, "w", encoding="utf-8") as f:
-                f.write(src)
-            os.chown(spj_src_path, COMPILER_USER_UID, 0)
-            os.chmod(spj_src_path, 0o400)
+        # 同一 spj_version 同时只编译一次, 其他请求等待编译完成后直接使用
+        os.makedirs(SPJ_STORE_DIR, exist_ok=True)
+        lock_fd = os.open(os.path.join(SPJ_STORE_DIR, f".lock-{spj_cfg.exe_name}"), os.O_RDWR | os.O_CREAT, 0o600)
         try:
-            exe_path = Compiler().compile(
-                language_config=spj_cfg,
-                src_path=spj_src_path,
-                output_dir=SPJ_EXE_DIR,
-            )
-            os.chown(exe_path, SPJ_USER_UID, 0)
-            os.chmod(exe_path, 0o500)
-        # turn common CompileError into SPJCompileError
-        except CompileError as e:
-            raise SPJCompileError(e.message)
+            fcntl.flock(lock_fd, fcntl.LOCK_EX)
+            if skip_existing and os.path.isfile(spj_exe_path):
+                return "success"
+
+            # if spj source code not found, then write it into file
+            if not os.path.exists(spj_src_path):
+                if src is None:
+                    raise SPJCompileError("spj source code not found")
+                with open(spj_src_path, "w", encoding="utf-8") as f:
+                    f.write(src)
+                os.chown(spj_src_path, COMPILER_USER_UID, 0)
+                os.chmod(spj_src_path, 0o400)
+            # 之前写入的源码可能与本次请求不同, 按实际编译的文件计算缓存 key
+            with open(spj_src_path, encoding="utf-8") as f:
+                src = f.read()
+
+            # 在独立目录中编译, 完成后 rename 到 SPJ_EXE_DIR, 评测时不会看到写了一半的文件
+            build_dir = os.path.join(SPJ_EXE_DIR, ".build-" + uuid.uuid4().hex)
+            os.mkdir(build_dir)
+            os.chown(build_dir, COMPILER_USER_UID, 0)
+            os.chmod(build_dir, 0o700)
+            try:
+                exe_path = compile_scheduler.submit(
+                    compile_scheduler.memory_of(spj_cfg),
+                    lambda: spj_cache.compile(
+                        language="spj",
+                        language_config=spj_cfg,
+                        src=src,
+                        src_path=spj_src_path,
+                        output_dir=build_dir,
+                    ),
+                ).result()
+                os.chown(exe_path, SPJ_USER_UID, 0)
+                os.chmod(exe_path, 0o500)
+                os.rename(exe_path, spj_exe_path)
+            # turn common CompileError into SPJCompileError
+            except CompileError as e:
+                raise SPJCompileError(e.message)
+            finally:
+                shutil.rmtree(build_dir, ignore_errors=True)
+        finally:
+            os.close(lock_fd)
         return "success"
 
 
+def stream_judge(data):
+    """流式评测, 每个用例结束时输出一条结果, 最后输出一条汇总记录
+
+    默认输出 NDJSON, 请求头 Accept 为 text/event-stream 时输出 SSE
+    """
+    records = queue.Queue()
+
+    def on_result(run_result):
+        records.put({"type": "test_case", "err": None, "data": run_result})
+
+    def judge():
+        summary = {"type": "summary", "err": None, "data": None}
+        try:
+            result = JudgeServer.judge(on_result=on_result, **data)
+            summary["data"] = {
+                "test_case_number": len(result),
+                "failed": sum(1 for item in result if item["result"] != judger.RESULT_SUCCESS),
+            }
+        except Exception as e:
+            logger.exception(e)
+            summary["err"], summary["data"] = exception_info(e)
+        records.put(summary)
+
+    threading.Thread(target=judge, daemon=True).start()
+    sse = request.accept_mimetypes.best == "text/event-stream"
+
+    def generate():
+        while True:
+            record = records.get()
+            line = json.dumps(record)
+            yield f"data: {line}\n\n" if sse else line + "\n"
+            if record["type"] == "summary":
+                break
+
+    return Response(generate(), mimetype="text/event-stream" if sse else "application/x-ndjson")
+
+
+def collect_metrics():
+    samples = []
+    scheduler_stats = run_scheduler.stats()
+    samples.append(("judge_active_runs", "gauge", {}, scheduler_stats["running"]))
+    samples.append(("judge_queued_runs", "gauge", {}, scheduler_stats["queued"]))
+    compile_stats = compile_scheduler.stats()
+    samples.append(("judge_active_compiles", "gauge", {}, compile_stats["running"]))
+    samples.append(("judge_queued_compiles", "gauge", {}, compile_stats["queued"]))
+    samples.append(("judge_job_queue_depth", "gauge", {}, job_queue.stats()["queued"]))
+    for cache_name, cache in (
+            ("compile", compile_cache),
+            ("spj", spj_cache),
+            ("test_case", test_case_store),
+            ("result", result_cache),
+            ("pch", precompiled_headers),
+            ("java_cds", java_cds),
+    ):
+        cache_stats = cache.stats()
+        samples.append(("judge_cache_hits_total", "counter", {"cache": cache_name}, cache_stats["hits"]))
+        samples.append(("judge_cache_misses_total", "counter", {"cache": cache_name}, cache_stats["misses"]))
+    for strategy, count in staging_stats().items():
+        samples.append(("judge_staged_files_total", "counter", {"strategy": strategy}, count))
+    pool_stats = workspace_pool.stats()
+    samples.append(("judge_workspace_leases_total", "counter", {"result": "hit"}, pool_stats["hits"]))
+    samples.append(("judge_workspace_leases_total", "counter", {"result": "miss"}, pool_stats["misses"]))
+    samples.append(("judge_pch_builds_total", "counter", {}, precompiled_headers.stats()["builds"]))
+    go_stats = go_build_cache.stats()
+    # 只有负责预热的 worker 有数据, 其余为 0
+    samples.append(("judge_go_cache_bytes", "gauge", {}, go_stats["size"]))
+    samples.append(("judge_go_cache_trimmed_total", "counter", {}, go_stats["trimmed"]))
+    javac_stats = javac_server.stats()
+    samples.append(("judge_javac_server_requests_total", "counter", {"result": "success"}, javac_stats["requests"]))
+    samples.append(("judge_javac_server_requests_total", "counter", {"result": "fallback"}, javac_stats["fallbacks"]))
+    samples.append(("judge_javac_server_restarts_total", "counter", {}, javac_stats["restarts"]))
+    page_cache_stats = page_cache.stats()
+    if page_cache_stats["leader"]:
+        # 只有负责预热的 worker 上报, 避免重复计算
+        samples.append(("judge_page_cache_pinned_bytes", "gauge", {}, page_cache_stats["pinned"]))
+        hot = page_cache_stats["hot"]
+        samples.append(("judge_page_cache_hot_bytes", "gauge", {}, sum(item["size"] for item in hot)))
+        samples.append(("judge_page_cache_resident_bytes", "gauge", {}, sum(item["resident"] for item in hot)))
+    return samples
+
+
+metrics.register(collect_metrics)
+
+
+@app.route("/metrics", methods=["GET", "POST"])
+def metrics_view():
+    # Prometheus 无法自定义请求头时可以使用 Authorization: Bearer <token>
+    _token = request.headers.get("X-Judge-Server-Token")
+    if _token is None and request.headers.get("Authorization", "").startswith("Bearer "):
+        _token = request.headers["Authorization"][len("Bearer "):]
+    if _token != token:
+        ret = {"err": "TokenVerificationFailed", "data": "invalid token"}
+        return Response(json.dumps(ret), mimetype="application/json", status=TokenVerificationFailed.status)
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+
 @app.route("/", defaults={"path": ""})
 @app.route("/<path:path>", methods=["POST"])
 def server(path):
-    if path in {"judge", "ping", "compile_spj"}:
+    headers = {}
+    if path.startswith("result/"):
+        # /result/<job_id>
+        path, job_id = path.split("/", 1)
+    else:
+        job_id = None
+    if path in {"judge", "judge_batch", "ping", "compile_spj", "result", "prefetch", "warmup"}:
         _token = request.headers.get("X-Judge-Server-Token")
+        uploaded = None
         try:
             if _token != token:
                 raise TokenVerificationFailed("invalid token")
             try:
-                data = request.json
+                with metrics.timer(Stage.parse):
+                    data, uploaded = read_request(request)
+            except JudgeClientError:
+                raise
             except Exception:
                 data = {}
+            if uploaded is not None:
+                if path != "judge":
+                    raise JudgeClientError("test case upload is only supported by /judge")
+                data["test_case"] = uploaded
+            if job_id:
+                data = {"job_id": job_id}
+            # on_result 是 stream_judge 内部使用的回调, 不接受请求中的同名参数
+            data.pop("on_result", None)
             status = 200
-            ret = {"err": None, "data": getattr(JudgeServer, path)(**data)}
+            if path in {"judge", "judge_batch"} and data.pop("async", False):
+                # 异步评测, 立即返回 job_id, 通过 /result/<job_id> 或 callback_url 获取结果
+                callback_url = data.pop("callback_url", None)
+                status = 202
+                ret = {"err": None, "data": {"job_id": job_queue.submit(getattr(JudgeServer, path), data, callback_url)}}
+            elif path == "judge" and data.pop("stream", False):
+                return stream_judge(data)
+            else:
+                ret = {"err": None, "data": getattr(JudgeServer, path)(**data)}
         except (
                 CompileError,
                 CompilerRuntimeError,
                 TokenVerificationFailed,
                 SPJCompileError,
                 JudgeClientError,
+                JudgeQueueFull,
+                JobNotFound,
+                TestCaseNotFound,
         ) as e:
             status = e.status
+            if uploaded is not None:
+                uploaded.discard()
+            if isinstance(e, JudgeQueueFull):
+                headers["Retry-After"] = str(e.retry_after)
             logger.exception(e)
             logger.exception(data)
             ret = {"err": e.__class__.__name__, "data": e.message}
         except Exception as e:
             status = 500
+            if uploaded is not None:
+                uploaded.discard()
             logger.exception(e)
             logger.exception(data)
             ret = {
@@ -311,8 +823,17 @@ def server(path):
     else:
         status = 400
         ret = {"err": "InvalidRequest", "data": "404"}
-    return Response(json.dumps(ret), mimetype="application/json", status=status)
+    with metrics.timer(Stage.serialize, verdict=ret["err"]):
+        body = json.dumps(ret)
+    return Response(body, mimetype="application/json", status=status, headers=headers)
+
 
+# 清理上次遗留和之后移入回收目录的评测目录, 预先创建评测目录
+reaper.start()
+workspace_pool.start()
+precompiled_headers.prebuild()
+go_build_cache.start()
+java_cds.start()
 
 if DEBUG:
     logger.info("DEBUG=ON")
@@ -0,0 +1,85 @@
+import collections
+import fcntl
+import os
+import shutil
+import stat
+import threading
+
+from config import COMPILER_USER_UID, RUN_USER_UID, SPJ_USER_UID
+from utils import logger
+
+FICLONE = 0x40049409  # linux/fs.h, _IOW(0x94, 9, int)
+
+
+class StageStrategy:
+    hardlink = "hardlink"
+    reflink = "reflink"
+    copy = "copy"
+
+
+_stats = collections.Counter()
+_stats_lock = threading.Lock()
+
+
+def _can_hardlink(st):
+    # 硬链接与测试数据共享 inode 和权限, 属主可以修改权限,
+    # 只有不属于沙箱用户且本来就对其他用户只读的文件才能直接链接
+    return (
+        stat.S_ISREG(st.st_mode)
+        and st.st_uid not in (RUN_USER_UID, SPJ_USER_UID, COMPILER_USER_UID)
+        and st.st_mode & stat.S_IROTH
+        and not st.st_mode & (stat.S_IWGRP | stat.S_IWOTH)
+    )
+
+
+def _reflink(src, dst):
+    src_fd = os.open(src, os.O_RDONLY)
+    try:
+        dst_fd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+        try:
+            fcntl.ioctl(dst_fd, FICLONE, src_fd)
+        except OSError:
+            os.close(dst_fd)
+            os.remove(dst)
+            raise
+        os.close(dst_fd)
+    finally:
+        os.close(src_fd)
+
+
+def stage_file(src, dst):
+    """把测试数据放到评测目录下, 供沙箱用户和 spj 用户读取
+
+    依次尝试硬链接, reflink(FICLONE), 最后才拷贝. 两者都要求测试数据和评测目录在同一文件系统:
+    去重存储和同步来源的测试用例(/judger/store)与评测目录(/judger/run)同在 /judger 卷上时可以链接;
+    /test_case 是单独挂载的, /judger/run 挂载为 tmpfs 时也不在同一文件系统, 这些情况直接拷贝.
+
+    :return: 使用的 StageStrategy
+    """
+    src_st = os.stat(src)
+    strategy = None
+    if src_st.st_dev == os.stat(os.path.dirname(dst)).st_dev:
+        if _can_hardlink(src_st):
+            try:
+                os.link(src, dst)
+                strategy = StageStrategy.hardlink
+            except OSError:
+                pass
+        if strategy is None:
+            try:
+                _reflink(src, dst)
+                strategy = StageStrategy.reflink
+            except OSError:
+                pass
+    if strategy is None:
+        shutil.copyfile(src, dst)
+        strategy = StageStrategy.copy
+    with _stats_lock:
+        _stats[strategy] += 1
+    logger.debug(f"Staged {src} -> {dst} by {strategy}")
+    return strategy
+
+
+def stats():
+    with _stats_lock:
+        return dict(_stats)
@@ -0,0 +1,197 @@
+import contextlib
+import fcntl
+import hashlib
+import os
+import re
+import shutil
+import threading
+import uuid
+
+from config import TEST_CASE_STORE_DIR, TEST_CASE_STORE_EVICT_INTERVAL, TEST_CASE_STORE_MAX_SIZE
+from exception import JudgeClientError
+from reaper import reaper
+from utils import dir_size, logger, remove_stale_tmp
+
+KEY_PATTERN = re.compile(r"^[0-9a-f]{64}$")
+LOCK_NAME = ".lock"
+
+
+class TestCaseStore(object):
+    """按内容寻址的内联测试用例存储, 也用于保存同步的测试用例
+
+    每个条目是 store_dir 下以 key 命名的目录, 包含 1.in, 1.out, ... 和 info, 可以直接作为测试用例目录使用.
+    评测期间对条目中的 .lock 持有共享锁作为引用计数, 淘汰时只删除能拿到排他锁的条目, worker 异常退出时锁自动释放.
+    条目目录的 mtime 作为最近使用时间, 每发布 TEST_CASE_STORE_EVICT_INTERVAL 个条目检查一次总大小, 超过 max_size 时淘汰最久未使用的条目.
+    条目发布后内容不变, 本进程记录已统计过的条目大小, 淘汰时只统计新出现的条目.
+    """
+
+    def __init__(self, store_dir=TEST_CASE_STORE_DIR, max_size=TEST_CASE_STORE_MAX_SIZE):
+        self._store_dir = store_dir
+        self._max_size = max_size
+        self._lock = threading.Lock()
+        self._published = 0
+        # 条目名 -> 大小, 只在持有 .lock 时访问
+        self._sizes = {}
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def enabled(self):
+        return self._max_size > 0
+
+    @staticmethod
+    def make_key(file_hashes, spj):
+        """key = sha256("spj={0|1}\\n" + 每个用例一行 "<输入的 sha256> <输出的 sha256>\\n"), 后端可以自行计算
+
+        :param file_hashes: 按用例顺序排列的 [(输入的 sha256, 输出的 sha256)]
+        """
+        key = hashlib.sha256(f"spj={int(bool(spj))}\n".encode("utf-8"))
+        for input_hash, output_hash in file_hashes:
+            key.update(f"{input_hash} {output_hash}\n".encode("utf-8"))
+        return key.hexdigest()
+
+    @staticmethod
+    def hash_test_case(test_case):
+        """计算内联测试用例 [{'input': ..., 'output': ...}] 每个用例的 sha256"""
+        return [
+            (
+                hashlib.sha256(item["input"].encode("utf-8")).hexdigest(),
+                hashlib.sha256(item["output"].encode("utf-8")).hexdigest(),
+            )
+            for item in test_case
+        ]
+
+    def _count(self, hit):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def _acquire(self, key):
+        """对条目加共享锁, 条目不存在时返回 None
+
+        条目按内容寻址, 等待锁期间条目被淘汰后又被重新发布时, 新条目的内容相同, 直接改用新条目
+        """
+        entry_dir = os.path.join(self._store_dir, key)
+        lock_path = os.path.join(entry_dir, LOCK_NAME)
+        while True:
+            try:
+                lock_fd = os.open(lock_path, os.O_RDONLY)
+            except FileNotFoundError:
+                return None
+            fcntl.flock(lock_fd, fcntl.LOCK_SH)
+            try:
+                # 等待锁期间条目可能已被淘汰并移入回收目录
+                if os.stat(lock_path).st_ino == os.fstat(lock_fd).st_ino:
+                    os.utime(entry_dir)
+                    return lock_fd
+            except FileNotFoundError:
+                pass
+            os.close(lock_fd)
+
+    def _publish(self, key, tmp_dir):
+        """把准备好的目录发布为条目, 返回已加共享锁的 fd, 同一条目已存在时返回 None"""
+        lock_fd = os.open(os.path.join(tmp_dir, LOCK_NAME), os.O_RDONLY | os.O_CREAT, 0o600)
+        fcntl.flock(lock_fd, fcntl.LOCK_SH)
+        try:
+            os.rename(tmp_dir, os.path.join(self._store_dir, key))
+        except OSError as e:
+            # 其他请求已发布同一条目
+            logger.debug(f"Failed to publish test case {key}: {e}")
+            os.close(lock_fd)
+            return None
+        with self._lock:
+            self._published += 1
+            evict = self._published % TEST_CASE_STORE_EVICT_INTERVAL == 0
+        if evict:
+            self._evict()
+        return lock_fd
+
+    def _evict(self):
+        lock_fd = os.open(os.path.join(self._store_dir, LOCK_NAME), os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            try:
+                fcntl.flock(lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                # 其他 worker 正在淘汰
+                return
+            remove_stale_tmp(self._store_dir)
+            sizes = {}
+            entries = []
+            total = 0
+            with os.scandir(self._store_dir) as it:
+                for entry in it:
+                    if entry.name.startswith(".") or not entry.is_dir():
+                        continue
+                    size = self._sizes.get(entry.name)
+                    if size is None:
+                        size = dir_size(entry.path)
+                    sizes[entry.name] = size
+                    total += size
+                    entries.append((entry.stat().st_mtime, size, entry.name))
+            entries.sort()
+            for _, size, name in entries:
+                if total <= self._max_size:
+                    break
+                path = os.path.join(self._store_dir, name)
+                try:
+                    entry_lock_fd = os.open(os.path.join(path, LOCK_NAME), os.O_RDONLY)
+                except FileNotFoundError:
+                    continue
+                try:
+                    fcntl.flock(entry_lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    reaper.discard(path)
+                    del sizes[name]
+                    total -= size
+                except BlockingIOError:
+                    # 正在评测中使用
+                    pass
+                finally:
+                    os.close(entry_lock_fd)
+            self._sizes = sizes
+        finally:
+            os.close(lock_fd)
+
+    @contextlib.contextmanager
+    def use(self, key, write=None, src_dir=None):
+        """使用条目, 期间条目不会被淘汰
+
+        :param write: 条目不存在时调用 write(目录) 写入测试用例和 info
+        :param src_dir: 条目不存在时把该目录移入存储作为条目, 条目已存在时删除该目录
+        :return: 条目目录, 条目不存在且无法生成时为 None
+        """
+        if not KEY_PATTERN.match(key):
+            raise JudgeClientError("invalid test case hash")
+        os.makedirs(self._store_dir, exist_ok=True)
+        lock_fd = self._acquire(key)
+        self._count(hit=lock_fd is not None)
+        if lock_fd is None and (write or src_dir):
+            if src_dir:
+                tmp_dir = src_dir
+            else:
+                tmp_dir = os.path.join(self._store_dir, ".tmp-" + uuid.uuid4().hex)
+                os.mkdir(tmp_dir, 0o700)
+                try:
+                    write(tmp_dir)
+                except Exception:
+                    shutil.rmtree(tmp_dir, ignore_errors=True)
+                    raise
+            lock_fd = self._publish(key, tmp_dir)
+            if lock_fd is None:
+                reaper.discard(tmp_dir)
+                lock_fd = self._acquire(key)
+        elif src_dir:
+            reaper.discard(src_dir)
+        try:
+            yield os.path.join(self._store_dir, key) if lock_fd is not None else None
+        finally:
+            if lock_fd is not None:
+                os.close(lock_fd)
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses}
+
+
+test_case_store = TestCaseStore()
@@ -0,0 +1,260 @@
+import contextlib
+import fcntl
+import hashlib
+import json
+import os
+import queue
+import re
+import shutil
+import tarfile
+import threading
+import time
+
+import requests
+import zstandard
+
+from config import (
+    MAX_READ_BYTES,
+    TEST_CASE_SOURCE,
+    TEST_CASE_SYNC_DIR,
+    TEST_CASE_SYNC_MAX_SIZE,
+    TEST_CASE_SYNC_PACKAGE_MAX_SIZE,
+    TEST_CASE_SYNC_TIMEOUT,
+    TEST_CASE_SYNC_VERSION_TTL,
+)
+from exception import JudgeClientError
+from output_hash import output_md5
+from test_case_store import TestCaseStore
+from utils import logger
+
+NAME_PATTERN = re.compile(r"^[\w.-]+$")
+PACKAGE_NAME = "package.tar.zst"
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+
+def _check_name(name):
+    if not name or not NAME_PATTERN.match(name) or name in {".", ".."}:
+        raise JudgeClientError("Test case not found")
+
+
+def _verify(test_case_dir):
+    """按 info 检查解压后的测试用例文件是否完整"""
+    with open(os.path.join(test_case_dir, "info")) as f:
+        info = json.load(f)
+    for item in info["test_cases"].values():
+        input_path = os.path.join(test_case_dir, item["input_name"])
+        if "input_size" in item and os.path.getsize(input_path) != item["input_size"]:
+            raise ValueError(f"size mismatch: {item['input_name']}")
+        if not item.get("output_name"):
+            continue
+        output_path = os.path.join(test_case_dir, item["output_name"])
+        output_size = os.path.getsize(output_path)
+        if "output_size" in item and output_size != item["output_size"]:
+            raise ValueError(f"size mismatch: {item['output_name']}")
+        # 超过 MAX_READ_BYTES 的输出评测时只计算前一部分 md5, 不检查
+        if item.get("output_md5") and output_size <= MAX_READ_BYTES:
+            if output_md5(output_path)[0] != item["output_md5"]:
+                raise ValueError(f"md5 mismatch: {item['output_name']}")
+
+
+class TestCaseSync(object):
+    """从目录或 http(s) 来源同步测试用例
+
+    压缩包下载后先保存, 首次评测时才解压并按 info 校验. 解压后的目录和压缩包分别保存在 TestCaseStore 中,
+    评测期间持有引用, 冷门题目按 LRU 淘汰. 同一版本同时只下载和解压一次, 其他请求等待完成后直接使用.
+    """
+
+    def __init__(
+            self,
+            source=TEST_CASE_SOURCE,
+            sync_dir=TEST_CASE_SYNC_DIR,
+            max_size=TEST_CASE_SYNC_MAX_SIZE,
+            package_max_size=TEST_CASE_SYNC_PACKAGE_MAX_SIZE,
+    ):
+        self._source = source.rstrip("/")
+        self._sync_dir = sync_dir
+        self._test_cases = TestCaseStore(os.path.join(sync_dir, "test_case"), max_size)
+        self._packages = TestCaseStore(os.path.join(sync_dir, "package"), package_max_size)
+        self._versions = {}  # test_case_id -> (version, 查询时间)
+        self._prefetch_queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._started = False
+        self.fetches = 0
+        self.unpacks = 0
+
+    @property
+    def enabled(self):
+        return bool(self._source)
+
+    @property
+    def _http(self):
+        return self._source.startswith(("http://", "https://"))
+
+    @staticmethod
+    def _key(test_case_id, version):
+        return hashlib.sha256(f"{test_case_id}\n{version}".encode("utf-8")).hexdigest()
+
+    def _read_source(self, path):
+        if self._http:
+            resp = requests.get(f"{self._source}/{path}", timeout=TEST_CASE_SYNC_TIMEOUT)
+            if resp.status_code == 404:
+                raise JudgeClientError("Test case not found")
+            resp.raise_for_status()
+            return resp.text
+        try:
+            with open(os.path.join(self._source, path)) as f:
+                return f.read()
+        except FileNotFoundError:
+            raise JudgeClientError("Test case not found")
+
+    def latest_version(self, test_case_id):
+        """来源中的最新版本号, 每个 worker 缓存 TEST_CASE_SYNC_VERSION_TTL 秒"""
+        with self._lock:
+            cached = self._versions.get(test_case_id)
+        if cached and time.monotonic() - cached[1] < TEST_CASE_SYNC_VERSION_TTL:
+            return cached[0]
+        try:
+            version = self._read_source(f"{test_case_id}/latest").strip()
+        except requests.RequestException as e:
+            # 来源暂时不可用时继续使用已知的版本
+            if cached:
+                logger.warning(f"Failed to check version of {test_case_id}: {e}")
+                return cached[0]
+            raise JudgeClientError(f"failed to fetch test case {test_case_id}: {e}")
+        _check_name(version)
+        with self._lock:
+            self._versions[test_case_id] = (version, time.monotonic())
+        return version
+
+    def _download(self, test_case_id, version, package_dir):
+        package_path = os.path.join(package_dir, PACKAGE_NAME)
+        try:
+            with requests.get(
+                    f"{self._source}/{test_case_id}/{version}.tar.zst", stream=True, timeout=TEST_CASE_SYNC_TIMEOUT
+            ) as resp:
+                if resp.status_code == 404:
+                    raise JudgeClientError("Test case not found")
+                resp.raise_for_status()
+                with open(package_path, "wb") as f:
+                    for chunk in resp.iter_content(DOWNLOAD_CHUNK_SIZE):
+                        f.write(chunk)
+        except requests.RequestException as e:
+            raise JudgeClientError(f"failed to fetch test case {test_case_id}: {e}")
+        with self._lock:
+            self.fetches += 1
+
+    @contextlib.contextmanager
+    def _single_flight(self, key):
+        os.makedirs(self._sync_dir, exist_ok=True)
+        lock_fd = os.open(os.path.join(self._sync_dir, f".lock-{key}"), os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(lock_fd, fcntl.LOCK_EX)
+            yield
+        finally:
+            os.close(lock_fd)
+
+    @contextlib.contextmanager
+    def _package(self, test_case_id, version):
+        """返回压缩包路径, http 来源先下载到本地"""
+        if not self._http:
+            package_path = os.path.join(self._source, test_case_id, f"{version}.tar.zst")
+            if not os.path.isfile(package_path):
+                raise JudgeClientError("Test case not found")
+            yield package_path
+            return
+        key = self._key(test_case_id, version)
+        with self._packages.use(key, write=lambda path: self._download(test_case_id, version, path)) as package_dir:
+            if package_dir is None:
+                raise JudgeClientError(f"failed to fetch test case {test_case_id}")
+            yield os.path.join(package_dir, PACKAGE_NAME)
+
+    def _unpack(self, test_case_id, version, test_case_dir):
+        with self._package(test_case_id, version) as package_path:
+            try:
+                with open(package_path, "rb") as f:
+                    reader = zstandard.ZstdDecompressor().stream_reader(f)
+                    with tarfile.open(fileobj=reader, mode="r|") as tar:
+                        for member in tar:
+                            name = os.path.normpath(member.name)
+                            if os.path.isabs(name) or name == ".." or name.startswith("../"):
+                                raise ValueError(f"unexpected tar member {member.name}")
+                            path = os.path.join(test_case_dir, name)
+                            if member.isdir():
+                                os.makedirs(path, exist_ok=True)
+                            elif member.isfile():
+                                os.makedirs(os.path.dirname(path), exist_ok=True)
+                                with open(path, "wb") as dst:
+                                    shutil.copyfileobj(tar.extractfile(member), dst, DOWNLOAD_CHUNK_SIZE)
+                                os.chmod(path, 0o644)
+                            else:
+                                raise ValueError(f"unexpected tar member {member.name}")
+                _verify(test_case_dir)
+            except (OSError, ValueError, KeyError, TypeError, tarfile.TarError, zstandard.ZstdError) as e:
+                logger.warning(f"Bad test case package {test_case_id}/{version}: {e}")
+                raise JudgeClientError("Bad test case package")
+        with self._lock:
+            self.unpacks += 1
+
+    @contextlib.contextmanager
+    def use(self, test_case_id, version=None):
+        """评测期间使用测试用例, 本地没有时阻塞等待下载和解压
+
+        :param version: 未指定时使用来源中的最新版本
+        :return: 测试用例目录
+        """
+        _check_name(test_case_id)
+        if version is None:
+            version = self.latest_version(test_case_id)
+        else:
+            _check_name(version)
+        key = self._key(test_case_id, version)
+        with contextlib.ExitStack() as stack:
+            test_case_dir = stack.enter_context(self._test_cases.use(key))
+            if test_case_dir is None:
+                with self._single_flight(key):
+                    test_case_dir = stack.enter_context(
+                        self._test_cases.use(key, write=lambda path: self._unpack(test_case_id, version, path))
+                    )
+                if test_case_dir is None:
+                    raise JudgeClientError("Test case not found")
+            yield test_case_dir
+
+    def _prefetch(self, test_case_id, unpack):
+        version = self.latest_version(test_case_id)
+        if unpack:
+            with self.use(test_case_id, version):
+                return
+        with self._single_flight(self._key(test_case_id, version)), self._package(test_case_id, version):
+            pass
+
+    def _prefetch_loop(self):
+        while True:
+            test_case_id, unpack = self._prefetch_queue.get()
+            try:
+                self._prefetch(test_case_id, unpack)
+            except Exception as e:
+                logger.exception(e)
+
+    def prefetch(self, test_case_ids, unpack=False):
+        """在后台下载测试用例, 用于比赛开始前预热
+
+        :param unpack: 同时解压, 否则首次评测时再解压
+        """
+        if not self.enabled:
+            raise JudgeClientError("test case sync is disabled")
+        for test_case_id in test_case_ids:
+            _check_name(test_case_id)
+        with self._lock:
+            if not self._started:
+                threading.Thread(target=self._prefetch_loop, daemon=True).start()
+                self._started = True
+        for test_case_id in test_case_ids:
+            self._prefetch_queue.put((test_case_id, unpack))
+        return {"queued": len(test_case_ids)}
+
+    def stats(self):
+        with self._lock:
+            return {"fetches": self.fetches, "unpacks": self.unpacks, "prefetch_queued": self._prefetch_queue.qsize()}
+
+
+test_case_sync = TestCaseSync()
@@ -0,0 +1,306 @@
+import fcntl
+import os
+import shutil
+import subprocess
+import threading
+import time
+import uuid
+
+from config import (
+    COMPILER_GROUP_GID,
+    COMPILER_USER_UID,
+    GO_CACHE_DIR,
+    GO_CACHE_MAX_SIZE,
+    GO_CACHE_TRIM_INTERVAL,
+    JAVA_CDS_DIR,
+    JAVA_CDS_ENABLED,
+    TOOLCHAIN_BUILD_TIMEOUT,
+)
+from languages import JavaConfig
+from reaper import reaper
+from utils import logger
+
+GO = "/usr/bin/go"
+JAVA = "/usr/bin/java"
+JAVAC = "/usr/bin/javac"
+STAMP_NAME = "stamp"
+# 生成类列表时运行的程序, 覆盖提交中常用的输入输出和集合类
+JAVA_SAMPLE = """\
+import java.io.*;
+import java.math.*;
+import java.util.*;
+import java.util.stream.*;
+
+public class Main {
+    public static void main(String[] args) throws IOException {
+        BufferedReader reader = new BufferedReader(new InputStreamReader(System.in));
+        StringTokenizer tokenizer = new StringTokenizer(reader.readLine());
+        Scanner scanner = new Scanner(reader);
+        PrintWriter writer = new PrintWriter(new BufferedWriter(new OutputStreamWriter(System.out)));
+        long a = Long.parseLong(tokenizer.nextToken());
+        int b = scanner.nextInt();
+        List<Integer> list = new ArrayList<>(Arrays.asList(b, 3, 1));
+        Collections.sort(list);
+        Map<String, Integer> map = new HashMap<>();
+        map.put("a", b);
+        TreeMap<Integer, Integer> tree = new TreeMap<>(Comparator.reverseOrder());
+        tree.put(b, 1);
+        Deque<Integer> deque = new ArrayDeque<>(list);
+        PriorityQueue<Integer> queue = new PriorityQueue<>(list);
+        int[] array = list.stream().mapToInt(Integer::intValue).sorted().toArray();
+        writer.println(String.format("%d %.2f", a + b, Math.sqrt(a)) + map + tree + deque + queue.peek()
+                + Arrays.toString(array) + list.stream().map(String::valueOf).collect(Collectors.joining(" "))
+                + BigInteger.valueOf(a).pow(b) + new BigDecimal("1.5").multiply(BigDecimal.TEN));
+        writer.flush();
+        System.out.println(new StringBuilder("ok").reverse());
+    }
+}
+"""
+JAVA_SAMPLE_INPUT = b"1\n2\n"
+
+
+def _stamp(*paths):
+    """可执行文件的实际路径, 大小和 mtime, 工具链更新时变化"""
+    stamp = []
+    for path in paths:
+        path = os.path.realpath(path)
+        st = os.stat(path)
+        stamp.append(f"{path} {st.st_size} {st.st_mtime_ns}")
+    return "\n".join(stamp)
+
+
+class GoBuildCache(object):
+    """编译用户独享的 Go 构建缓存
+
+    所有 go build 共用 GOCACHE, 标准库只需编译一次. 启动时由一个 worker 预编译标准库, 之后每隔
+    GO_CACHE_TRIM_INTERVAL 检查总大小, 超过 max_size 时按 mtime 删除最久未使用的条目(go 使用条目时会更新 mtime).
+    """
+
+    def __init__(self, cache_dir=GO_CACHE_DIR, max_size=GO_CACHE_MAX_SIZE):
+        self._cache_dir = cache_dir
+        self._max_size = max_size
+        self._lock = threading.Lock()
+        self._started = False
+        self.prewarmed = False
+        self.size = 0
+        self.trimmed = 0
+
+    def _prewarm(self):
+        subprocess.run(
+            [GO, "build", "std"],
+            check=True,
+            capture_output=True,
+            timeout=TOOLCHAIN_BUILD_TIMEOUT,
+            cwd="/tmp",
+            env={"PATH": os.getenv("PATH"), "GOCACHE": self._cache_dir, "GOPATH": "/tmp/go"},
+            user=COMPILER_USER_UID,
+            group=COMPILER_GROUP_GID,
+        )
+        self.prewarmed = True
+
+    def _trim(self):
+        entries = []
+        total = 0
+        for root, _, files in os.walk(self._cache_dir):
+            for name in files:
+                # go 的缓存条目以 -a(动作) 或 -d(输出) 结尾, 其余为 README, trim.txt 等
+                if not name.endswith(("-a", "-d")):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    st = os.lstat(path)
+                except FileNotFoundError:
+                    continue
+                total += st.st_size
+                entries.append((st.st_mtime, st.st_size, path))
+        if total > self._max_size:
+            entries.sort()
+            # 留出余量, 避免每次检查都要淘汰
+            target = self._max_size * 0.8
+            for _, size, path in entries:
+                if total <= target:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                total -= size
+                self.trimmed += 1
+        self.size = total
+
+    def _run(self):
+        os.makedirs(self._cache_dir, exist_ok=True)
+        lock_fd = os.open(os.path.join(self._cache_dir, ".lock"), os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            # 拿到锁的 worker 负责预热和淘汰, 其他 worker 每隔 GO_CACHE_TRIM_INTERVAL 重试, 负责的 worker 退出时接替
+            while True:
+                try:
+                    fcntl.flock(lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except BlockingIOError:
+                    time.sleep(GO_CACHE_TRIM_INTERVAL)
+            try:
+                self._prewarm()
+            except (OSError, subprocess.SubprocessError) as e:
+                logger.warning(f"Failed to prewarm go build cache: {e}")
+            while True:
+                try:
+                    self._trim()
+                except OSError as e:
+                    logger.warning(f"Failed to trim go build cache: {e}")
+                time.sleep(GO_CACHE_TRIM_INTERVAL)
+        finally:
+            os.close(lock_fd)
+
+    def start(self):
+        with self._lock:
+            if self._started:
+                return
+            threading.Thread(target=self._run, daemon=True).start()
+            self._started = True
+
+    def stats(self):
+        """只有负责预热的 worker 有数据"""
+        return {"prewarmed": self.prewarmed, "size": self.size, "trimmed": self.trimmed}
+
+
+class JavaCDS(object):
+    """javac 和 java 的 AppCDS 归档
+
+    先运行 javac 和 java 记录加载的 JDK 类, 再以 -Xshare:dump 生成静态归档, 归档中只有 JDK 的类, 不限制 classpath.
+    归档和生成时的 JDK 版本保存在 cds_dir/current 中, JDK 更新后不再使用, 由下次启动重新生成.
+    """
+
+    def __init__(self, cds_dir=JAVA_CDS_DIR, enabled=JAVA_CDS_ENABLED):
+        self._cds_dir = cds_dir
+        self._enabled = enabled
+        self._lock = threading.Lock()
+        self._started = False
+        self.hits = 0
+        self.misses = 0
+        self.builds = 0
+
+    @property
+    def _current(self):
+        return os.path.join(self._cds_dir, "current")
+
+    def _valid(self):
+        try:
+            with open(os.path.join(self._current, STAMP_NAME)) as f:
+                return f.read() == _stamp(JAVA, JAVAC)
+        except FileNotFoundError:
+            return False
+
+    @staticmethod
+    def _filter_class_list(class_list_path):
+        """去掉示例程序自身的类, 只保留 JDK 的类"""
+        with open(class_list_path) as f:
+            lines = f.read().splitlines()
+        kept = []
+        for line in lines:
+            fields = line.split()
+            if not fields:
+                continue
+            name = fields[1] if fields[0] == "@lambda-proxy" and len(fields) > 1 else fields[0]
+            if name.startswith("#") or name.startswith("@") or "/" in name:
+                kept.append(line)
+        with open(class_list_path, "w") as f:
+            f.write("\n".join(kept) + "\n")
+
+    def _build(self, tmp_dir):
+        def run(command, **kwargs):
+            subprocess.run(command, check=True, capture_output=True, timeout=TOOLCHAIN_BUILD_TIMEOUT, **kwargs)
+
+        src_path = os.path.join(tmp_dir, "Main.java")
+        with open(src_path, "w") as f:
+            f.write(JAVA_SAMPLE)
+        javac_list = os.path.join(tmp_dir, "javac.classlist")
+        java_list = os.path.join(tmp_dir, "java.classlist")
+        run([JAVAC, f"-J-XX:DumpLoadedClassList={javac_list}", src_path, "-d", tmp_dir])
+        run([JAVA, f"-XX:DumpLoadedClassList={java_list}", "-cp", tmp_dir, "Main"], input=JAVA_SAMPLE_INPUT)
+        for class_list in (javac_list, java_list):
+            self._filter_class_list(class_list)
+        # javac 启动器会附加自己的 JVM 参数, 归档也要经由它生成
+        run([
+            JAVAC, "-J-Xshare:dump", f"-J-XX:SharedClassListFile={javac_list}",
+            f"-J-XX:SharedArchiveFile={os.path.join(tmp_dir, 'javac.jsa')}",
+        ])
+        run([
+            JAVA, "-Xshare:dump", f"-XX:SharedClassListFile={java_list}",
+            f"-XX:SharedArchiveFile={os.path.join(tmp_dir, 'java.jsa')}",
+        ])
+        for name in os.listdir(tmp_dir):
+            if not name.endswith(".jsa"):
+                os.remove(os.path.join(tmp_dir, name))
+        with open(os.path.join(tmp_dir, STAMP_NAME), "w") as f:
+            f.write(_stamp(JAVA, JAVAC))
+        for name in os.listdir(tmp_dir):
+            os.chmod(os.path.join(tmp_dir, name), 0o644)
+        os.chmod(tmp_dir, 0o755)
+
+    def _run(self):
+        os.makedirs(self._cds_dir, mode=0o755, exist_ok=True)
+        lock_fd = os.open(os.path.join(self._cds_dir, ".lock"), os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            try:
+                fcntl.flock(lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                # 其他 worker 正在生成
+                return
+            if self._valid():
+                return
+            tmp_dir = os.path.join(self._cds_dir, ".tmp-" + uuid.uuid4().hex)
+            os.mkdir(tmp_dir)
+            try:
+                self._build(tmp_dir)
+                if os.path.exists(self._current):
+                    reaper.discard(self._current)
+                os.rename(tmp_dir, self._current)
+            except (OSError, subprocess.SubprocessError) as e:
+                logger.warning(f"Failed to build java cds archive: {e}")
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+                return
+            with self._lock:
+                self.builds += 1
+        finally:
+            os.close(lock_fd)
+
+    def start(self):
+        if not self._enabled:
+            return
+        with self._lock:
+            if self._started:
+                return
+            threading.Thread(target=self._run, daemon=True).start()
+            self._started = True
+
+    def _options(self, language_config, name, prefix):
+        if not self._enabled or not isinstance(language_config, JavaConfig):
+            return ""
+        hit = self._valid()
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+        if not hit:
+            return ""
+        # 归档无法使用时 -Xshare:auto 会忽略归档, 不输出日志以免混入程序输出
+        options = [f"-XX:SharedArchiveFile={os.path.join(self._current, name)}", "-Xshare:auto", "-Xlog:cds*=off"]
+        return " ".join(prefix + option for option in options)
+
+    def javac_options(self, language_config):
+        """替换 JavaConfig.compile_command 中 {cds_options} 的参数"""
+        return self._options(language_config, "javac.jsa", "-J")
+
+    def java_options(self, language_config):
+        """替换 JavaConfig.execute_command 中 {cds_options} 的参数"""
+        return self._options(language_config, "java.jsa", "")
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "builds": self.builds}
+
+
+go_build_cache = GoBuildCache()
+java_cds = JavaCDS()
@@ -0,0 +1,275 @@
+import functools
+import gzip
+import hashlib
+import json
+import os
+import re
+import tarfile
+import uuid
+
+import zstandard
+from werkzeug.sansio.multipart import Data, Epilogue, Field, File, MultipartDecoder, NeedData
+
+from config import UPLOAD_DIR, UPLOAD_MAX_SIZE
+from exception import JudgeClientError
+from output_hash import OutputHasher
+from reaper import reaper
+
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+# 上传的测试用例文件名, 与内联测试用例写入的文件名一致
+TEST_CASE_FILE_NAME = re.compile(r"^([1-9][0-9]*)\.(in|out)$")
+# multipart 的表单字段 / tar 中的文件名, 内容为 JSON 格式的其余参数
+DATA_NAME = "data"
+DATA_MAX_SIZE = 16 * 1024 * 1024  # data 在内存中解析, 单独限制大小
+
+
+class _TestCaseFileWriter(object):
+    """写入测试用例文件, 写入时计算大小, sha256, 输出文件还计算 rstrip 后的 md5 和去除所有空白字符后的 md5"""
+
+    def __init__(self, path, compute_md5):
+        self._f = open(path, "w+b")
+        self._sha256 = hashlib.sha256()
+        self._hasher = OutputHasher(self._f) if compute_md5 else None
+        self.size = 0
+
+    def write(self, chunk):
+        self._f.write(chunk)
+        self._sha256.update(chunk)
+        self.size += len(chunk)
+        if self._hasher is not None:
+            self._hasher.update(chunk)
+
+    def close(self):
+        self._f.close()
+
+    @property
+    def sha256(self):
+        return self._sha256.hexdigest()
+
+    @property
+    def output_md5(self):
+        return self._hasher.output_md5
+
+    @property
+    def stripped_output_md5(self):
+        return self._hasher.stripped_output_md5
+
+
+class _LimitedReader(object):
+    """请求体(压缩时为解压后的内容), 读取超过 max_bytes 字节时报错"""
+
+    def __init__(self, stream, max_bytes):
+        self._stream = stream
+        self._remaining = max_bytes
+
+    def read(self, size=-1):
+        if size is None or size < 0 or size > self._remaining:
+            # 多读一个字节用于判断是否超过限制
+            size = self._remaining + 1
+        data = self._stream.read(size)
+        self._remaining -= len(data)
+        if self._remaining < 0:
+            raise JudgeClientError("request body too large")
+        return data
+
+
+class UploadedTestCase(object):
+    """以 multipart 或 tar 上传的测试用例, 解析请求时直接写入磁盘, 评测时作为测试用例目录使用"""
+
+    def __init__(self, upload_dir=UPLOAD_DIR):
+        self.path = os.path.join(upload_dir, uuid.uuid4().hex)
+        os.makedirs(upload_dir, exist_ok=True)
+        os.mkdir(self.path, 0o700)
+        self._files = {}
+        self._discarded = False
+
+    def __bool__(self):
+        return True
+
+    def write(self, name, stream):
+        """把 stream 的内容写入名为 name 的测试用例文件"""
+        writer = self.open(name)
+        try:
+            while True:
+                chunk = stream.read(UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                writer.write(chunk)
+        finally:
+            writer.close()
+
+    def open(self, name):
+        if not TEST_CASE_FILE_NAME.match(name) or name in self._files:
+            raise JudgeClientError(f"invalid test case file name {name}")
+        writer = _TestCaseFileWriter(os.path.join(self.path, name), compute_md5=name.endswith(".out"))
+        self._files[name] = writer
+        return writer
+
+    def _test_case_files(self):
+        """按用例顺序返回 [(输入文件, 输出文件)]"""
+        indexes = sorted({int(TEST_CASE_FILE_NAME.match(name).group(1)) for name in self._files})
+        if not indexes or indexes != list(range(1, len(indexes) + 1)):
+            raise JudgeClientError("test case files must be numbered from 1")
+        test_case_files = []
+        for index in indexes:
+            input_file = self._files.get(f"{index}.in")
+            output_file = self._files.get(f"{index}.out")
+            if input_file is None or output_file is None:
+                raise JudgeClientError(f"test case {index} requires both {index}.in and {index}.out")
+            test_case_files.append((input_file, output_file))
+        return test_case_files
+
+    def file_hashes(self):
+        """按用例顺序返回 [(输入的 sha256, 输出的 sha256)], 用于 TestCaseStore.make_key"""
+        return [(input_file.sha256, output_file.sha256) for input_file, output_file in self._test_case_files()]
+
+    def write_info(self, is_spj):
+        """生成 info, 格式与内联测试用例相同"""
+        test_case_files = self._test_case_files()
+        info = {
+            "test_case_number": len(test_case_files),
+            "spj": is_spj,
+            "test_cases": {},
+        }
+        for index, (input_file, output_file) in enumerate(test_case_files, 1):
+            info["test_cases"][index] = {
+                "input_name": f"{index}.in",
+                "input_size": input_file.size,
+                "output_name": f"{index}.out",
+                "output_md5": output_file.output_md5,
+                "output_size": output_file.size,
+                "stripped_output_md5": output_file.stripped_output_md5,
+            }
+        with open(os.path.join(self.path, "info"), "w") as f:
+            json.dump(info, f)
+
+    def detach(self):
+        """目录已移入测试用例存储, 之后不再删除"""
+        self._discarded = True
+        return self.path
+
+    def discard(self):
+        if not self._discarded:
+            self._discarded = True
+            reaper.discard(self.path)
+
+
+def discard_uploaded_test_case(func):
+    """函数返回后删除作为 test_case 参数传入的上传测试用例, 同步, 异步和流式评测都会经过这里"""
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        try:
+            return func(*args, **kwargs)
+        finally:
+            test_case = kwargs.get("test_case")
+            if isinstance(test_case, UploadedTestCase):
+                test_case.discard()
+
+    return wrapper
+
+
+def open_body(stream, content_encoding, max_bytes=UPLOAD_MAX_SIZE):
+    """按 Content-Encoding 返回可以流式读取的请求体, (解压后)超过 max_bytes 字节时报错"""
+    if not content_encoding or content_encoding == "identity":
+        return _LimitedReader(stream, max_bytes)
+    if content_encoding == "gzip":
+        return _LimitedReader(gzip.GzipFile(fileobj=stream, mode="rb"), max_bytes)
+    if content_encoding == "zstd":
+        return _LimitedReader(zstandard.ZstdDecompressor().stream_reader(stream), max_bytes)
+    raise JudgeClientError(f"unsupported content encoding {content_encoding}")
+
+
+def _read_multipart(body, boundary):
+    if not boundary:
+        raise JudgeClientError("missing multipart boundary")
+    decoder = MultipartDecoder(boundary.encode("latin-1"))
+    uploaded = UploadedTestCase()
+    data = None
+    field = None  # 当前 "data" 字段的内容
+    writer = None  # 当前测试用例文件
+    try:
+        while True:
+            event = decoder.next_event()
+            if isinstance(event, NeedData):
+                decoder.receive_data(body.read(UPLOAD_CHUNK_SIZE) or None)
+            elif isinstance(event, (Field, File)):
+                if event.name == DATA_NAME:
+                    field = bytearray()
+                else:
+                    writer = uploaded.open(event.name or "")
+            elif isinstance(event, Data):
+                if writer is not None:
+                    writer.write(event.data)
+                    if not event.more_data:
+                        writer.close()
+                        writer = None
+                elif field is not None:
+                    field += event.data
+                    if len(field) > DATA_MAX_SIZE:
+                        raise JudgeClientError(f"field {DATA_NAME} too large")
+                    if not event.more_data:
+                        data = json.loads(field)
+                        field = None
+            elif isinstance(event, Epilogue):
+                break
+        if data is None:
+            raise JudgeClientError(f"missing field {DATA_NAME}")
+    except Exception as e:
+        if writer is not None:
+            writer.close()
+        uploaded.discard()
+        if isinstance(e, ValueError):
+            # multipart 格式错误或 data 不是合法的 JSON
+            raise JudgeClientError(f"invalid multipart body: {e}")
+        raise
+    return data, uploaded
+
+
+def _read_tar(body):
+    uploaded = UploadedTestCase()
+    data = None
+    try:
+        with tarfile.open(fileobj=body, mode="r|") as tar:
+            for member in tar:
+                if member.isdir():
+                    continue
+                if not member.isfile():
+                    raise JudgeClientError(f"unexpected tar member {member.name}")
+                # 兼容 tar -C dir . 打包产生的 ./1.in
+                name = os.path.normpath(member.name)
+                if name == DATA_NAME:
+                    if member.size > DATA_MAX_SIZE:
+                        raise JudgeClientError(f"tar member {DATA_NAME} too large")
+                    data = json.load(tar.extractfile(member))
+                else:
+                    uploaded.write(name, tar.extractfile(member))
+        if data is None:
+            raise JudgeClientError(f"missing tar member {DATA_NAME}")
+    except Exception as e:
+        uploaded.discard()
+        if isinstance(e, (tarfile.TarError, ValueError)):
+            raise JudgeClientError(f"invalid tar body: {e}")
+        raise
+    return data, uploaded
+
+
+def read_request(request):
+    """读取请求参数
+
+    除 JSON 外还支持两种上传测试用例的格式, 测试用例文件边接收边写入磁盘:
+    multipart/form-data: 字段 data 为 JSON 格式的参数, 文件字段名为 1.in, 1.out, 2.in ...
+    application/x-tar: tar 中的 data 文件为 JSON 格式的参数, 其余文件为 1.in, 1.out, 2.in ...
+    请求体可以使用 Content-Encoding: gzip 或 zstd 压缩
+
+    :return: (参数, UploadedTestCase), 没有上传测试用例时后者为 None
+    """
+    content_encoding = request.headers.get("Content-Encoding")
+    if request.mimetype == "multipart/form-data":
+        body = open_body(request.stream, content_encoding)
+        return _read_multipart(body, request.mimetype_params.get("boundary"))
+    if request.mimetype == "application/x-tar":
+        return _read_tar(open_body(request.stream, content_encoding))
+    if content_encoding:
+        return json.load(open_body(request.stream, content_encoding)), None
+    return request.json, None
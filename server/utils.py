@@ -1,13 +1,15 @@
 import hashlib
 import logging.handlers
 import os
+import shutil
 import socket
+import time
 
 import judger
 import psutil
 
-from config import DEBUG, SERVER_LOG_PATH
-from exception import JudgeClientError
+from config import DEBUG, SERVER_LOG_PATH, STALE_TMP_AGE
+from exception import JudgeClientError, JudgeServerException
 
 logger = logging.getLogger(__name__)
 handler = logging.handlers.RotatingFileHandler(SERVER_LOG_PATH, maxBytes=10 * 1024 * 1024, backupCount=5)
@@ -29,6 +31,43 @@ def server_info():
             "judger_version": ".".join([str((ver >> 16) & 0xff), str((ver >> 8) & 0xff), str(ver & 0xff)])}
 
 
+def exception_info(e):
+    """将异常转换为接口返回的 err 和 data"""
+    if isinstance(e, JudgeServerException):
+        return e.__class__.__name__, e.message
+    return "JudgeClientError", e.__class__.__name__ + " :" + str(e)
+
+
+def dir_size(path):
+    """目录下所有文件的大小之和"""
+    size = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                size += os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                pass
+    return size
+
+
+def remove_stale_tmp(base_dir, max_age=STALE_TMP_AGE):
+    """删除 base_dir 下超过 max_age 秒未修改的 .tmp-* 文件或目录, 它们是写入过程中崩溃遗留的"""
+    deadline = time.time() - max_age
+    with os.scandir(base_dir) as it:
+        for entry in it:
+            if not entry.name.startswith(".tmp-"):
+                continue
+            try:
+                if entry.stat(follow_symlinks=False).st_mtime > deadline:
+                    continue
+                if entry.is_dir(follow_symlinks=False):
+                    shutil.rmtree(entry.path, ignore_errors=True)
+                else:
+                    os.remove(entry.path)
+            except FileNotFoundError:
+                pass
+
+
 def get_token():
     token = os.environ.get("TOKEN")
     if not token:
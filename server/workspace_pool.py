@@ -0,0 +1,174 @@
+import collections
+import os
+import threading
+import uuid
+
+import psutil
+
+from config import (
+    COMPILER_USER_UID,
+    JUDGER_WORKSPACE_BASE,
+    RUN_GROUP_GID,
+    WORKSPACE_POOL_SIZE,
+)
+from reaper import reaper
+from utils import logger
+
+TEST_CASE_DIR_NAME = "inline_test_case"
+
+
+class WorkspacePool(object):
+    """预先创建好的评测目录
+
+    目录按 <pid>-<进程启动时间>-<uuid> 命名, 已设置好属主和权限, 并包含内联测试用例目录. 每次取出时重命名, 每次评测的路径都不相同.
+    file 模式下各用例的输出目录由评测时创建.
+    评测结束后目录交给后台线程清空并恢复属主和权限, 再放回池中; 出现意外内容(例如用户程序创建的多层目录)时交给 reaper 删除.
+    """
+
+    def __init__(self, workspace=JUDGER_WORKSPACE_BASE, size=WORKSPACE_POOL_SIZE):
+        self._workspace = workspace
+        self._size = size
+        self._free = collections.deque()
+        self._dirty = collections.deque()
+        self._wakeup = threading.Event()
+        self._lock = threading.Lock()
+        self._started = False
+        self._owner = None
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def enabled(self):
+        return self._size > 0
+
+    @staticmethod
+    def _process_owner(process):
+        return f"{process.pid}-{process.create_time()}"
+
+    def _new_name(self):
+        return f"{self._owner}-{uuid.uuid4().hex}"
+
+    def start(self):
+        with self._lock:
+            if self._started:
+                return
+            # gunicorn fork 之后才记录, 各 worker 不同
+            self._owner = self._process_owner(psutil.Process())
+            if self.enabled:
+                self._collect_orphans()
+                threading.Thread(target=self._run, daemon=True).start()
+            self._started = True
+
+    def _collect_orphans(self):
+        # 已退出的 worker 池中的目录不会再被使用, worker 重启后 pid 可能被复用, 同时比较进程启动时间
+        for name in os.listdir(self._workspace):
+            pid, _, rest = name.partition("-")
+            owner = f"{pid}-{rest.partition('-')[0]}"
+            try:
+                alive = self._process_owner(psutil.Process(int(pid))) == owner
+            except psutil.NoSuchProcess:
+                alive = False
+            except (ValueError, psutil.Error):
+                continue
+            if not alive:
+                reaper.discard(os.path.join(self._workspace, name))
+
+    def _provision(self, name, init_test_case_dir=True):
+        work_dir = os.path.join(self._workspace, name)
+        os.mkdir(work_dir)
+        if init_test_case_dir:
+            os.mkdir(os.path.join(work_dir, TEST_CASE_DIR_NAME))
+        os.chown(work_dir, COMPILER_USER_UID, RUN_GROUP_GID)
+        os.chmod(work_dir, 0o711)
+
+    def _scrub(self, name):
+        """清空目录并恢复属主和权限, 返回 False 表示目录无法复用"""
+        work_dir = os.path.join(self._workspace, name)
+        found_test_case_dir = False
+        for entry in os.scandir(work_dir):
+            if not entry.is_dir(follow_symlinks=False):
+                os.unlink(entry.path)
+                continue
+            for child in os.scandir(entry.path):
+                if child.is_dir(follow_symlinks=False):
+                    return False
+                os.unlink(child.path)
+            if entry.name == TEST_CASE_DIR_NAME:
+                found_test_case_dir = True
+            else:
+                # file 模式的用例目录
+                os.rmdir(entry.path)
+        if not found_test_case_dir:
+            return False
+        test_case_dir = os.path.join(work_dir, TEST_CASE_DIR_NAME)
+        os.chown(test_case_dir, 0, 0)
+        os.chmod(test_case_dir, 0o755)
+        # spj 会把评测目录的属主改为 spj 用户
+        os.chown(work_dir, COMPILER_USER_UID, RUN_GROUP_GID)
+        os.chmod(work_dir, 0o711)
+        return True
+
+    def _refill(self):
+        while self._dirty:
+            name = self._dirty.popleft()
+            try:
+                reusable = len(self._free) < self._size and self._scrub(name)
+            except OSError as e:
+                logger.warning(f"Failed to scrub workspace {name}: {e}")
+                reusable = False
+            if reusable:
+                self._free.append(name)
+            else:
+                reaper.discard(os.path.join(self._workspace, name))
+        while len(self._free) < self._size:
+            name = self._new_name()
+            self._provision(name)
+            self._free.append(name)
+
+    def _run(self):
+        while True:
+            try:
+                self._refill()
+            except Exception as e:
+                logger.exception(e)
+            self._wakeup.wait()
+            self._wakeup.clear()
+
+    def lease(self, init_test_case_dir=False):
+        """取出一个评测目录, 池为空时直接创建
+
+        :return: (评测目录, 内联测试用例目录), 不需要测试用例目录时后者为 None
+        """
+        self.start()
+        name = self._new_name()
+        try:
+            # 用例目录和 .pyc 中记录的路径包含目录名, 每次评测使用新的名称
+            os.rename(os.path.join(self._workspace, self._free.popleft()), os.path.join(self._workspace, name))
+            hit = True
+        except (IndexError, OSError):
+            self._provision(name, init_test_case_dir=init_test_case_dir)
+            hit = False
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+        self._wakeup.set()
+        work_dir = os.path.join(self._workspace, name)
+        test_case_dir = os.path.join(work_dir, TEST_CASE_DIR_NAME) if init_test_case_dir else None
+        return work_dir, test_case_dir
+
+    def release(self, work_dir):
+        """归还评测目录, 目录在后台清理"""
+        if not self.enabled:
+            reaper.discard(work_dir)
+            return
+        self._dirty.append(os.path.basename(work_dir))
+        self._wakeup.set()
+
+    def stats(self):
+        with self._lock:
+            return {"free": len(self._free), "hits": self.hits, "misses": self.misses}
+
+
+workspace_pool = WorkspacePool()
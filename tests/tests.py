@@ -3,9 +3,16 @@ from __future__ import unicode_literals
 from os import sys, path
 sys.path.append(path.dirname(path.dirname(path.abspath(__file__))))
 
+import hashlib
+import hmac
 import json
+import os
+import re
+import threading
+import time
 import unittest
 import requests
+from http.server import BaseHTTPRequestHandler, HTTPServer
 
 from client.app import JudgeServerClient, JudgeServerClientError
 
@@ -42,5 +49,230 @@ class JudgeServerTest(unittest.TestCase):
         data = client.ping()
         self.assertEqual(data["err"], "TokenVerificationFailed")
 
+    def test_async_judge(self):
+        src = "#include <stdio.h>\nint main(){int a, b; scanf(\"%d%d\", &a, &b); printf(\"%d\\n\", a+b); return 0;}"
+        data = self.client._request(self.server_base_url + "/judge",
+                                    data={"async": True, "language": "c", "src": src, "max_cpu_time": 1000,
+                                          "max_real_time": 2000, "max_memory": 128 * 1024 * 1024,
+                                          "test_case_id": "normal"})
+        self.assertEqual(data["err"], None)
+        job_id = data["data"]["job_id"]
+        for _ in range(100):
+            data = self.client._request(self.server_base_url + "/result/" + job_id)
+            if data["data"]["status"] == "done":
+                break
+            time.sleep(0.1)
+        self.assertEqual(data["data"]["status"], "done")
+        self.assertEqual(data["data"]["err"], None)
+        self.assertEqual(data["data"]["data"][0]["result"], 0)
+
+    def test_async_judge_callback(self):
+        # judge server 需要能访问到本机, 在容器中运行时通过 JUDGE_TEST_CALLBACK_HOST 指定本机地址
+        callbacks = []
+
+        class CallbackHandler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers["Content-Length"]))
+                callbacks.append((self.headers.get("X-Judge-Server-Signature"), body))
+                self.send_response(200)
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        callback_server = HTTPServer(("0.0.0.0", 0), CallbackHandler)
+        threading.Thread(target=callback_server.serve_forever, daemon=True).start()
+        try:
+            callback_url = "http://%s:%d/callback" % (os.getenv("JUDGE_TEST_CALLBACK_HOST", "127.0.0.1"),
+                                                      callback_server.server_address[1])
+            src = "#include <stdio.h>\nint main(){int a, b; scanf(\"%d%d\", &a, &b); printf(\"%d\\n\", a+b); return 0;}"
+            data = self.client._request(self.server_base_url + "/judge",
+                                        data={"async": True, "callback_url": callback_url, "language": "c",
+                                              "src": src, "max_cpu_time": 1000, "max_real_time": 2000,
+                                              "max_memory": 128 * 1024 * 1024, "test_case_id": "normal"})
+            self.assertEqual(data["err"], None)
+            for _ in range(100):
+                if callbacks:
+                    break
+                time.sleep(0.1)
+        finally:
+            callback_server.shutdown()
+        self.assertEqual(len(callbacks), 1)
+        signature, body = callbacks[0]
+        # 回调只带请求体的签名, 不带 token
+        self.assertEqual(signature, hmac.new(self.token.encode("utf-8"), body, hashlib.sha256).hexdigest())
+        job = json.loads(body)
+        self.assertEqual(job["job_id"], data["data"]["job_id"])
+        self.assertEqual(job["status"], "done")
+        self.assertEqual(job["data"][0]["result"], 0)
+
+    def test_stream_judge(self):
+        src = "#include <stdio.h>\nint main(){int a, b; scanf(\"%d%d\", &a, &b); printf(\"%d\\n\", a+b); return 0;}"
+        resp = requests.post(self.server_base_url + "/judge",
+                             headers={"X-Judge-Server-Token": self.client.token, "Content-Type": "application/json"},
+                             data=json.dumps({"stream": True, "language": "c", "src": src, "max_cpu_time": 1000,
+                                              "max_real_time": 2000, "max_memory": 128 * 1024 * 1024,
+                                              "test_case_id": "normal"}),
+                             stream=True)
+        records = [json.loads(line) for line in resp.iter_lines() if line]
+        self.assertEqual([record["type"] for record in records], ["test_case", "summary"])
+        self.assertEqual(records[0]["data"]["result"], 0)
+        self.assertEqual(records[-1]["err"], None)
+
+    def test_judge_ignores_on_result(self):
+        src = "#include <stdio.h>\nint main(){int a, b; scanf(\"%d%d\", &a, &b); printf(\"%d\\n\", a+b); return 0;}"
+        params = {"language": "c", "src": src, "max_cpu_time": 1000, "max_real_time": 2000,
+                  "max_memory": 128 * 1024 * 1024, "test_case_id": "normal", "on_result": 1}
+        data = self.client._request(self.server_base_url + "/judge", data=params)
+        self.assertEqual(data["err"], None)
+        self.assertEqual(data["data"][0]["result"], 0)
+        resp = requests.post(self.server_base_url + "/judge",
+                             headers={"X-Judge-Server-Token": self.client.token, "Content-Type": "application/json"},
+                             data=json.dumps(dict(params, stream=True)), stream=True)
+        records = [json.loads(line) for line in resp.iter_lines() if line]
+        self.assertEqual(records[-1]["err"], None)
+
+    def test_judge_batch(self):
+        src = "#include <stdio.h>\nint main(){int a, b; scanf(\"%d%d\", &a, &b); printf(\"%d\\n\", a+b); return 0;}"
+        limits = {"max_cpu_time": 1000, "max_real_time": 2000, "max_memory": 128 * 1024 * 1024}
+        data = self.client._request(self.server_base_url + "/judge_batch",
+                                    data={"language": "c", "src": src,
+                                          "jobs": [dict(limits, test_case_id="normal"),
+                                                   dict(limits, test_case=[{"input": "1 2", "output": "3"},
+                                                                           {"input": "2 2", "output": "5"}])]})
+        self.assertEqual(data["err"], None)
+        self.assertEqual([job["err"] for job in data["data"]], [None, None])
+        self.assertEqual(data["data"][0]["data"][0]["result"], 0)
+        self.assertEqual([item["result"] for item in data["data"][1]["data"]], [0, -1])
+
+    def test_judge_batch_compile_error(self):
+        limits = {"max_cpu_time": 1000, "max_real_time": 2000, "max_memory": 128 * 1024 * 1024}
+        data = self.client._request(self.server_base_url + "/judge_batch",
+                                    data={"language": "c", "src": "int main(){",
+                                          "jobs": [dict(limits, test_case_id="normal"),
+                                                   dict(limits, test_case=[{"input": "1 2", "output": "3"}])]})
+        self.assertEqual(data["err"], "CompileError")
+
+    def _judge_with_checker(self, src, test_case, checker):
+        data = self.client._request(self.server_base_url + "/judge",
+                                    data={"language": "py", "src": src, "max_cpu_time": 1000, "max_real_time": 2000,
+                                          "max_memory": 128 * 1024 * 1024, "test_case": test_case,
+                                          "checker": checker})
+        self.assertEqual(data["err"], None)
+        return [item["result"] for item in data["data"]]
+
+    def test_checker_tokens(self):
+        src = "a, b = map(int, input().split())\nprint(a + b, '', a * b, end='  \\n\\n')"
+        test_case = [{"input": "1 2", "output": "3\n2"}, {"input": "2 2", "output": "4 5"}]
+        self.assertEqual(self._judge_with_checker(src, test_case, "tokens"), [0, -1])
+        self.assertEqual(self._judge_with_checker("print('HeLLo World')", [{"input": "", "output": "hello\nworld"}],
+                                                  "tokens_ci"), [0])
+
+    def test_checker_float(self):
+        src = "print(1 / float(input()))"
+        test_case = [{"input": "3", "output": "0.3333334"}, {"input": "3", "output": "0.3334"}]
+        self.assertEqual(self._judge_with_checker(src, test_case, "float"), [0, -1])
+        self.assertEqual(self._judge_with_checker(src, test_case, {"type": "float", "eps": 1e-3}), [0, 0])
+
+    def test_checker_lines_unordered(self):
+        src = "print('b  \\n\\na')"
+        test_case = [{"input": "", "output": "a\nb\n"}, {"input": "", "output": "a\na\nb"}]
+        self.assertEqual(self._judge_with_checker(src, test_case, "lines_unordered"), [0, -1])
+
+    def test_max_failures(self):
+        src = "if input() == 'loop':\n    while True:\n        pass\nprint(0)"
+        params = {"language": "py", "src": src, "max_cpu_time": 10000, "max_real_time": 20000,
+                  "max_memory": 128 * 1024 * 1024,
+                  "test_case": [{"input": "wa", "output": "1"}, {"input": "loop", "output": "0"}]}
+        start = time.time()
+        data = self.client._request(self.server_base_url + "/judge", data=dict(params, max_failures=1))
+        self.assertEqual(data["err"], None)
+        # 第一个用例未通过后中止仍在运行的用例
+        self.assertEqual([item["result"] for item in data["data"]], [-1, -3])
+        self.assertLess(time.time() - start, 10)
+        for max_failures in (0, -1, 1.5, "1"):
+            data = self.client._request(self.server_base_url + "/judge", data=dict(params, max_failures=max_failures))
+            self.assertEqual(data["err"], "JudgeClientError")
+
+    def test_result_cache(self):
+        # 需要开启结果缓存(RESULT_CACHE_MAX_SIZE_MB > 0), 编译产物中带时间戳避免命中之前的测试留下的条目
+        src = "#include <stdio.h>\nint main(){int a, b; scanf(\"%d%d\", &a, &b); printf(\"%d\\n\", a+b); return 0;}\n"
+        src += f"char tag[] = \"{time.time()}\";\n"
+        params = {"language": "c", "src": src, "max_cpu_time": 1000, "max_real_time": 2000,
+                  "max_memory": 128 * 1024 * 1024, "test_case_id": "normal", "use_result_cache": True}
+        first = self.client._request(self.server_base_url + "/judge", data=params)
+        self.assertEqual(first["err"], None)
+        self.assertFalse(any(item.get("cached") for item in first["data"]))
+        second = self.client._request(self.server_base_url + "/judge", data=params)
+        self.assertEqual(second["err"], None)
+        self.assertTrue(all(item.get("cached") for item in second["data"]))
+        self.assertEqual([item["result"] for item in second["data"]], [item["result"] for item in first["data"]])
+
+    def test_upload_test_case(self):
+        src = "#include <stdio.h>\nint main(){int a, b; scanf(\"%d%d\", &a, &b); printf(\"%d\\n\", a+b); return 0;}"
+        params = {"language": "c", "src": src, "max_cpu_time": 1000, "max_real_time": 2000,
+                  "max_memory": 128 * 1024 * 1024}
+        resp = requests.post(self.server_base_url + "/judge",
+                             headers={"X-Judge-Server-Token": self.client.token},
+                             files=[("data", (None, json.dumps(params))),
+                                    ("1.in", ("1.in", b"1 2\n")), ("1.out", ("1.out", b"3\n")),
+                                    ("2.in", ("2.in", b"2 2\n")), ("2.out", ("2.out", b"5\n"))])
+        data = resp.json()
+        self.assertEqual(data["err"], None)
+        self.assertEqual([item["result"] for item in data["data"]], [0, -1])
+
+    def test_judge_by_test_case_hash(self):
+        src = "#include <stdio.h>\nint main(){int a, b; scanf(\"%d%d\", &a, &b); printf(\"%d\\n\", a+b); return 0;}"
+        test_case = [{"input": "3 4", "output": "7"}]
+        params = {"language": "c", "src": src, "max_cpu_time": 1000, "max_real_time": 2000,
+                  "max_memory": 128 * 1024 * 1024}
+        key = hashlib.sha256(b"spj=0\n")
+        for item in test_case:
+            key.update((hashlib.sha256(item["input"].encode("utf-8")).hexdigest() + " " +
+                        hashlib.sha256(item["output"].encode("utf-8")).hexdigest() + "\n").encode("utf-8"))
+        data = self.client._request(self.server_base_url + "/judge", data=dict(params, test_case_hash="0" * 64))
+        self.assertEqual(data["err"], "TestCaseNotFound")
+        data = self.client._request(self.server_base_url + "/judge", data=dict(params, test_case=test_case))
+        self.assertEqual(data["data"][0]["result"], 0)
+        data = self.client._request(self.server_base_url + "/judge", data=dict(params, test_case_hash=key.hexdigest()))
+        self.assertEqual(data["err"], None)
+        self.assertEqual(data["data"][0]["result"], 0)
+
+    def test_spj_source_not_found(self):
+        src = "#include <stdio.h>\nint main(){int a, b; scanf(\"%d%d\", &a, &b); printf(\"%d\\n\", a+b); return 0;}"
+        data = self.client._request(self.server_base_url + "/judge",
+                                    data={"language": "c", "src": src, "max_cpu_time": 1000, "max_real_time": 2000,
+                                          "max_memory": 128 * 1024 * 1024, "test_case_id": "spj",
+                                          "spj_version": "missing-" + str(time.time())})
+        self.assertEqual(data["err"], "SPJCompileError")
+
+    def test_metrics(self):
+        src = "#include <stdio.h>\nint main(){int a, b; scanf(\"%d%d\", &a, &b); printf(\"%d\\n\", a+b); return 0;}"
+        data = self.client._request(self.server_base_url + "/judge",
+                                    data={"language": "c", "src": src, "max_cpu_time": 1000, "max_real_time": 2000,
+                                          "max_memory": 128 * 1024 * 1024, "test_case_id": "normal"})
+        self.assertEqual(data["err"], None)
+        # 其他 worker 的数据定期写入磁盘, 等待评测所在的 worker 写入
+        pattern = re.compile(r'^judge_stage_duration_seconds_count\{stage="run",language="c",verdict="0"\} (\d+)$',
+                             re.MULTILINE)
+        count = 0
+        for _ in range(30):
+            resp = requests.get(self.server_base_url + "/metrics", headers={"X-Judge-Server-Token": self.client.token})
+            self.assertEqual(resp.status_code, 200)
+            match = pattern.search(resp.text)
+            count = int(match.group(1)) if match else 0
+            if count:
+                break
+            time.sleep(0.5)
+        self.assertGreater(count, 0)
+
+    def test_metrics_invalid_token(self):
+        resp = requests.get(self.server_base_url + "/metrics", headers={"X-Judge-Server-Token": "wrong token"})
+        self.assertEqual(resp.json()["err"], "TokenVerificationFailed")
+
+    def test_async_result_not_found(self):
+        data = self.client._request(self.server_base_url + "/result/" + "0" * 32)
+        self.assertEqual(data["err"], "JobNotFound")
+
 if __name__ == '__main__':
     unittest.main()
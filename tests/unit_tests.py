@@ -0,0 +1,657 @@
+# coding=utf-8
+"""直接测试 server 下的模块, 需要在评测镜像内以 root 运行(依赖 judger 和 compiler/code/spj 用户)
+
+    TOKEN=... JUDGE_SERVER_DIR=/app python3 tests/unit_tests.py
+"""
+import fcntl
+import gzip
+import hashlib
+import io
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tarfile
+import tempfile
+import threading
+import time
+import unittest
+import uuid
+
+import psutil
+import zstandard
+from werkzeug.test import EnvironBuilder
+from werkzeug.wrappers import Request
+
+SERVER_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "server")
+sys.path.insert(0, os.getenv("JUDGE_SERVER_DIR") or SERVER_DIR)
+
+import judger  # noqa: E402
+from compile_cache import CompileCache  # noqa: E402
+from config import (  # noqa: E402
+    COMPILER_GROUP_GID,
+    COMPILER_USER_UID,
+    JUDGER_PATH,
+    RUN_USER_UID,
+    STALE_TMP_AGE,
+    TEST_CASE_STORE_EVICT_INTERVAL,
+)
+from exception import JudgeClientError  # noqa: E402
+from job_queue import JobQueue, JobStatus  # noqa: E402
+from output_hash import output_md5  # noqa: E402
+from javac_server import JavacServer  # noqa: E402
+from judge_client import _run_in_dir  # noqa: E402
+from languages import CppConfig, JavaConfig  # noqa: E402
+from page_cache import PageCacheWarmer  # noqa: E402
+from pch import INCLUDE_SCAN_SIZE, PrecompiledHeaders  # noqa: E402
+from result_cache import hash_artifacts, hash_test_case  # noqa: E402
+from scheduler import CompileScheduler, HostSlots  # noqa: E402
+from staging import StageStrategy, stage_file  # noqa: E402
+from test_case_store import TestCaseStore  # noqa: E402
+from test_case_sync import TestCaseSync  # noqa: E402
+from upload import DATA_MAX_SIZE, UploadedTestCase, open_body, read_request  # noqa: E402
+from workspace_pool import WorkspacePool  # noqa: E402
+
+
+class TempDirTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+
+class CompileCacheTest(TempDirTestCase):
+    def _store(self, cache, key, mtime):
+        output_dir = os.path.join(self.tmp_dir, "output")
+        os.makedirs(output_dir, exist_ok=True)
+        with open(os.path.join(output_dir, "main"), "wb") as f:
+            f.write(b"\0" * 100)
+        cache._store(key, output_dir, ["main"])
+        os.utime(os.path.join(self.tmp_dir, "cache", key), (mtime, mtime))
+
+    def test_evict(self):
+        cache_dir = os.path.join(self.tmp_dir, "cache")
+        os.makedirs(cache_dir)
+        cache = CompileCache(cache_dir=cache_dir, max_size=300)
+        for index in range(3):
+            self._store(cache, f"key{index}", 1000 + index)
+        # 崩溃遗留的临时目录, 超时的被清理
+        stale = os.path.join(cache_dir, ".tmp-stale")
+        fresh = os.path.join(cache_dir, ".tmp-fresh")
+        os.makedirs(stale)
+        os.makedirs(fresh)
+        os.utime(stale, (time.time() - STALE_TMP_AGE - 1,) * 2)
+        self._store(cache, "key3", 1003)
+        cache._evict()
+        self.assertEqual(sorted(os.listdir(cache_dir)), [".lock", ".tmp-fresh", "key1", "key2", "key3"])
+
+
+class CompileSchedulerTest(TempDirTestCase):
+    def setUp(self):
+        super().setUp()
+        self._lock = threading.Lock()
+        self._active = 0
+        self.max_active = 0
+        self.ran = []
+
+    def _task(self, name, event=None):
+        with self._lock:
+            self._active += 1
+            self.max_active = max(self.max_active, self._active)
+        if event is None:
+            time.sleep(0.1)
+        else:
+            event.wait(5)
+        with self._lock:
+            self._active -= 1
+            self.ran.append(name)
+        return name
+
+    def _run_all(self, scheduler, memories):
+        futures = [scheduler.submit(memory, self._task, index) for index, memory in enumerate(memories)]
+        return [future.result(timeout=5) for future in futures]
+
+    def test_concurrency(self):
+        scheduler = CompileScheduler(slot_num=2, slot_dir=self.tmp_dir, memory_budget=0)
+        self.assertEqual(self._run_all(scheduler, [1] * 6), list(range(6)))
+        self.assertEqual(self.max_active, 2)
+
+    def test_slot_held_by_other_process(self):
+        # 其他 worker 占用的槽位不可用, 选择第一个空闲的槽位
+        scheduler = CompileScheduler(slot_num=2, slot_dir=self.tmp_dir, memory_budget=0)
+        fd = os.open(os.path.join(self.tmp_dir, "slot-0"), os.O_RDWR | os.O_CREAT)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            self._run_all(scheduler, [1] * 3)
+        finally:
+            os.close(fd)
+        self.assertEqual(self.max_active, 1)
+
+    def test_memory_budget(self):
+        scheduler = CompileScheduler(slot_num=3, slot_dir=self.tmp_dir, memory_budget=100)
+        self._run_all(scheduler, [60] * 3)
+        self.assertEqual(self.max_active, 1)
+        self.max_active = 0
+        self._run_all(scheduler, [50] * 4)
+        self.assertEqual(self.max_active, 2)
+        # 超过预算的任务在其他编译结束后单独运行
+        self.max_active = 0
+        self._run_all(scheduler, [200, 10])
+        self.assertEqual(self.max_active, 1)
+        # 结果先于槽位释放返回
+        for _ in range(100):
+            if not scheduler.stats()["busy_slots"]:
+                break
+            time.sleep(0.01)
+        self.assertEqual(scheduler.stats()["reserved_memory"], 0)
+
+    def test_cancel(self):
+        scheduler = CompileScheduler(slot_num=2, slot_dir=self.tmp_dir, memory_budget=100)
+        event = threading.Event()
+        first = scheduler.submit(100, self._task, "first", event)
+        # second 出队后等待内存预算, third 在队列中
+        second = scheduler.submit(100, self._task, "second")
+        third = scheduler.submit(100, self._task, "third")
+        time.sleep(0.2)
+        self.assertEqual(scheduler.stats()["queued"], 2)
+        self.assertTrue(second.cancel())
+        self.assertTrue(third.cancel())
+        event.set()
+        self.assertEqual(first.result(timeout=5), "first")
+        self.assertEqual(scheduler.submit(100, self._task, "fourth").result(timeout=5), "fourth")
+        self.assertEqual(self.ran, ["first", "fourth"])
+
+
+class HostSlotsTest(TempDirTestCase):
+    def _acquire_in_thread(self, slots):
+        result = []
+        thread = threading.Thread(target=lambda: result.append(slots.acquire()))
+        thread.start()
+        return thread, result
+
+    def test_wait_for_other_process(self):
+        slots = HostSlots(1, self.tmp_dir)
+        fd = os.open(os.path.join(self.tmp_dir, "slot-0"), os.O_RDWR | os.O_CREAT)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            thread, result = self._acquire_in_thread(slots)
+            time.sleep(0.3)
+            self.assertEqual(result, [])
+        finally:
+            os.close(fd)
+        thread.join(5)
+        self.assertEqual(result, [0])
+
+    def test_wake_on_release(self):
+        # 本进程释放槽位时直接唤醒等待的线程, 不必等到下一次轮询
+        slots = HostSlots(1, self.tmp_dir)
+        index = slots.acquire()
+        thread, result = self._acquire_in_thread(slots)
+        time.sleep(0.3)
+        slots.release(index)
+        thread.join(0.05)
+        self.assertEqual(result, [0])
+
+
+class RunInDirTest(TempDirTestCase):
+    @unittest.skipUnless(os.path.exists(JUDGER_PATH), "requires libjudger.so")
+    def test_cwd(self):
+        output_path = os.path.join(self.tmp_dir, "stdio.txt")
+        result = _run_in_dir(
+            self.tmp_dir, max_cpu_time=1000, max_real_time=2000, max_memory=judger.UNLIMITED,
+            max_stack=128 * 1024 * 1024, max_output_size=1024 * 1024, max_process_number=judger.UNLIMITED,
+            exe_path="/bin/pwd", input_path="/dev/null", output_path=output_path, error_path=output_path,
+            args=[], env=[], log_path=os.path.join(self.tmp_dir, "judger.log"), seccomp_rule_name=None,
+            uid=0, gid=0, memory_limit_check_only=0,
+        )
+        self.assertEqual(result["result"], judger.RESULT_SUCCESS)
+        with open(output_path) as f:
+            self.assertEqual(f.read().strip(), self.tmp_dir)
+
+
+class JobQueueTest(TempDirTestCase):
+    def test_result(self):
+        jobs = JobQueue(job_dir=self.tmp_dir, worker_num=1)
+        job_id = jobs.submit(lambda a, b: a + b, {"a": 1, "b": 2})
+        for _ in range(100):
+            job = jobs.result(job_id)
+            if job["status"] == JobStatus.done:
+                break
+            time.sleep(0.05)
+        self.assertEqual(job, {"job_id": job_id, "status": JobStatus.done, "err": None, "data": 3})
+
+    def test_orphaned_job(self):
+        # 所属 worker 已退出的任务查询时标记为 JobLost
+        process = subprocess.Popen(["true"])
+        process.wait()
+        job_id = "0" * 32
+        with open(os.path.join(self.tmp_dir, job_id + ".json"), "w") as f:
+            json.dump({"job_id": job_id, "status": JobStatus.pending, "err": None, "data": None,
+                       "owner": f"{process.pid}:0.0"}, f)
+        job = JobQueue(job_dir=self.tmp_dir).result(job_id)
+        self.assertEqual(job["status"], JobStatus.done)
+        self.assertEqual(job["err"], "JobLost")
+        self.assertNotIn("owner", job)
+
+
+class JavacServerTest(TempDirTestCase):
+    def setUp(self):
+        super().setUp()
+        # 常驻进程以编译用户运行
+        os.chmod(self.tmp_dir, 0o711)
+        self.server_dir = os.path.join(self.tmp_dir, "javac_server")
+        self.output_dir = os.path.join(self.tmp_dir, "submission")
+        for path in (self.server_dir, self.output_dir):
+            os.mkdir(path, 0o700)
+            os.chown(path, COMPILER_USER_UID, COMPILER_GROUP_GID)
+        self.compiler_out = os.path.join(self.output_dir, "compiler.out")
+        self.language_config = JavaConfig()
+        self.servers = []
+
+    def tearDown(self):
+        for server in self.servers:
+            if server._daemon is not None:
+                server._daemon.stop()
+        super().tearDown()
+
+    def _server(self, **kwargs):
+        server = JavacServer(server_dir=self.server_dir, enabled=True, **kwargs)
+        self.servers.append(server)
+        return server
+
+    def _compile(self, server, src):
+        src_path = os.path.join(self.output_dir, "Main.java")
+        with open(src_path, "w") as f:
+            f.write(src)
+        return server.compile(self.language_config, ["-cp", self.output_dir, src_path, "-d", self.output_dir],
+                              self.compiler_out)
+
+    def _read_compiler_out(self):
+        with open(self.compiler_out) as f:
+            return f.read()
+
+    def test_fallback(self):
+        # 常驻进程无法启动时回退为每次启动 javac
+        server = JavacServer(server_dir=os.path.join(self.tmp_dir, "missing"), enabled=True)
+        self.assertIsNone(self._compile(server, "public class Main {}"))
+        self.assertEqual(server.stats()["fallbacks"], 1)
+
+    @unittest.skipUnless(os.path.exists("/usr/bin/java"), "requires java")
+    def test_compile(self):
+        server = self._server()
+        result = self._compile(server, "public class Main { public static void main(String[] args) {} }")
+        self.assertEqual(result["result"], judger.RESULT_SUCCESS)
+        self.assertTrue(os.path.exists(os.path.join(self.output_dir, "Main.class")))
+        result = self._compile(server, "public class Main { int a = ; }")
+        self.assertEqual(result["result"], judger.RESULT_RUNTIME_ERROR)
+        self.assertIn("error", self._read_compiler_out())
+        self.assertEqual(server.stats(), {"requests": 2, "fallbacks": 0, "restarts": 1})
+
+    @unittest.skipUnless(os.path.exists("/usr/bin/java"), "requires java")
+    def test_output_limit(self):
+        server = self._server(max_output_size=16)
+        result = self._compile(server, "public class Main { int a = ; }")
+        self.assertEqual(result["result"], judger.RESULT_RUNTIME_ERROR)
+        self.assertEqual(len(self._read_compiler_out()), 16)
+
+    @unittest.skipUnless(os.path.exists("/usr/bin/java"), "requires java")
+    def test_cpu_time_limit(self):
+        server = self._server()
+        self._compile(server, "public class Main {}")
+        self.language_config.max_cpu_time = 0
+        result = self._compile(server, "public class Main {}")
+        self.assertEqual(result["result"], judger.RESULT_CPU_TIME_LIMIT_EXCEEDED)
+        # 超限后常驻进程退出, 下次请求重新启动
+        self.language_config.max_cpu_time = 5000
+        self.assertEqual(self._compile(server, "public class Main {}")["result"], judger.RESULT_SUCCESS)
+        self.assertEqual(server.stats()["restarts"], 2)
+
+    @unittest.skipUnless(os.path.exists("/usr/bin/java"), "requires java")
+    def test_real_time_limit(self):
+        server = self._server()
+        self._compile(server, "public class Main {}")
+        daemon = server._daemon
+        self.language_config.max_real_time = 1
+        result = self._compile(server, "public class Main {}")
+        self.assertEqual(result["result"], judger.RESULT_REAL_TIME_LIMIT_EXCEEDED)
+        self.assertIsNotNone(daemon.proc.poll())
+
+
+class PageCacheTest(TempDirTestCase):
+    def setUp(self):
+        super().setUp()
+        with open(os.path.join(self.tmp_dir, "1.in"), "wb") as f:
+            f.write(os.urandom(256 * 1024))
+        with open(os.path.join(self.tmp_dir, "1.out"), "wb") as f:
+            f.write(b"3\n")
+        with open(os.path.join(self.tmp_dir, "info"), "w") as f:
+            json.dump({"test_cases": {"1": {"input_name": "1.in", "output_name": "1.out"}}}, f)
+        self.size = 256 * 1024 + 2
+        self.warmer = PageCacheWarmer(lock_path=os.path.join(self.tmp_dir, ".lock"), mlock_budget=1024 * 1024)
+
+    def test_warm(self):
+        for touch in (True, False):
+            report = self.warmer.warm("a_plus_b", self.tmp_dir, touch=touch)
+            self.assertEqual(report["files"], 2)
+            self.assertEqual(report["size"], self.size)
+            self.assertLessEqual(report["resident"], self.size)
+        self.assertEqual(self.warmer.warm("a_plus_b", self.tmp_dir)["resident"], self.size)
+
+    def test_pin(self):
+        self.warmer._pin([("a_plus_b", self.tmp_dir)])
+        self.assertEqual(self.warmer.stats()["pinned"], self.size)
+        self.assertEqual(self.warmer.warm("a_plus_b", self.tmp_dir)["pinned"], self.size)
+        self.warmer._pin([])
+        self.assertEqual(self.warmer.stats()["pinned"], 0)
+
+
+class PrecompiledHeadersTest(TempDirTestCase):
+    def setUp(self):
+        super().setUp()
+        self.language_config = CppConfig({"version": "c++17"})
+        self.pch_dir = os.path.join(self.tmp_dir, "pch")
+        self.entry_dir = os.path.join(self.pch_dir, "c++17-O2")
+        os.makedirs(self.entry_dir)
+        self.src_path = os.path.join(self.tmp_dir, "main.cpp")
+        self._write_src("#include <bits/stdc++.h>\nint main() { return 0; }\n")
+        # 持有生成锁, 未命中时不在后台生成
+        self.build_lock_fd = os.open(os.path.join(self.pch_dir, ".lock-c++17-O2"), os.O_RDWR | os.O_CREAT)
+        fcntl.flock(self.build_lock_fd, fcntl.LOCK_EX)
+
+    def tearDown(self):
+        os.close(self.build_lock_fd)
+        super().tearDown()
+
+    def _write_src(self, src):
+        with open(self.src_path, "w") as f:
+            f.write(src)
+
+    def _write_stamp(self):
+        with open(os.path.join(self.entry_dir, "stamp"), "w") as f:
+            f.write(PrecompiledHeaders._stamp(self.language_config))
+
+    def test_valid_stamp(self):
+        self._write_stamp()
+        pch = PrecompiledHeaders(pch_dir=self.pch_dir, enabled=True)
+        self.assertEqual(pch.include(self.language_config, self.src_path), "-I" + self.entry_dir)
+        self.assertEqual(pch.stats(), {"hits": 1, "misses": 0, "builds": 0})
+
+    def test_missing_stamp(self):
+        pch = PrecompiledHeaders(pch_dir=self.pch_dir, enabled=True)
+        self.assertEqual(pch.include(self.language_config, self.src_path), "")
+        self.assertEqual(pch.stats(), {"hits": 0, "misses": 1, "builds": 0})
+
+    def test_check_interval(self):
+        self._write_stamp()
+        pch = PrecompiledHeaders(pch_dir=self.pch_dir, enabled=True, check_interval=60)
+        self.assertTrue(pch.include(self.language_config, self.src_path))
+        os.remove(os.path.join(self.entry_dir, "stamp"))
+        self.assertTrue(pch.include(self.language_config, self.src_path))
+        pch = PrecompiledHeaders(pch_dir=self.pch_dir, enabled=True, check_interval=0)
+        self.assertEqual(pch.include(self.language_config, self.src_path), "")
+
+    def test_include_after_scan_size(self):
+        self._write_stamp()
+        self._write_src("//" + "x" * INCLUDE_SCAN_SIZE + "\n#include <bits/stdc++.h>\n")
+        pch = PrecompiledHeaders(pch_dir=self.pch_dir, enabled=True)
+        self.assertEqual(pch.include(self.language_config, self.src_path), "")
+        self.assertEqual(pch.stats(), {"hits": 0, "misses": 0, "builds": 0})
+
+
+class ResultCacheTest(TempDirTestCase):
+    def _write(self, name, content):
+        with open(os.path.join(self.tmp_dir, name), "wb") as f:
+            f.write(content)
+
+    def test_hash_artifacts(self):
+        self.assertIsNone(hash_artifacts(self.tmp_dir, ["main"]))
+        self._write("main", b"\x7fELF")
+        artifact_hash = hash_artifacts(self.tmp_dir, ["main"])
+        # 用户输出和测试用例目录不计入
+        self._write("1.out", b"3\n")
+        os.mkdir(os.path.join(self.tmp_dir, "inline_test_case"))
+        self.assertEqual(hash_artifacts(self.tmp_dir, ["main"]), artifact_hash)
+        self._write("main", b"\x7fELF\x02")
+        self.assertNotEqual(hash_artifacts(self.tmp_dir, ["main"]), artifact_hash)
+
+    def test_hash_artifacts_suffix(self):
+        self._write("Main.class", b"\xca\xfe")
+        artifact_hash = hash_artifacts(self.tmp_dir, ["Main"], suffix=".class")
+        self._write("Main$1.class", b"\xca\xfe")
+        self.assertNotEqual(hash_artifacts(self.tmp_dir, ["Main"], suffix=".class"), artifact_hash)
+
+    def test_hash_test_case(self):
+        self._write("info", b"{}")
+        self._write("1.in", b"1 2\n")
+        test_case_hash = hash_test_case(self.tmp_dir)
+        self.assertEqual(hash_test_case(self.tmp_dir), test_case_hash)
+        # 输入大小不变, info 不变
+        self._write("1.in", b"2 1\n")
+        os.utime(os.path.join(self.tmp_dir, "1.in"), ns=(0, 1))
+        self.assertNotEqual(hash_test_case(self.tmp_dir), test_case_hash)
+
+
+class StagingTest(TempDirTestCase):
+    def _write(self, name, mode, uid=0):
+        path = os.path.join(self.tmp_dir, name)
+        with open(path, "wb") as f:
+            f.write(b"1 2\n")
+        os.chown(path, uid, 0)
+        os.chmod(path, mode)
+        return path
+
+    def test_hardlink_same_filesystem(self):
+        src = self._write("1.in", 0o644)
+        self.assertEqual(stage_file(src, os.path.join(self.tmp_dir, "input.txt")), StageStrategy.hardlink)
+
+    def test_no_hardlink_for_sandbox_owned_file(self):
+        # 属主可以修改硬链接的权限, 沙箱用户的文件只能 reflink 或拷贝
+        src = self._write("1.in", 0o644, uid=RUN_USER_UID)
+        dst = os.path.join(self.tmp_dir, "input.txt")
+        self.assertIn(stage_file(src, dst), (StageStrategy.reflink, StageStrategy.copy))
+        self.assertNotEqual(os.stat(src).st_ino, os.stat(dst).st_ino)
+
+    def test_copy_across_filesystems(self):
+        src = self._write("1.in", 0o644)
+        dst_dir = tempfile.mkdtemp(dir="/dev/shm")
+        try:
+            if os.stat(dst_dir).st_dev == os.stat(src).st_dev:
+                self.skipTest("/dev/shm is on the same filesystem")
+            self.assertEqual(stage_file(src, os.path.join(dst_dir, "input.txt")), StageStrategy.copy)
+        finally:
+            shutil.rmtree(dst_dir)
+
+
+class WorkspacePoolTest(TempDirTestCase):
+    def _wait_free(self, pool, num):
+        for _ in range(100):
+            if pool.stats()["free"] == num:
+                return
+            time.sleep(0.01)
+        self.fail("workspace pool not refilled")
+
+    def test_collect_orphans(self):
+        parent = psutil.Process(os.getppid())
+        alive = f"{parent.pid}-{parent.create_time()}-{uuid.uuid4().hex}"
+        # pid 被复用, 启动时间不同
+        reused = f"{os.getpid()}-0.0-{uuid.uuid4().hex}"
+        for name in (alive, reused):
+            os.mkdir(os.path.join(self.tmp_dir, name))
+        pool = WorkspacePool(workspace=self.tmp_dir, size=1)
+        pool.start()
+        self._wait_free(pool, 1)
+        names = os.listdir(self.tmp_dir)
+        self.assertIn(alive, names)
+        self.assertNotIn(reused, names)
+
+    def test_unique_name_per_lease(self):
+        pool = WorkspacePool(workspace=self.tmp_dir, size=1)
+        pool.start()
+        self._wait_free(pool, 1)
+        names = set()
+        for _ in range(3):
+            work_dir, test_case_dir = pool.lease(init_test_case_dir=True)
+            self.assertNotIn(work_dir, names)
+            names.add(work_dir)
+            self.assertTrue(os.path.isdir(test_case_dir))
+            # 不预先创建 file 模式的用例目录
+            self.assertEqual(os.listdir(work_dir), [os.path.basename(test_case_dir)])
+            os.mkdir(os.path.join(work_dir, "1"))
+            with open(os.path.join(work_dir, "1", "stdio.txt"), "w") as f:
+                f.write("3\n")
+            pool.release(work_dir)
+            self._wait_free(pool, 1)
+        self.assertGreater(pool.stats()["hits"], 0)
+
+
+class UploadTest(TempDirTestCase):
+    def test_output_md5(self):
+        # 分块写入, 块边界落在行尾空白中
+        data = b"1 2 \n\n3\t\n \n"
+        uploaded = UploadedTestCase(upload_dir=self.tmp_dir)
+        writer = uploaded.open("1.out")
+        for i in range(0, len(data), 3):
+            writer.write(data[i:i + 3])
+        writer.close()
+        expected = (hashlib.md5(data.rstrip()).hexdigest(), hashlib.md5(b"123").hexdigest())
+        self.assertEqual((writer.output_md5, writer.stripped_output_md5), expected)
+        self.assertEqual(output_md5(os.path.join(uploaded.path, "1.out")), expected)
+
+    def test_decompressed_size_limit(self):
+        body = gzip.compress(b"0" * 4096)
+        self.assertEqual(len(open_body(io.BytesIO(body), "gzip", max_bytes=4096).read()), 4096)
+        with self.assertRaises(JudgeClientError):
+            open_body(io.BytesIO(body), "gzip", max_bytes=4095).read()
+
+    def test_identity_size_limit(self):
+        self.assertEqual(len(open_body(io.BytesIO(b"0" * 4096), None, max_bytes=4096).read()), 4096)
+        with self.assertRaises(JudgeClientError):
+            open_body(io.BytesIO(b"0" * 4096), "identity", max_bytes=4095).read()
+
+    def test_data_size_limit(self):
+        body = (
+            b"--x\r\nContent-Disposition: form-data; name=\"data\"\r\n\r\n"
+            + b" " * (DATA_MAX_SIZE + 1)
+            + b"{}\r\n--x--\r\n"
+        )
+        request = Request(EnvironBuilder(
+            method="POST", input_stream=io.BytesIO(body), content_type="multipart/form-data; boundary=x",
+            content_length=len(body),
+        ).get_environ())
+        with self.assertRaises(JudgeClientError):
+            read_request(request)
+
+
+class TestCaseStoreTest(TempDirTestCase):
+    def _write(self, path):
+        with open(os.path.join(path, "1.in"), "w") as f:
+            f.write("1 2\n")
+
+    def test_republished_entry_is_hit(self):
+        store = TestCaseStore(store_dir=self.tmp_dir, max_size=1024 * 1024)
+        key = "0" * 64
+        with store.use(key, write=self._write):
+            pass
+        # 模拟淘汰: 持有排他锁期间条目被移走, 随后同一 key 被重新发布
+        entry_dir = os.path.join(self.tmp_dir, key)
+        lock_fd = os.open(os.path.join(entry_dir, ".lock"), os.O_RDONLY)
+        fcntl.flock(lock_fd, fcntl.LOCK_EX)
+        result = []
+
+        def use():
+            with store.use(key, write=self._write) as test_case_dir:
+                result.append(test_case_dir)
+
+        thread = threading.Thread(target=use)
+        thread.start()
+        time.sleep(0.1)
+        os.rename(entry_dir, os.path.join(self.tmp_dir, ".evicted"))
+        with TestCaseStore(store_dir=self.tmp_dir, max_size=1024 * 1024).use(key, write=self._write):
+            pass
+        os.close(lock_fd)
+        thread.join()
+        self.assertEqual(result, [entry_dir])
+        self.assertEqual(store.stats(), {"hits": 1, "misses": 1})
+
+    def test_evict(self):
+        # 每个条目 4 字节, 最多保留两个
+        store = TestCaseStore(store_dir=self.tmp_dir, max_size=8)
+        stale = os.path.join(self.tmp_dir, ".tmp-stale")
+        os.mkdir(stale)
+        os.utime(stale, (time.time() - STALE_TMP_AGE - 1,) * 2)
+        keys = [f"{index:064x}" for index in range(TEST_CASE_STORE_EVICT_INTERVAL)]
+        for key in keys[:-1]:
+            with store.use(key, write=self._write):
+                pass
+        # 发布满 TEST_CASE_STORE_EVICT_INTERVAL 个条目才检查总大小
+        self.assertEqual(len([name for name in os.listdir(self.tmp_dir) if name in keys]), len(keys) - 1)
+        with store.use(keys[-1], write=self._write):
+            pass
+        self.assertEqual(sorted(name for name in os.listdir(self.tmp_dir) if not name.startswith(".")), keys[-2:])
+        self.assertFalse(os.path.exists(stale))
+
+
+class TestCaseSyncTest(TempDirTestCase):
+    def setUp(self):
+        super().setUp()
+        self.source = os.path.join(self.tmp_dir, "source")
+        self.sync = TestCaseSync(source=self.source, sync_dir=os.path.join(self.tmp_dir, "sync"))
+
+    def _publish(self, version, output, output_md5=None):
+        """在来源目录中发布 a_plus_b 的一个版本"""
+        files = {
+            "1.in": b"1 2\n",
+            "1.out": output,
+            "info": json.dumps({"test_case_number": 1, "spj": False, "test_cases": {"1": {
+                "input_name": "1.in", "input_size": 4, "output_name": "1.out", "output_size": len(output),
+                "output_md5": output_md5 or hashlib.md5(output.rstrip()).hexdigest(),
+            }}}).encode("utf-8"),
+        }
+        package_dir = os.path.join(self.source, "a_plus_b")
+        os.makedirs(package_dir, exist_ok=True)
+        with open(os.path.join(package_dir, f"{version}.tar.zst"), "wb") as f:
+            with zstandard.ZstdCompressor().stream_writer(f) as writer:
+                with tarfile.open(fileobj=writer, mode="w|") as tar:
+                    for name, content in files.items():
+                        member = tarfile.TarInfo(name)
+                        member.size = len(content)
+                        tar.addfile(member, io.BytesIO(content))
+        with open(os.path.join(package_dir, "latest"), "w") as f:
+            f.write(version + "\n")
+
+    def _read_output(self):
+        with self.sync.use("a_plus_b") as test_case_dir:
+            with open(os.path.join(test_case_dir, "1.out"), "rb") as f:
+                return f.read()
+
+    def test_fetch(self):
+        self._publish("v1", b"3\n")
+        self.assertEqual(self._read_output(), b"3\n")
+        self.assertEqual(self._read_output(), b"3\n")
+        self.assertEqual(self.sync.unpacks, 1)
+
+    def test_version_bump(self):
+        self._publish("v1", b"3\n")
+        self.assertEqual(self._read_output(), b"3\n")
+        self._publish("v2", b"3 \n")
+        # 版本号缓存过期
+        self.sync._versions.clear()
+        self.assertEqual(self._read_output(), b"3 \n")
+        self.assertEqual(self.sync.unpacks, 2)
+
+    def test_checksum_mismatch(self):
+        self._publish("v1", b"3\n", output_md5="0" * 32)
+        with self.assertRaises(JudgeClientError) as cm:
+            self._read_output()
+        self.assertEqual(cm.exception.message, "Bad test case package")
+
+    def test_not_found(self):
+        with self.assertRaises(JudgeClientError) as cm:
+            self._read_output()
+        self.assertEqual(cm.exception.message, "Test case not found")
+
+
+if __name__ == "__main__":
+    unittest.main()